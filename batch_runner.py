@@ -0,0 +1,255 @@
+"""
+Batch extraction of many (folder, threshold, gaps, algorithm) jobs.
+
+Running the CLIs once per job pays the imports and the image decoding again for every job. The
+batch runner reads a manifest of jobs and runs them on a pool of worker processes:
+
+1. every (folder, gaps) volume of the manifest is loaded once into the volume cache
+   (see 'volume_cache.py'), one folder per worker,
+2. the jobs are run by the pool, each worker memory-maps the cached volumes it needs (and keeps
+   the last ones open with their brick index, so the jobs of the same volume share them),
+3. the result of every job is appended to a JSON lines report as soon as it is done: its status,
+   the triangle count, the output size and the stage times of the job (see 'profiling.py').
+
+The outputs are written to a temporary file that is renamed when complete, so after a crash (or
+Ctrl+C) the same command resumes the batch: the jobs reported done whose output exists are skipped,
+the failed and unfinished ones are run again.
+
+The manifest is a JSON list of jobs, or a CSV file with one job per row (header: field names):
+
+    input,output,threshold,gaps,algorithm
+    data/lower,out/lower_100.stl,100,1,cubes
+    data/lower,out/lower_100_tetra.obj,100,2,tetra
+
+$ python batch_runner.py jobs.csv --workers 4 --report jobs_report.jsonl
+
+input, output and threshold are required. algorithm is 'cubes' (vertices at the edge midpoints,
+like 'marching_cubes.py'), 'interp' (interpolated vertices, like 'marching_cubes_interp.py') or
+'tetra' (like 'marching_tetrahedra.py'), and an OBJ output is written as an indexed mesh. The jobs
+are identified in the report by their id field if given, else by their output.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+from brick_index import BrickIndex
+from indexed_mesh import save_obj_chunks
+from mc_vectorized import marching_cubes_vectorized
+from mt_vectorized import marching_tetrahedra_vectorized
+from profiling import Profiler
+from stl_writer import save_stl_chunks
+from volume_cache import DEFAULT_CACHE_DIR, load_ct_folder_cached
+
+
+ALGORITHMS = ("cubes", "interp", "tetra")
+
+# field: (type, default), None for the required fields
+JOB_FIELDS = {
+    "id": (str, ""),
+    "input": (str, None),
+    "output": (str, None),
+    "threshold": (float, None),
+    "gaps": (float, 1.0),
+    "algorithm": (str, "cubes"),
+    "slice_spacing": (float, 1.0),
+    "backend": (str, "numpy"),
+    "brick_size": (int, 32),
+}
+
+
+def parse_job(fields):
+    """job dict of the fields of a manifest entry, with the defaults filled in and the values checked"""
+
+    unknown = set(fields) - set(JOB_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown job fields {sorted(unknown)}, expected some of {list(JOB_FIELDS)}")
+
+    job = {}
+    for name, (kind, default) in JOB_FIELDS.items():
+        value = fields.get(name)
+        # the empty cells of a CSV file take the default
+        if value is None or value == "":
+            if default is None:
+                raise ValueError(f"job {dict(fields)} has no {name}")
+            value = default
+        job[name] = kind(value)
+
+    if job["algorithm"] not in ALGORITHMS:
+        raise ValueError(f"unknown algorithm {job['algorithm']}, expected one of {ALGORITHMS}")
+    if job["backend"] not in ("numpy", "numba"):
+        raise ValueError(f"unknown backend {job['backend']}, expected numpy or numba")
+    if not job["output"].endswith((".stl", ".obj")):
+        raise ValueError(f"the output of a job must be an .stl or .obj file, got {job['output']}")
+    job["id"] = job["id"] or job["output"]
+    return job
+
+
+def load_manifest(path):
+    """list of the jobs of a JSON (list of job objects) or CSV (one job per row) manifest"""
+
+    with open(path, newline="") as f:
+        entries = list(csv.DictReader(f)) if path.endswith(".csv") else json.load(f)
+
+    jobs = [parse_job(entry) for entry in entries]
+
+    # the jobs are resumed by id, and two jobs must not write the same file
+    for name in ("id", "output"):
+        values = [os.path.abspath(job[name]) if name == "output" else job[name] for job in jobs]
+        if len(set(values)) != len(values):
+            raise ValueError(f"the jobs of {path} must have distinct {name}s")
+    return jobs
+
+
+def finished_jobs(report_path):
+    """ids of the jobs reported done whose output exists (skipped when the batch is resumed)"""
+
+    done = set()
+    if not os.path.exists(report_path):
+        return done
+
+    with open(report_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # last line of a report interrupted while it was written
+                continue
+            if result.get("status") == "done" and os.path.exists(result["output"]):
+                done.add(result["id"])
+            else:
+                done.discard(result.get("id"))
+    return done
+
+
+def _prepare_volume(folder_dir, gaps, cache_dir):
+    """loads the volume into the cache (run once per volume, so that the workers never write the same entry)"""
+
+    load_ct_folder_cached(folder_dir, gaps, cache_dir)
+
+
+@lru_cache(maxsize=2)
+def _open_volume(folder_dir, gaps, cache_dir, brick_size):
+    """memory-mapped volume of the cache and its brick index, kept open for the next jobs of the worker"""
+
+    volume = load_ct_folder_cached(folder_dir, gaps, cache_dir)
+    bricks = BrickIndex(volume, brick_size) if brick_size > 0 else None
+    return volume, bricks
+
+
+def run_job(job, cache_dir=DEFAULT_CACHE_DIR):
+    """runs a job (in a worker process), returns its report line"""
+
+    profiler = Profiler()
+    start = time.perf_counter()
+
+    with profiler.stage("load"):
+        volume, bricks = _open_volume(os.path.abspath(job["input"]), job["gaps"], cache_dir, job["brick_size"])
+
+    save_obj = job["output"].endswith(".obj")
+    spacing = (1.0, 1.0, job["slice_spacing"])
+    if job["algorithm"] == "tetra":
+        mesh = marching_tetrahedra_vectorized(volume, job["threshold"], indexed=save_obj, bricks=bricks, spacing=spacing,
+                                              backend=job["backend"], profiler=profiler)
+    else:
+        mesh = marching_cubes_vectorized(volume, job["threshold"], indexed=save_obj, interpolate=job["algorithm"] == "interp",
+                                         bricks=bricks, spacing=spacing, backend=job["backend"], profiler=profiler)
+
+    # written next to the output and renamed when complete, an existing output is always a whole mesh
+    root, ext = os.path.splitext(job["output"])
+    partial = f"{root}.part{ext}"
+    os.makedirs(os.path.dirname(os.path.abspath(job["output"])), exist_ok=True)
+    try:
+        with profiler.stage("write"):
+            if save_obj:
+                save_obj_chunks(partial, [mesh])
+            else:
+                save_stl_chunks(partial, [mesh.vectors])
+        os.replace(partial, job["output"])
+    except BaseException:
+        # a failed write leaves no partial file behind
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    profiler.add_bytes("write", os.path.getsize(job["output"]))
+
+    return dict(job, status="done", seconds=time.perf_counter() - start, triangles=len(mesh[1] if save_obj else mesh),
+                output_bytes=os.path.getsize(job["output"]), profile=profiler.report())
+
+
+def run_batch(jobs, report_path, workers=None, cache_dir=DEFAULT_CACHE_DIR):
+    """runs the jobs not reported done in report_path on a pool of processes, appending their results to it
+
+    returns the number of (done, failed, skipped) jobs
+    """
+
+    done = finished_jobs(report_path)
+    todo = [job for job in jobs if job["id"] not in done]
+    n_done, n_failed = 0, 0
+
+    with open(report_path, "a") as report, ProcessPoolExecutor(max_workers=workers) as pool:
+
+        def record(result):
+            report.write(json.dumps(result) + "\n")
+            report.flush()
+
+        def failed(job, error):
+            record(dict(job, status="failed", error=f"{type(error).__name__}: {error}"))
+            print(f"{job['id']}: failed, {type(error).__name__}: {error}", file=sys.stderr)
+
+        # load every volume once, the volumes that cannot be loaded fail their jobs
+        volumes = {(os.path.abspath(job["input"]), job["gaps"]) for job in todo}
+        futures = {pool.submit(_prepare_volume, folder_dir, gaps, cache_dir): (folder_dir, gaps) for folder_dir, gaps in volumes}
+        broken = {}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                broken[futures[future]] = future.exception()
+
+        # the jobs of the same volume are submitted together, so that the workers keep it open
+        todo.sort(key=lambda job: (os.path.abspath(job["input"]), job["gaps"]))
+        futures = {}
+        for job in todo:
+            error = broken.get((os.path.abspath(job["input"]), job["gaps"]))
+            if error is not None:
+                failed(job, error)
+                n_failed += 1
+            else:
+                futures[pool.submit(run_job, job, cache_dir)] = job
+
+        for future in as_completed(futures):
+            job = futures[future]
+            if future.exception() is not None:
+                failed(job, future.exception())
+                n_failed += 1
+                continue
+            result = future.result()
+            record(result)
+            n_done += 1
+            print(f"{job['id']}: {result['triangles']} triangles in {result['seconds']:.3f}s", file=sys.stderr)
+
+    return n_done, n_failed, len(jobs) - len(todo)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Batch Marching Cubes")
+    parser.add_argument("manifest", type=str, help="JSON or CSV file of the jobs (input, output, threshold, gaps, algorithm, ...)")
+    parser.add_argument("--report", type=str, help="JSON lines report of the jobs, also used to resume the batch (default: <manifest>_report.jsonl)", default=None)
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs)", default=None)
+    parser.add_argument("--cache-dir", type=str, help="Directory of the volume cache the volumes are loaded into", default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ValueError) as error:
+        parser.error(f"invalid manifest: {error}")
+    report_path = args.report or os.path.splitext(args.manifest)[0] + "_report.jsonl"
+
+    n_done, n_failed, n_skipped = run_batch(jobs, report_path, args.workers, args.cache_dir)
+    print(f"{n_done} jobs done, {n_failed} failed, {n_skipped} already done (report: {report_path})", file=sys.stderr)
+    sys.exit(1 if n_failed else 0)
@@ -0,0 +1,364 @@
+"""
+Benchmark of the extractors on synthetic volumes and on the CT stacks of 'data/'.
+
+Every (volume, extractor, threshold) case is run in a fresh Python process (so that its peak
+memory can be measured) in three timed stages:
+    load: create or load the volume
+    extract: run the extractor (best of --repeat runs)
+    write: save the triangles to a binary STL file
+and reported as JSON (cells/s, triangles/s, peak RSS, stage times), to track regressions:
+
+$ python benchmark.py --volumes sphere head --extractors interp vectorized --output bench.json
+
+The loop extractors ('naive', 'interp', 'tetra') are skipped on volumes with more than
+--max-loop-cells cells.
+
+With --startup, the startup of every mode of 'marching.py' is timed instead (a fresh process
+showing the help of the mode, best of --repeat runs), together with the heavy dependencies it
+imported. A mode fails the check (exit code 1) if it takes more than --startup-budget seconds or
+imports any of HEAVY_MODULES, which the modes should only import when their options need them.
+The extraction tools are also timed on a tiny extraction (a 16^3 sphere written as images, extracted
+to a temporary STL file), which fails the check if it takes more than --extraction-budget seconds
+or imports matplotlib or numba:
+
+$ python benchmark.py --startup --repeat 5
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def _load_synthetic(name):
+    from load_voxels import create_sphere_voxels, create_multiple_objects
+    from synthetic_volumes import scene, sample_volume
+
+    if name == "sphere":
+        return create_sphere_voxels()
+    if name == "objects":
+        return create_multiple_objects()
+
+    # scene of 'synthetic_volumes.py' and size, e.g. gyroid256
+    scene_name = name.rstrip("0123456789")
+    shape = (int(name[len(scene_name):]),)*3
+    return sample_volume(shape, scene(scene_name, shape))
+
+
+def _load_stack(name):
+    from load_voxels import load_ct_folder_fast
+    return load_ct_folder_fast(os.path.join(DATA_DIR, name))
+
+
+# volume name: (loader, default threshold)
+VOLUMES = {
+    "sphere": (_load_synthetic, 0.0),
+    "objects": (_load_synthetic, 0.0),
+    "noise64": (_load_synthetic, 0.0),
+    "noise128": (_load_synthetic, 0.0),
+    "noise256": (_load_synthetic, 0.0),
+    "shapes128": (_load_synthetic, 0.0),
+    "shapes256": (_load_synthetic, 0.0),
+    "gyroid128": (_load_synthetic, 0.0),
+    "gyroid256": (_load_synthetic, 0.0),
+}
+for _stack in ("lower", "upper", "head"):
+    if os.path.isdir(os.path.join(DATA_DIR, _stack)):
+        VOLUMES[_stack] = (_load_stack, 100.0)
+
+
+def _naive(voxel, threshold, workers):
+    from marching_cubes import marching_cubes_naive
+    return marching_cubes_naive(voxel, threshold).vectors
+
+
+def _interp(voxel, threshold, workers):
+    from marching_cubes_interp import marching_cubes_iterpolation
+    return marching_cubes_iterpolation(voxel, threshold).vectors
+
+
+def _tetra(voxel, threshold, workers):
+    from marching_tetrahedra import marching_tetrahedra
+    return marching_tetrahedra(voxel, threshold).vectors
+
+
+def _vectorized(voxel, threshold, workers):
+    from mc_vectorized import marching_cubes_vectorized
+    return marching_cubes_vectorized(voxel, threshold).vectors
+
+
+def _bricks(voxel, threshold, workers):
+    from mc_vectorized import marching_cubes_vectorized
+    from brick_index import BrickIndex
+    return marching_cubes_vectorized(voxel, threshold, bricks=BrickIndex(voxel)).vectors
+
+
+def _tetra_vectorized(voxel, threshold, workers):
+    from mt_vectorized import marching_tetrahedra_vectorized
+    return marching_tetrahedra_vectorized(voxel, threshold).vectors
+
+
+def _numba(voxel, threshold, workers):
+    from mc_vectorized import marching_cubes_vectorized
+    return marching_cubes_vectorized(voxel, threshold, backend="numba").vectors
+
+
+def _tetra_numba(voxel, threshold, workers):
+    from mt_vectorized import marching_tetrahedra_vectorized
+    return marching_tetrahedra_vectorized(voxel, threshold, backend="numba").vectors
+
+
+def _parallel(voxel, threshold, workers):
+    from mc_parallel import marching_cubes_parallel
+    return marching_cubes_parallel(voxel, threshold, workers=workers).vectors
+
+
+def _stream(voxel, threshold, workers):
+    from mc_vectorized import marching_cubes_stream
+    chunks = list(marching_cubes_stream((voxel[:, :, k] for k in range(voxel.shape[2])), threshold))
+    return np.concatenate(chunks) if chunks else np.zeros((0, 3, 3), dtype=np.float32)
+
+
+# extractor name: (function(voxel, threshold, workers) -> (T, 3, 3) triangles, python loop over the cells)
+EXTRACTORS = {
+    "naive": (_naive, True),
+    "interp": (_interp, True),
+    "tetra": (_tetra, True),
+    "vectorized": (_vectorized, False),
+    "bricks": (_bricks, False),
+    "tetra_vectorized": (_tetra_vectorized, False),
+    "numba": (_numba, False),
+    "tetra_numba": (_tetra_numba, False),
+    "parallel": (_parallel, False),
+    "stream": (_stream, False),
+}
+
+
+# modes of 'marching.py' timed by --startup, the dependencies they must not import to start, and
+# the startup budget in seconds (the Python interpreter and NumPy take about half of it)
+STARTUP_MODES = ("cubes", "interp", "tetra", "batch", "synthetic")
+HEAVY_MODULES = ("matplotlib", "cv2", "stl", "numba")
+STARTUP_BUDGET_S = 0.5
+
+# modes also timed on a tiny extraction, its size, the dependencies it must not import (it reads
+# images with cv2 and builds a numpy-stl mesh) and its budget in seconds
+EXTRACTION_MODES = ("cubes", "interp", "tetra")
+EXTRACTION_SIZE = 16
+EXTRACTION_HEAVY_MODULES = ("matplotlib", "numba")
+EXTRACTION_BUDGET_S = 1.0
+
+
+def imported_modules(command):
+    """top-level modules imported by a command (a Python command line), from the output of -X importtime"""
+
+    process = subprocess.run([command[0], "-X", "importtime"] + command[1:], capture_output=True, text=True)
+    modules = set()
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return modules
+
+
+def time_command(command, repeat=1):
+    """best time of a command (a Python command line) over repeat fresh processes, and the top-level modules it imported"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times), imported_modules(command)
+
+
+def write_extraction_input(folder_dir, size=EXTRACTION_SIZE):
+    """writes a size^3 sphere as a folder of PNG images, the input of the tiny extraction of --startup"""
+
+    # cv2 is only needed to write the images
+    import cv2
+
+    center = (size - 1) / 2
+    distance = np.sqrt(sum((x - center)**2 for x in np.ogrid[:size, :size, :size]))
+    volume = np.clip(128 + 32*(size/3 - distance), 0, 255).astype(np.uint8)
+    for k in range(size):
+        cv2.imwrite(os.path.join(folder_dir, f"slice_{k:03d}.png"), volume[:, :, k])
+
+
+def run_startup(mode, repeat=1, budget=STARTUP_BUDGET_S, extraction_budget=EXTRACTION_BUDGET_S):
+    """times the startup of a mode of 'marching.py' in fresh processes, and a tiny extraction of the
+    EXTRACTION_MODES, returns its result dict"""
+
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "marching.py"), mode]
+
+    startup_s, modules = time_command(command + ["--help"], repeat)
+    heavy = sorted(modules & set(HEAVY_MODULES))
+    result = {"mode": mode, "startup_s": startup_s, "budget_s": budget, "heavy_modules": heavy,
+              "ok": startup_s <= budget and not heavy}
+    if mode not in EXTRACTION_MODES:
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the output is not written into the folder of the images, which are all read
+        images = os.path.join(tmp, "images")
+        os.mkdir(images)
+        write_extraction_input(images)
+        extraction = ["--input", images, "--output", os.path.join(tmp, "output.stl"), "--threshold", "128"]
+        extraction_s, modules = time_command(command + extraction, repeat)
+    heavy = sorted(modules & set(EXTRACTION_HEAVY_MODULES))
+    result.update(extraction_s=extraction_s, extraction_budget_s=extraction_budget, extraction_heavy_modules=heavy,
+                  ok=result["ok"] and extraction_s <= extraction_budget and not heavy)
+    return result
+
+
+def peak_rss_mb():
+    """peak resident memory of the process in MB (None if it cannot be measured on this platform)"""
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak/2**20 if sys.platform == "darwin" else peak/2**10
+
+
+def run_case(volume, extractor, threshold=None, repeat=1, workers=2, max_loop_cells=64**3):
+    """runs one benchmark case in this process, returns its result dict"""
+
+    loader, default_threshold = VOLUMES[volume]
+    extract, is_loop = EXTRACTORS[extractor]
+    threshold = default_threshold if threshold is None else threshold
+    result = {"volume": volume, "extractor": extractor, "threshold": threshold}
+
+    start = time.perf_counter()
+    voxel = loader(volume)
+    result["load_s"] = time.perf_counter() - start
+
+    cells = int(np.prod(np.array(voxel.shape) - 1))
+    result.update(shape=list(voxel.shape), dtype=voxel.dtype.name, cells=cells)
+    if is_loop and cells > max_loop_cells:
+        result["skipped"] = f"more than {max_loop_cells} cells for a loop extractor"
+        return result
+
+    # untimed run on a corner of the volume (same dtype and memory layout), so that the imports
+    # and the numba compilation are not counted in the extract time
+    warmup = voxel[:4, :4, :4]
+    extract(warmup.copy() if voxel.flags.c_contiguous else warmup, threshold, workers)
+
+    # best of repeat runs
+    extract_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        triangles = extract(voxel, threshold, workers)
+        extract_times.append(time.perf_counter() - start)
+    result["extract_s"] = min(extract_times)
+
+    from stl_writer import save_stl_chunks
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "benchmark.stl")
+        start = time.perf_counter()
+        save_stl_chunks(path, [triangles])
+        result["write_s"] = time.perf_counter() - start
+        result["stl_bytes"] = os.path.getsize(path)
+
+    result["triangles"] = len(triangles)
+    result["cells_per_s"] = cells/result["extract_s"] if result["extract_s"] > 0 else None
+    result["triangles_per_s"] = len(triangles)/result["extract_s"] if result["extract_s"] > 0 else None
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_isolated(case):
+    """runs a case in a fresh Python process (peak RSS of the case only)"""
+
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)],
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        return dict(case, error=process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "failed")
+    # the result is the last line (the loaders may print)
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def machine_info():
+    info = {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "cpu_count": os.cpu_count()}
+    try:
+        import numba
+        info["numba"] = numba.__version__
+    except ImportError:
+        info["numba"] = None
+    return info
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Marching Cubes benchmark")
+    parser.add_argument("--volumes", type=str, nargs="+", help="Volumes to run on", choices=list(VOLUMES), default=list(VOLUMES))
+    parser.add_argument("--extractors", type=str, nargs="+", help="Extractors to run", choices=list(EXTRACTORS), default=list(EXTRACTORS))
+    parser.add_argument("--thresholds", type=float, nargs="+", help="Thresholds (default: one per volume)", default=None)
+    parser.add_argument("--repeat", type=int, help="Number of extraction runs per case (the best time is reported)", default=1)
+    parser.add_argument("--workers", type=int, help="Number of worker processes of the parallel extractor", default=2)
+    parser.add_argument("--max-loop-cells", type=int, help="Largest volume (in cells) the loop extractors are run on", default=64**3)
+    parser.add_argument("--in-process", action="store_true", help="Run the cases in this process (the peak RSS is then cumulative)")
+    parser.add_argument("--startup", action="store_true", help="Time the startup of the modes of marching.py instead of the extractors")
+    parser.add_argument("--startup-budget", type=float, help="Startup time budget of a mode in seconds (with --startup)", default=STARTUP_BUDGET_S)
+    parser.add_argument("--extraction-budget", type=float, help=f"Time budget in seconds of the {EXTRACTION_SIZE}^3 extraction of the extraction modes (with --startup)", default=EXTRACTION_BUDGET_S)
+    parser.add_argument("--output", type=str, help="Path to output JSON file (default: stdout)", default=None)
+    parser.add_argument("--run-case", type=str, help=argparse.SUPPRESS, default=None)
+    args = parser.parse_args()
+
+    if args.run_case is not None:
+        # single case, run by run_isolated
+        print(json.dumps(run_case(**json.loads(args.run_case))))
+        sys.exit(0)
+
+    if args.startup:
+        results = []
+        for mode in STARTUP_MODES:
+            result = run_startup(mode, args.repeat, args.startup_budget, args.extraction_budget)
+            results.append(result)
+            heavy = result["heavy_modules"] + result.get("extraction_heavy_modules", [])
+            print(f"{mode:>10}: startup {result['startup_s']:.3f}s (budget {result['budget_s']:.3f}s)"
+                  + (f", extraction {result['extraction_s']:.3f}s (budget {result['extraction_budget_s']:.3f}s)"
+                     if "extraction_s" in result else "")
+                  + (f", imports {', '.join(sorted(set(heavy)))}" if heavy else "")
+                  + ("" if result["ok"] else ", FAILED"), file=sys.stderr)
+
+        report = json.dumps({"machine": machine_info(), "startup": results}, indent=1)
+        if args.output is None:
+            print(report)
+        else:
+            with open(args.output, "w") as f:
+                f.write(report)
+        sys.exit(0 if all(result["ok"] for result in results) else 1)
+
+    results = []
+    for volume in args.volumes:
+        for threshold in args.thresholds or [None]:
+            for extractor in args.extractors:
+                case = dict(volume=volume, extractor=extractor, threshold=threshold, repeat=args.repeat,
+                            workers=args.workers, max_loop_cells=args.max_loop_cells)
+                result = run_case(**case) if args.in_process else run_isolated(case)
+                results.append(result)
+
+                if "extract_s" in result:
+                    print(f"{volume:>10} {extractor:>16}: extract {result['extract_s']:.3f}s, "
+                          f"{result['triangles']} triangles, {result['cells_per_s']:.0f} cells/s", file=sys.stderr)
+                else:
+                    print(f"{volume:>10} {extractor:>16}: {result.get('skipped') or result.get('error')}", file=sys.stderr)
+
+    report = json.dumps({"machine": machine_info(), "results": results}, indent=1)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report)
@@ -0,0 +1,74 @@
+"""
+Min/max brick index for empty-space skipping.
+
+The cells of the volume are grouped into fixed-size bricks of brick_size^3 cells, and the minimum
+and maximum voxel values of each brick (including the voxels shared with the next brick) are
+computed once. A cell can only be crossed by the isosurface if one of its corners is above the
+threshold and another one is not, so a brick can only contain surface cells if
+    min <= threshold < max
+The extractors then classify only the cells of those bricks. The index does not depend on the
+threshold, so the same index can be reused for any number of threshold queries on the volume.
+"""
+
+import numpy as np
+
+
+def _overlapping_block_reduce(values, size, axis, reduce):
+    """reduces values along axis over the blocks [b*size, (b+1)*size] (inclusive, so blocks share their last point)"""
+
+    values = np.moveaxis(values, axis, 0)
+    n = values.shape[0]
+    n_blocks = max(-(-(n - 1) // size), 1)
+    n_full = min(n_blocks, (n - 1) // size)     # blocks that have a next block point
+
+    blocks = np.empty((n_blocks,) + values.shape[1:], dtype=values.dtype)
+    if n_full:
+        reduce.reduce(values[:n_full*size].reshape((n_full, size) + values.shape[1:]), axis=1, out=blocks[:n_full])
+        # add the first point of the next block
+        reduce(blocks[:n_full], values[size:n_full*size + 1:size], out=blocks[:n_full])
+    if n_full < n_blocks:
+        # the last block runs to the end of the axis
+        blocks[n_full] = reduce.reduce(values[n_full*size:], axis=0)
+
+    return np.moveaxis(blocks, 0, axis)
+
+
+class BrickIndex:
+
+    def __init__(self, voxel, brick_size=32):
+        self.shape = voxel.shape
+        self.brick_size = brick_size
+
+        # reduce one axis at a time (the array shrinks by brick_size after each axis)
+        brick_min, brick_max = voxel, voxel
+        for axis in range(3):
+            brick_min = _overlapping_block_reduce(brick_min, brick_size, axis, np.minimum)
+            brick_max = _overlapping_block_reduce(brick_max, brick_size, axis, np.maximum)
+
+        self.brick_min = brick_min
+        self.brick_max = brick_max
+
+    @classmethod
+    def from_bounds(cls, shape, brick_size, brick_min, brick_max):
+        """index of precomputed brick bounds (e.g. the bounds stored with a bricked volume, see 'brick_volume.py')"""
+
+        index = cls.__new__(cls)
+        index.shape = tuple(shape)
+        index.brick_size = brick_size
+        index.brick_min = brick_min
+        index.brick_max = brick_max
+        return index
+
+    def active_bricks(self, threshold):
+        """boolean mask of the bricks whose [min, max] range straddles the threshold"""
+        return (self.brick_min <= threshold) & (self.brick_max > threshold)
+
+    def brick_slices(self, threshold):
+        """voxel slices (with the shared boundary voxels) of the active bricks"""
+
+        s = self.brick_size
+        return [tuple(slice(b*s, min((b + 1)*s + 1, n)) for b, n in zip(brick, self.shape))
+                for brick in np.argwhere(self.active_bricks(threshold))]
+
+    def active_fraction(self, threshold):
+        return self.active_bricks(threshold).mean()
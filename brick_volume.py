@@ -0,0 +1,328 @@
+"""
+Chunked out-of-core volume format.
+
+A bricked volume is a directory holding the voxels of a volume as fixed-size bricks of
+brick_size^3 cells ((brick_size + 1)^3 voxels, the last voxel of a brick along each axis is
+repeated as the first voxel of the next one, and the bricks at the end of the grid are padded by
+repeating the last voxel, like 'mc_vectorized.gather_bricks'):
+
+    header.json      shape, dtype, brick size, compression and the source of the volume
+    brick_min.npy    minimum and maximum of every brick (the bounds of a 'brick_index.BrickIndex')
+    brick_max.npy
+    bricks.npy       raw bricks, a (bricks_k, bricks_i, bricks_j, size + 1, size + 1, size + 1) array
+    bricks.bin       or zlib compressed bricks, one after the other, located by offsets.npy
+
+The bricks are ordered by slab along the third axis (the axis of the images), so the converter
+only holds brick_size + 1 slices at a time ('convert_ct_folder' reads the images lazily with
+'load_voxels.iter_ct_slices') and the slabs are read back with sequential I/O.
+
+'BrickVolume' opens the directory without reading any brick: the raw bricks are memory-mapped
+and the compressed ones are decompressed on demand. 'marching_cubes_bricked' extracts the
+isosurface one slab of bricks at a time, reading only the bricks whose [min, max] range
+straddles the threshold, so volumes far larger than the memory can be processed:
+
+    volume = load_ct_bricked("./data/lower", "./data/lower.bricks", gaps=4)
+    save_stl_chunks("output.stl", marching_cubes_bricked(volume, threshold=100))
+"""
+
+import json
+import os
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from brick_index import BrickIndex
+from indexed_mesh import key_plane
+from load_voxels import iter_ct_slices, read_ct_image, slice_positions
+from mc_parallel import merge_indexed
+from mc_vectorized import extract_block, chain_indexed_parts
+from profiling import NULL_PROFILER
+from stl_writer import triangle_buffer
+from volume_cache import folder_metadata
+
+
+BRICK_SIZE = 64
+COMPRESSIONS = ("raw", "zlib")
+
+
+def brick_grid(shape, brick_size):
+    """number of bricks along each axis (same as the bounds of a 'brick_index.BrickIndex')"""
+    return tuple(max(-(-(n - 1) // brick_size), 1) for n in shape)
+
+
+def _cut_bricks(window, brick_size, n_bricks):
+    """yields the bricks of a (height, width, <= size + 1) window of slices, padded by repeating the last voxel"""
+
+    size = brick_size
+    padding = [(0, n_bricks[0]*size + 1 - window.shape[0]), (0, n_bricks[1]*size + 1 - window.shape[1]),
+               (0, size + 1 - window.shape[2])]
+    window = np.pad(window, padding, mode="edge")
+    for bi in range(n_bricks[0]):
+        for bj in range(n_bricks[1]):
+            yield bi, bj, window[bi*size:(bi + 1)*size + 1, bj*size:(bj + 1)*size + 1]
+
+
+def save_bricked(slices, shape, path, brick_size=BRICK_SIZE, compression="raw", dtype=None, metadata=None,
+                 profiler=NULL_PROFILER):
+    """writes a stream of 2D slices (stacked along the third axis) of a volume of the given shape as a bricked volume
+
+    Only brick_size + 1 slices are held at a time. The voxels are stored as dtype (the dtype of the
+    first slice if not given), raw or zlib compressed. metadata is saved in the header (as 'source').
+    An in-memory volume is saved with (volume[:, :, k] for k in range(volume.shape[2])).
+    Returns the opened 'BrickVolume'.
+    """
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+    if brick_size < 1:
+        raise ValueError(f"brick size must be positive, got {brick_size}")
+    if len(shape) != 3 or min(shape) < 2:
+        raise ValueError(f"a bricked volume needs at least 2 voxels along each of its 3 axes, got {tuple(shape)}")
+
+    shape = tuple(int(n) for n in shape)
+    n_bricks = brick_grid(shape, brick_size)
+    size = brick_size + 1
+
+    # write to a temporary directory first so an interrupted conversion never leaves a partial volume
+    tmp_path = path.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    offsets = [0]
+    bricks = data = None
+    window = []
+    bk = 0
+    try:
+        for k, image in enumerate(slices):
+            if k >= shape[2] or image.shape != shape[:2]:
+                raise ValueError(f"slice {k} is {image.shape}, expected {shape[2]} slices of {shape[:2]}")
+            if k == 0:
+                dtype = np.dtype(dtype or image.dtype)
+                brick_min = np.empty(n_bricks, dtype=dtype)
+                brick_max = np.empty(n_bricks, dtype=dtype)
+                if compression == "raw":
+                    bricks = np.lib.format.open_memmap(os.path.join(tmp_path, "bricks.npy"), mode="w+", dtype=dtype,
+                                                       shape=(n_bricks[2], n_bricks[0], n_bricks[1], size, size, size))
+                else:
+                    data = open(os.path.join(tmp_path, "bricks.bin"), "wb")
+
+            window.append(np.asarray(image).astype(dtype, copy=False))
+            if len(window) < size and k < shape[2] - 1:
+                continue
+
+            # one slab of bricks, the last slice of the window is the first one of the next slab
+            with profiler.stage("bricks"):
+                for bi, bj, brick in _cut_bricks(np.stack(window, axis=2), brick_size, n_bricks):
+                    brick_min[bi, bj, bk] = brick.min()
+                    brick_max[bi, bj, bk] = brick.max()
+                    if bricks is not None:
+                        bricks[bk, bi, bj] = brick
+                    else:
+                        compressed = zlib.compress(np.ascontiguousarray(brick).tobytes(), 1)
+                        data.write(compressed)
+                        offsets.append(offsets[-1] + len(compressed))
+            profiler.add_bytes("bricks", n_bricks[0]*n_bricks[1]*size**3*dtype.itemsize)
+            window = window[-1:]
+            bk += 1
+    finally:
+        if data is not None:
+            data.close()
+
+    if bk != n_bricks[2]:
+        raise ValueError(f"the stream ended before the {shape[2]} slices of the volume")
+
+    if bricks is not None:
+        bricks.flush()
+        del bricks
+    else:
+        np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "brick_min.npy"), brick_min)
+    np.save(os.path.join(tmp_path, "brick_max.npy"), brick_max)
+
+    header = {"shape": list(shape), "dtype": dtype.str, "brick_size": brick_size, "compression": compression,
+              "source": metadata}
+    with open(os.path.join(tmp_path, "header.json"), "w") as f:
+        json.dump(header, f, indent=1)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return BrickVolume(path)
+
+
+def convert_ct_folder(folder_dir, path, gaps=1, brick_size=BRICK_SIZE, compression="raw", dtype=None,
+                      profiler=NULL_PROFILER):
+    """converts the images of a folder (resampled with gaps slices per image interval) into a bricked volume
+
+    The images are read lazily, so the volume never has to fit in memory. The voxels keep the
+    dtype of the images without gaps, and are stored as float64 when resampled (like
+    'load_voxels.resample_depth', so the bricked engine extracts the same surface as the others).
+    """
+
+    files = sorted(os.listdir(folder_dir))
+    first = read_ct_image(os.path.join(folder_dir, files[0]))
+    n_slices = len(slice_positions(len(files), gaps)[0])
+    dtype = dtype or (first.dtype if gaps == 1 else np.float64)
+
+    volume = save_bricked(iter_ct_slices(folder_dir, gaps, profiler), first.shape + (n_slices,), path, brick_size,
+                          compression, dtype, folder_metadata(folder_dir, gaps), profiler)
+
+    print(f"Converted {len(files)} images from {folder_dir} into the bricked volume {path}")
+    print(f"Dimensions: {volume.shape}")
+    return volume
+
+
+def load_ct_bricked(folder_dir, path, gaps=1, brick_size=BRICK_SIZE, compression="raw", profiler=NULL_PROFILER):
+    """opens the bricked volume of a folder, converted once (and again when the images change, see 'volume_cache.py')"""
+
+    try:
+        volume = BrickVolume(path)
+        if volume.metadata == folder_metadata(folder_dir, gaps) and volume.brick_size == brick_size \
+                and volume.compression == compression:
+            print(f"Opened bricked volume {path} for {folder_dir}")
+            print(f"Dimensions: {volume.shape}")
+            return volume
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return convert_ct_folder(folder_dir, path, gaps, brick_size, compression, profiler=profiler)
+
+
+class BrickVolume:
+    """lazy reader of a bricked volume (see save_bricked), no brick is read before it is needed"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "header.json")) as f:
+            header = json.load(f)
+
+        self.path = path
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.brick_size = header["brick_size"]
+        self.compression = header["compression"]
+        self.metadata = header["source"]
+        self.n_bricks = brick_grid(self.shape, self.brick_size)
+
+        # the bounds of the bricks are the brick index of the volume
+        self.index = BrickIndex.from_bounds(self.shape, self.brick_size, np.load(os.path.join(path, "brick_min.npy")),
+                                            np.load(os.path.join(path, "brick_max.npy")))
+
+        if self.compression == "raw":
+            self._bricks = np.load(os.path.join(path, "bricks.npy"), mmap_mode="r")
+        elif self.compression == "zlib":
+            data_path = os.path.join(path, "bricks.bin")
+            self._data = np.memmap(data_path, dtype=np.uint8, mode="r") if os.path.getsize(data_path) \
+                else np.empty(0, dtype=np.uint8)
+            self._offsets = np.load(os.path.join(path, "offsets.npy"))
+        else:
+            raise ValueError(f"unknown compression {self.compression!r}, expected one of {COMPRESSIONS}")
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape))*self.dtype.itemsize
+
+    def read_brick(self, brick):
+        """(size + 1)^3 voxels of the (bi, bj, bk) brick, padded at the end of the grid"""
+
+        bi, bj, bk = brick
+        if self.compression == "raw":
+            return self._bricks[bk, bi, bj]
+
+        n = (bk*self.n_bricks[0] + bi)*self.n_bricks[1] + bj
+        size = self.brick_size + 1
+        voxels = zlib.decompress(self._data[self._offsets[n]:self._offsets[n + 1]])
+        return np.frombuffer(voxels, dtype=self.dtype).reshape(size, size, size)
+
+    def brick_block(self, brick, voxels=None):
+        """(voxel index of the origin, voxels) of the brick, without the padding (voxels is the read brick if given)"""
+
+        origin = np.asarray(brick)*self.brick_size
+        stop = np.minimum(origin + self.brick_size + 1, self.shape) - origin
+        voxels = self.read_brick(brick) if voxels is None else voxels
+        return tuple(origin.tolist()), voxels[:stop[0], :stop[1], :stop[2]]
+
+    def __getitem__(self, index):
+        """reads a region of the volume, given as a tuple of 3 slices, from the bricks overlapping it"""
+
+        if not isinstance(index, tuple) or len(index) != 3 or not all(isinstance(s, slice) for s in index):
+            raise ValueError("a bricked volume is indexed by a tuple of 3 slices")
+        bounds = [s.indices(n) for s, n in zip(index, self.shape)]
+        if any(step != 1 for _, _, step in bounds):
+            raise ValueError("a bricked volume can only be read with unit steps")
+
+        size = self.brick_size
+        region = np.empty([max(stop - start, 0) for start, stop, _ in bounds], dtype=self.dtype)
+        if not region.size:
+            return region
+
+        ranges = [range(start // size, min((stop - 2) // size, n - 1) + 1) if stop - start > 1 else
+                  range(min(start // size, n - 1), min(start // size, n - 1) + 1)
+                  for (start, stop, _), n in zip(bounds, self.n_bricks)]
+        for bi in ranges[0]:
+            for bj in ranges[1]:
+                for bk in ranges[2]:
+                    origin, voxels = self.brick_block((bi, bj, bk))
+                    # overlap of the brick with the region, in the coordinates of both
+                    src, dst = [], []
+                    for o, n, (start, stop, _) in zip(origin, voxels.shape, bounds):
+                        low, high = max(o, start), min(o + n, stop)
+                        src.append(slice(low - o, high - o))
+                        dst.append(slice(low - start, high - start))
+                    region[tuple(dst)] = voxels[tuple(src)]
+
+        return region
+
+
+def marching_cubes_bricked(volume, threshold=0.0, indexed=False, interpolate=True, extract=extract_block,
+                           spacing=(1.0, 1.0, 1.0), workers=None, profiler=NULL_PROFILER):
+    """runs marching cubes on a 'BrickVolume', one slab of bricks (along the third axis) at a time
+
+    Only the bricks whose [min, max] range straddles the threshold are read (by a pool of workers
+    threads) and extracted, one block of the grid each. Yields one chunk per slab, like
+    'mc_vectorized.marching_cubes_stream': (T, 3, 3) float32 triangles, or if indexed is set,
+    (new vertices, faces) chunks where the faces index into all the vertices yielded so far.
+    extract is the block extractor (e.g. 'mt_vectorized.extract_tetra_block' for tetrahedra).
+    """
+
+    active = volume.index.active_bricks(threshold)
+    profiler.count("bricks_read", active.sum())
+    profiler.count("bricks_skipped", active.size - active.sum())
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        slabs = (_extract_slab(volume, threshold, active, bk, pool, extract, indexed, interpolate, spacing, profiler)
+                 for bk in range(volume.n_bricks[2]))
+
+        if not indexed:
+            for parts in slabs:
+                yield np.concatenate(parts, out=triangle_buffer(sum(len(part) for part in parts))) if parts \
+                    else triangle_buffer(0)
+            return
+
+        # the vertices shared by the bricks of a slab are merged by global edge ID, and those on the
+        # top slice of the slab are reused by the next slab
+        yield from chain_indexed_parts(_merge_slab(parts, volume.shape, (bk + 1)*volume.brick_size)
+                                       for bk, parts in enumerate(slabs))
+
+
+def _extract_slab(volume, threshold, active, bk, pool, extract, indexed, interpolate, spacing, profiler):
+    """reads the active bricks of slab bk and extracts them, returns the list of their meshes"""
+
+    bricks = [(bi, bj, bk) for bi, bj in np.argwhere(active[:, :, bk]).tolist()]
+    with profiler.stage("read"):
+        blocks = [volume.brick_block(brick, voxels) for brick, voxels in zip(bricks, pool.map(volume.read_brick, bricks))]
+    profiler.add_bytes("read", len(bricks)*(volume.brick_size + 1)**3*volume.dtype.itemsize)
+
+    return [extract(voxels, threshold, origin=origin, grid_shape=volume.shape, indexed=indexed, interpolate=interpolate,
+                    spacing=spacing, profiler=profiler) for origin, voxels in blocks]
+
+
+def _merge_slab(parts, shape, top):
+    """(keys, vertices, faces, vertices on slice top) of the merged meshes of the bricks of a slab"""
+
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.int64), \
+            np.empty(0, dtype=bool)
+
+    keys, vertices, faces = merge_indexed(parts)
+    return keys, vertices, faces, key_plane(keys, shape) == top
@@ -0,0 +1,258 @@
+"""
+Command line of the extraction tools.
+
+'marching_cubes.py' (vertices at the edge midpoints), 'marching_cubes_interp.py' (interpolated
+vertices) and 'marching_tetrahedra.py' (tetrahedra) share their options and engines, the algorithm
+only selects the block extractor, the vectorized extractor and the loop implementation:
+
+$ python marching_cubes.py --input ./data/lower --output lower.stl --threshold 100 --engine stream
+
+The interp tool also extracts several thresholds at once (one output per threshold), LOD previews
+and adaptive meshes.
+
+The modules of the engines are only imported by the engine that runs, and the heavy dependencies
+only when the options need them (cv2 when images are read, numba by the numba backend, matplotlib
+by myplot), so the startup of a small extraction is not dominated by the imports (see
+'benchmark.py --startup').
+"""
+
+import argparse
+import os
+import time
+
+from profiling import Profiler, NULL_PROFILER
+
+
+# algorithm: (engine help, default output, interpolated vertices)
+ALGORITHMS = {
+    "cubes": ("Marching Cubes engine", "output.stl", False),
+    "interp": ("Marching Cubes engine", "output.stl", True),
+    "tetra": ("Marching Tetrahedra engine", "tetrahedra.stl", True),
+}
+
+
+def build_parser(algorithm):
+    """argument parser of the tool of an algorithm ("cubes", "interp" or "tetra")"""
+
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"unknown algorithm {algorithm!r}, expected one of {list(ALGORITHMS)}")
+    engine_help, output, _ = ALGORITHMS[algorithm]
+
+    parser = argparse.ArgumentParser(description="Marching Cubes")
+    parser.add_argument("--input", type=str, help="Path to input images", default="./data/lower")
+    parser.add_argument("--output", type=str, help="Path to output STL file", default=output)
+    if algorithm == "interp":
+        parser.add_argument("--threshold", type=float, nargs="+", help="Threshold(s) for binarization, one output per threshold", default=[100])
+    else:
+        parser.add_argument("--threshold", type=float, help="Threshold for binarization", default=0)
+    parser.add_argument("--gaps", type=float, help="Gaps between images, may be fractional (interpolated slices per image)", default=1)
+    parser.add_argument("--slice-spacing", type=float, help="Distance between images relative to the pixel size, the mesh is scaled instead of interpolating slices (vectorized and stream engines)", default=1.0)
+    parser.add_argument("--cache-dir", type=str, help="Directory of the volume cache, the loaded volume is saved once and memory-mapped by later runs", default=None)
+    parser.add_argument("--engine", type=str, help=engine_help, choices=["vectorized", "loop", "stream", "pipeline"], default="vectorized")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (vectorized engine), or of image decoding threads (pipeline engine)", default=1)
+    parser.add_argument("--brick-size", type=int, help="Brick size of the min/max index used to skip empty space (vectorized engine, 0 to disable)", default=32)
+    parser.add_argument("--backend", type=str, help="Kernel backend of the vectorized and stream engines and of the decimation (numba falls back to numpy if it is not installed)", choices=["numpy", "numba"], default="numpy")
+    if algorithm == "interp":
+        parser.add_argument("--lod", type=int, help="Extract a preview from this level of the downsampled pyramid (1 is 2x coarser, 2 is 4x, ...), the levels are cached with --cache-dir", default=0)
+        parser.add_argument("--adaptive", action="store_true", help="Adaptive extraction, coarse cells where the surface is flat and fine cells where it bends (crack-free)")
+        parser.add_argument("--tolerance", type=float, help="Largest distance in voxels the coarse cells of --adaptive may move the surface", default=0.5)
+    else:
+        parser.set_defaults(lod=0, adaptive=False)
+    parser.add_argument("--target-faces", type=float, help="Decimate the mesh to this number of faces, or to this fraction of the faces if below 1 (e.g. 0.1 for a 10x smaller mesh)", default=None)
+    parser.add_argument("--max-error", type=float, help="Decimate the mesh while the surface moves by at most this distance", default=None)
+    parser.add_argument("--normals", action="store_true", help="Write smooth normals, interpolated from the gradient of the volume, into the STL facets (single process vectorized engine)")
+    parser.add_argument("--bricked", type=str, help="Directory of a bricked copy of the volume (converted once from the images), extracted brick by brick with bounded memory for volumes larger than the memory", default=None)
+    parser.add_argument("--compress", action="store_true", help="Compress the bricks of --bricked with zlib")
+    parser.add_argument("--stats", action="store_true", help="Print the value statistics (max, min, mean, median) of the images while they are loaded (vectorized and loop engines)")
+    parser.add_argument("--profile", action="store_true", help="Print the time of each stage (read, resample, classify, interpolate, write, ...) and the cell and triangle counts")
+    return parser
+
+
+def block_extractor(algorithm, backend):
+    """block extractor of the vectorized, stream, bricked and pipeline engines"""
+
+    if backend != "numpy":
+        # numba is only imported by the numba backend
+        from mc_numba import block_extractor
+        return block_extractor(backend, tetra=algorithm == "tetra")
+    if algorithm == "tetra":
+        from mt_vectorized import extract_tetra_block
+        return extract_tetra_block
+    from mc_vectorized import extract_block
+    return extract_block
+
+
+def check_args(parser, args, thresholds, indexed, decimate):
+    """exits with a parser error if the options of args are not supported together"""
+
+    if args.slice_spacing != 1 and args.engine == "loop":
+        parser.error("--slice-spacing is not supported by the loop engine")
+
+    # the smooth normals are computed from the whole volume and written into the STL records
+    if args.normals and (args.engine != "vectorized" or args.workers > 1 or args.bricked):
+        parser.error("--normals is only supported by the single process vectorized engine (without --bricked)")
+    if args.normals and indexed:
+        parser.error("--normals is only supported by STL output without decimation")
+
+    # the bricked volume is read and extracted one slab of bricks at a time
+    if args.bricked and (args.engine != "vectorized" or args.workers > 1):
+        parser.error("--bricked is only supported by the single process vectorized engine")
+
+    if len(thresholds) > 1 and (args.engine != "vectorized" or args.workers > 1 or args.bricked):
+        parser.error("several thresholds are only supported by the single process vectorized engine (without --bricked)")
+
+    # the LOD and adaptive modes are single threshold, single process vectorized extractions
+    if args.lod and args.adaptive:
+        parser.error("--lod and --adaptive are exclusive")
+    if (args.lod or args.adaptive) and (args.engine != "vectorized" or args.workers > 1 or len(thresholds) > 1
+                                        or args.bricked or args.normals):
+        parser.error("--lod and --adaptive are only supported by the single process, single threshold vectorized engine "
+                     "(without --bricked and --normals)")
+
+    # the pipeline engine writes the chunks itself, as they are extracted
+    if args.engine == "pipeline" and decimate:
+        parser.error("--target-faces and --max-error are not supported by the pipeline engine")
+
+
+def extract_meshes(algorithm, loop_engine, args, thresholds, indexed, extract, spacing, profiler):
+    """chunks of the mesh of each threshold (see save_stl_chunks and save_obj_chunks), the chunks of
+    the stream and bricked engines are extracted while they are written, the pipeline engine writes
+    its output itself and returns no chunks"""
+
+    interpolate = ALGORITHMS[algorithm][2]
+    threshold = thresholds[0]
+
+    if args.engine == "pipeline":
+        # the images are decoded, extracted and written concurrently (see mc_pipeline)
+        from mc_pipeline import run_pipeline
+        run_pipeline(args.input, args.output, threshold=threshold, gaps=args.gaps, indexed=indexed, interpolate=interpolate,
+                     extract=extract, spacing=spacing, workers=args.workers, profiler=profiler)
+        return []
+    if args.engine == "stream":
+        # read two adjacent slices at a time, the whole volume is never loaded
+        from load_voxels import iter_ct_slices
+        from mc_vectorized import marching_cubes_stream
+        return [marching_cubes_stream(iter_ct_slices(args.input, args.gaps, profiler), threshold=threshold, indexed=indexed,
+                                      interpolate=interpolate, spacing=spacing, extract=extract, profiler=profiler)]
+    if args.bricked:
+        # only the bricks straddling the threshold are read
+        from brick_volume import load_ct_bricked, marching_cubes_bricked
+        volume = load_ct_bricked(args.input, args.bricked, args.gaps, compression="zlib" if args.compress else "raw", profiler=profiler)
+        return [marching_cubes_bricked(volume, threshold=threshold, indexed=indexed, interpolate=interpolate, spacing=spacing,
+                                       extract=extract, profiler=profiler)]
+
+    # without gaps, the images are loaded in their native dtype (uint8 or uint16)
+    if args.lod and args.cache_dir:
+        from volume_cache import load_lod_cached
+        pyramid = load_lod_cached(args.input, args.lod, args.gaps, args.cache_dir, args.stats, profiler)
+    elif args.cache_dir:
+        from volume_cache import load_ct_folder_cached
+        example = load_ct_folder_cached(args.input, args.gaps, args.cache_dir, args.stats, profiler)
+    else:
+        from load_voxels import load_ct_volume
+        example = load_ct_volume(args.input, args.gaps, args.stats, profiler)
+    if args.lod and not args.cache_dir:
+        from mc_lod import volume_pyramid
+        with profiler.stage("downsample"):
+            pyramid = volume_pyramid(example, args.lod)
+
+    start_time = time.time()
+    if args.lod:
+        from mc_lod import marching_cubes_lod
+        meshes = [marching_cubes_lod(pyramid, threshold=threshold, level=args.lod, indexed=indexed, spacing=spacing,
+                                     backend=args.backend, profiler=profiler)]
+    elif args.adaptive:
+        from mc_lod import marching_cubes_adaptive
+        meshes = [marching_cubes_adaptive(example, threshold=threshold, tolerance=args.tolerance, indexed=indexed,
+                                          spacing=spacing, profiler=profiler)]
+    elif len(thresholds) > 1:
+        # the volume, the brick index and the brick gathers are shared by all the thresholds
+        from brick_index import BrickIndex
+        from mc_vectorized import marching_cubes_multi
+        with profiler.stage("index"):
+            bricks = BrickIndex(example, args.brick_size or max(example.shape))
+        meshes = marching_cubes_multi(example, thresholds, indexed=indexed, interpolate=interpolate, bricks=bricks,
+                                      spacing=spacing, extract=extract, normals=args.normals, profiler=profiler)
+    elif args.engine == "vectorized" and args.workers > 1:
+        from mc_parallel import marching_cubes_parallel
+        meshes = [marching_cubes_parallel(example, threshold=threshold, workers=args.workers, indexed=indexed,
+                                          interpolate=interpolate, spacing=spacing, extract=extract, profiler=profiler)]
+    elif args.engine == "vectorized":
+        from brick_index import BrickIndex
+        with profiler.stage("index"):
+            bricks = BrickIndex(example, args.brick_size) if args.brick_size > 0 else None
+        if algorithm == "tetra":
+            from mt_vectorized import marching_tetrahedra_vectorized
+            meshes = [marching_tetrahedra_vectorized(example, threshold=threshold, indexed=indexed, bricks=bricks,
+                                                     spacing=spacing, backend=args.backend, normals=args.normals,
+                                                     profiler=profiler)]
+        else:
+            from mc_vectorized import marching_cubes_vectorized
+            meshes = [marching_cubes_vectorized(example, threshold=threshold, indexed=indexed, interpolate=interpolate,
+                                                bricks=bricks, spacing=spacing, backend=args.backend, normals=args.normals,
+                                                profiler=profiler)]
+    else:
+        meshes = [loop_engine(example, threshold=threshold, indexed=indexed, profiler=profiler)]
+    if algorithm == "interp":
+        print(f"Marching Cube took: {time.time() - start_time} seconds")
+
+    # to plot the mesh (suggested for mesh under 64x64x64)
+    # from myplot import plot_mesh
+    # plot_mesh(meshes[0])
+
+    return [[mesh] if indexed else [mesh.vectors] for mesh in meshes]
+
+
+def main(algorithm, loop_engine, argv=None):
+    """runs the tool of an algorithm with the command line arguments argv (sys.argv by default)
+
+    loop_engine is the loop implementation of the algorithm run by --engine loop (e.g.
+    'marching_cubes.marching_cubes_naive')
+    """
+
+    parser = build_parser(algorithm)
+    args = parser.parse_args(argv)
+
+    # the stages are only recorded with --profile
+    profiler = Profiler() if args.profile else NULL_PROFILER
+
+    # voxel size along the (i, j, k) axes of the volume, the images are stacked along k
+    spacing = (1.0, 1.0, args.slice_spacing)
+
+    # an OBJ output keeps the vertices shared between faces, the decimation works on the shared vertices too
+    save_obj = args.output.endswith(".obj")
+    decimate = args.target_faces is not None or args.max_error is not None
+    indexed = save_obj or decimate
+
+    # with several thresholds, the outputs are named <output>_<threshold>.<ext>
+    thresholds = args.threshold if isinstance(args.threshold, list) else [args.threshold]
+    check_args(parser, args, thresholds, indexed, decimate)
+    if len(thresholds) > 1:
+        root, ext = os.path.splitext(args.output)
+        outputs = [f"{root}_{threshold:g}{ext}" for threshold in thresholds]
+    else:
+        outputs = [args.output]
+
+    results = extract_meshes(algorithm, loop_engine, args, thresholds, indexed, block_extractor(algorithm, args.backend),
+                             spacing, profiler)
+
+    # save to stl (suggested for mesh larger than 64x64x64)
+    # (with the stream engine, the chunks are read and extracted while they are written)
+    for output, chunks in zip(outputs, results):
+        # the decimated mesh is written in one chunk
+        if decimate:
+            from mesh_decimation import decimate_chunks
+            vertices, faces = decimate_chunks(chunks, args.target_faces, args.max_error, backend=args.backend, profiler=profiler)
+            chunks = [(vertices, faces)] if save_obj else [vertices[faces]]
+
+        with profiler.stage("write"):
+            if save_obj:
+                from indexed_mesh import save_obj_chunks
+                save_obj_chunks(output, chunks)
+            else:
+                from stl_writer import save_stl_chunks
+                save_stl_chunks(output, chunks)
+        profiler.add_bytes("write", os.path.getsize(output))
+
+    if args.profile:
+        profiler.print_report()
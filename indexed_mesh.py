@@ -0,0 +1,142 @@
+"""
+Shared-vertex (indexed) mesh output.
+
+Instead of a triangle soup, the extractors can return a deduplicated (V, 3) vertex array and
+a (F, 3) face index array. Every vertex lies on an edge of the voxel grid, so each vertex is
+keyed by the global ID of that edge: the same edge crossed by neighboring cells (or by
+neighboring tetrahedra) always has the same ID, and no coordinates are hashed after the fact.
+
+The global ID of the edge going from voxel point p = (i, j, k) to p + d (d in {-1, 0, 1}^3) is
+    ((k * height + i) * width + j) * 27 + code(d)
+where the edge is oriented so that p is its lowest endpoint. The ID does not depend on the
+depth of the volume, so slices can be streamed without knowing how many will follow.
+For a cell whose base voxel is voxel[i][j][k], this is the base key of (i, j, k) plus a
+constant per edge, which is what `edge_key_offsets` precomputes.
+"""
+
+import numpy as np
+
+from mc_lookup_table import VERTEX_OFFSETS, EDGE_VERTICES
+from tetrahedra_lookup_table import TETRA_EDGE_CUBE_VERTICES
+
+
+def key_strides(shape):
+    """strides of (i, j, k) in the global edge ID (only the height and width of the grid are used)"""
+    return np.array([shape[1]*27, 27, shape[0]*shape[1]*27], dtype=np.int64)
+
+
+def edge_key_offsets(shape, start_offsets, end_offsets):
+    """computes for each edge the offset to add to the base key of the cell to get the global edge ID
+
+    shape: shape of the voxel grid
+    start_offsets, end_offsets: (..., 3) voxel offsets of the two endpoints of each edge
+    """
+
+    start_offsets = np.asarray(start_offsets)
+    end_offsets = np.asarray(end_offsets)
+
+    # orient each edge so that it starts at its lowest endpoint
+    strides = key_strides(shape)
+    swap = (start_offsets @ strides > end_offsets @ strides)[..., None]
+    low = np.where(swap, end_offsets, start_offsets)
+    high = np.where(swap, start_offsets, end_offsets)
+
+    # direction of the edge, encoded in base 3
+    delta = high - low + 1
+    code = delta[..., 0]*9 + delta[..., 1]*3 + delta[..., 2]
+
+    return low @ strides + code
+
+
+def cube_edge_key_offsets(shape):
+    """global edge ID offsets of the 12 edges of a cube (Marching Cubes edge layout)"""
+    return edge_key_offsets(shape, VERTEX_OFFSETS[EDGE_VERTICES[:, 0]], VERTEX_OFFSETS[EDGE_VERTICES[:, 1]])
+
+
+def tetra_edge_key_offsets(shape):
+    """global edge ID offsets of the 6 edges of the 6 tetrahedra of a cube, shape (6, 6)"""
+    edge_vertices = TETRA_EDGE_CUBE_VERTICES
+    return edge_key_offsets(shape, VERTEX_OFFSETS[edge_vertices[..., 0]], VERTEX_OFFSETS[edge_vertices[..., 1]])
+
+
+def key_plane(keys, shape):
+    """k index of the lowest endpoint of each global edge ID"""
+    return keys // (shape[0]*shape[1]*27)
+
+
+def deduplicate_keys(keys):
+    """assigns one vertex per unique key (in order of first occurrence)
+
+    returns (index of the first occurrence of each vertex, vertex index of every key)
+    """
+
+    unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    # renumber vertices by first occurrence, so that the output follows the cell order
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    return first[order], rank[inverse.reshape(-1)]
+
+
+class IndexedMeshBuilder:
+    """collects vertices keyed by global edge ID (used by the loop based extractors)"""
+
+    def __init__(self):
+        self.vertex_ids = {}
+        self.vertices = []
+        self.faces = []
+
+    def add_vertex(self, key, xyz):
+        vertex_id = self.vertex_ids.get(key)
+        if vertex_id is None:
+            vertex_id = len(self.vertices)
+            self.vertex_ids[key] = vertex_id
+            self.vertices.append(xyz)
+        return vertex_id
+
+    def add_face(self, vertex_ids):
+        self.faces.append(vertex_ids)
+
+    def build(self):
+        vertices = np.array(self.vertices, dtype=np.float32).reshape(-1, 3)
+        faces = np.array(self.faces, dtype=face_dtype(len(vertices))).reshape(-1, 3)
+        return vertices, faces
+
+
+def face_dtype(n_vertices):
+    return np.int32 if n_vertices < 2**31 else np.int64
+
+
+def indexed_to_mesh(vertices, faces):
+    """expands an indexed mesh back to an stl mesh (triangle soup)"""
+
+    from stl_writer import triangle_buffer, triangles_to_mesh
+
+    triangles = triangle_buffer(len(faces))
+    triangles[:] = vertices[faces]
+    return triangles_to_mesh(triangles)
+
+
+def save_obj(filename, vertices, faces):
+    """saves an indexed mesh as a Wavefront OBJ file (vertices are shared between faces)"""
+    save_obj_chunks(filename, [(vertices, faces)])
+
+
+def save_obj_chunks(filename, chunks):
+    """saves a stream of (new vertices, faces) chunks as a Wavefront OBJ file
+
+    the faces of each chunk may index into the vertices of all the previous chunks (see 'marching_cubes_stream')
+    """
+
+    with open(filename, "w") as f:
+        for vertices, faces in chunks:
+            write_obj_chunk(f, vertices, faces)
+
+
+def write_obj_chunk(f, vertices, faces):
+    """appends the vertices and faces of a chunk to an open OBJ file (see save_obj_chunks)"""
+
+    np.savetxt(f, vertices, fmt="v %.6f %.6f %.6f")
+    np.savetxt(f, faces + 1, fmt="f %d %d %d")
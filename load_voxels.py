@@ -1,42 +1,25 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import cv2
+
+from profiling import NULL_PROFILER
+from synthetic_volumes import sphere, union
 
 def create_sphere_voxels(space_val=-1, object_val=1):
     voxels = space_val*np.ones((40, 40, 40))
-    center = np.array([20, 20, 20])
-    radius = 5
+    i, j, k = np.ogrid[0:40, 0:40, 0:40]
 
-    for i in range(voxels.shape[0]):
-        for j in range(voxels.shape[1]):
-            for k in range(voxels.shape[2]):
-                distance = np.linalg.norm(np.array([i, j, k]) - center)
-                if distance <= radius:
-                    voxels[i, j, k] = object_val
+    voxels[sphere((20, 20, 20), 5)(i, j, k) <= 0] = object_val
 
     return voxels
 
 def create_multiple_objects(space_val=-1, object_val=1):
     space = space_val*np.ones((64, 64, 64))
+    i, j, k = np.ogrid[0:64, 0:64, 0:64]
     
     space[10:20, 10:30, 10:20] = object_val
 
-    center1 = np.array([40, 40, 40])
-    radius1 = 5
-    for i in range(space.shape[0]):
-        for j in range(space.shape[1]):
-            for k in range(space.shape[2]):
-                distance1 = np.linalg.norm(np.array([i, j, k]) - center1)
-                if distance1 <= radius1:
-                    space[i, j, k] = object_val
-    center2 = np.array([50, 50, 20])
-    radius2 = 7
-    for i in range(space.shape[0]):
-        for j in range(space.shape[1]):
-            for k in range(space.shape[2]):
-                distance2 = np.linalg.norm(np.array([i, j, k]) - center2)
-                if distance2 <= radius2:
-                    space[i, j, k] = object_val
+    space[union(sphere((40, 40, 40), 5), sphere((50, 50, 20), 7))(i, j, k) <= 0] = object_val
     return space
 
 def create_dummy_voxels(space_val=-1, object_val=1):
@@ -53,6 +36,9 @@ def load_ct_folder(folder_dir):
 
     height, width, depth = None, None, len(files)
 
+    # cv2 is only imported when images are read
+    import cv2
+
     # read the first file to get the dimensions
     img = cv2.imread(os.path.join(folder_dir, files[0]), cv2.IMREAD_GRAYSCALE)
     height, width = img.shape
@@ -74,35 +60,144 @@ def load_ct_folder(folder_dir):
     
     return numpy_file
 
-def load_ct_folder_gaps(folder_dir, gaps=1):
+def read_ct_image(path):
+    """reads a grayscale image in its native dtype (uint8, or uint16 for 16-bit images)"""
+
+    import cv2
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH)
+    if img is None:
+        raise IOError(f"Could not read image {path}")
+    return img
+
+def print_volume_stats(volume, histogram=None):
+    """prints the value statistics of the volume, computed from the value histogram of an integer volume if given"""
+
+    print(f"Dimensions: {volume.shape}")
+    if histogram is None:
+        print(f"Max value: {volume.max()}")
+        print(f"Min value: {volume.min()}")
+        print(f"Mean value: {volume.mean()}")
+        print(f"Median value: {np.median(volume)}")
+        return
+
+    values = np.flatnonzero(histogram)
+    cumulative = np.cumsum(histogram)
+    n = cumulative[-1]
+    # the median is the mean of the two middle values (same as np.median)
+    middle = np.searchsorted(cumulative, [(n - 1)//2 + 1, n//2 + 1])
+    print(f"Max value: {values[-1]}")
+    print(f"Min value: {values[0]}")
+    print(f"Mean value: {np.dot(np.arange(len(histogram)), histogram)/n}")
+    print(f"Median value: {middle.mean()}")
+
+def load_ct_folder_fast(folder_dir, workers=None, stats=False, profiler=NULL_PROFILER):
+    """loads the images of the folder in their native dtype (same layout as 'load_ct_folder')
+
+    the images are decoded by a pool of threads straight into a preallocated (height, width, depth)
+    uint8 (or uint16) array. If stats is set, the value statistics are printed, computed from
+    a histogram of each image while it is loaded. profiler records the read stage (see 'profiling.py').
+    """
+
     # get all the files in the folder
     files = sorted(os.listdir(folder_dir))
+    paths = [os.path.join(folder_dir, file) for file in files]
 
-    height, width, depth = None, None, len(files) + (len(files) - 1) * gaps
+    # read the first file to get the dimensions and the dtype
+    first = read_ct_image(paths[0])
+    volume = np.empty(first.shape + (len(paths),), dtype=first.dtype)
+    histogram_size = np.iinfo(first.dtype).max + 1 if np.issubdtype(first.dtype, np.integer) else None
 
-    # read the first file to get the dimensions
-    img = cv2.imread(os.path.join(folder_dir, files[0]), cv2.IMREAD_GRAYSCALE)
-    height, width = img.shape
+    def load(i):
+        img = first if i == 0 else read_ct_image(paths[i])
+        if img.shape != first.shape or img.dtype != first.dtype:
+            raise ValueError(f"Image {paths[i]} is {img.dtype} {img.shape}, expected {first.dtype} {first.shape}")
+        volume[:, :, i] = img
+        if stats and histogram_size is not None:
+            return np.bincount(img.reshape(-1), minlength=histogram_size)
 
-    # create the numpy array
-    numpy_file = np.zeros((height, width, depth))
+    with profiler.stage("read"), ThreadPoolExecutor(max_workers=workers) as pool:
+        histograms = list(pool.map(load, range(len(paths))))
+    profiler.count("slices", len(paths))
+    profiler.add_bytes("read", volume.nbytes)
 
-    # read all the files
-    for i, file in enumerate(files):
-        img = cv2.imread(os.path.join(folder_dir, file), cv2.IMREAD_GRAYSCALE)
-        numpy_file[:, :, gaps*i] = img
-    
-    # interpolate the gaps
-    if gaps > 1:
-        for i in range(1, len(files)):
-            for gap in range(1, gaps):
-                numpy_file[:, :, gaps*i + gap] = (numpy_file[:, :, gaps*i] * (gaps - gap) + numpy_file[:, :, gaps*(i+1)] * gap) / gaps
-                
-    print(f"Loaded {len(files)} images from {folder_dir}, filling gaps with {gaps} images")
+    if stats:
+        print(f"Loaded {len(paths)} images from {folder_dir}")
+        print_volume_stats(volume, sum(histograms) if histogram_size is not None else None)
+
+    return volume
+
+def slice_positions(n_images, gaps=1):
+    """positions (in image units) of the slices resampled with gaps slices per image interval (gaps may be fractional)
+
+    returns (index of the image below, index of the image above, weight of the image above) of every slice
+    """
+
+    positions = np.arange(int(np.floor((n_images - 1)*gaps + 1e-9)) + 1)/gaps
+    lower = np.clip(np.floor(positions).astype(int), 0, max(n_images - 2, 0))
+    upper = np.minimum(lower + 1, n_images - 1)
+    return lower, upper, positions - lower
+
+def resample_depth(volume, gaps=1, profiler=NULL_PROFILER):
+    """linearly resamples the third axis of the volume with gaps slices per image interval
+
+    the (height, width, (depth - 1)*gaps + 1) float64 volume is built in one vectorized pass.
+    gaps may be fractional, e.g. the slice thickness divided by the pixel size.
+    """
+
+    with profiler.stage("resample"):
+        lower, upper, weight = slice_positions(volume.shape[2], gaps)
+        resampled = volume[:, :, lower]*(1 - weight) + volume[:, :, upper]*weight
+    profiler.add_bytes("resample", resampled.nbytes)
+    return resampled
+
+def iter_ct_slices(folder_dir, gaps=1, profiler=NULL_PROFILER):
+    """yields the slices of the folder one at a time (same order as the third axis of 'load_ct_folder')
+
+    the slices are resampled lazily like 'resample_depth', so only two images are held at a time
+    """
+
+    # get all the files in the folder
+    files = sorted(os.listdir(folder_dir))
+
+    images = {}
+    for lower, upper, weight in zip(*slice_positions(len(files), gaps)):
+        # keep only the two images around the slice
+        for idx in list(images):
+            if idx < lower:
+                del images[idx]
+        for idx in (lower, upper):
+            if idx not in images:
+                with profiler.stage("read"):
+                    img = read_ct_image(os.path.join(folder_dir, files[idx]))
+                profiler.count("slices")
+                profiler.add_bytes("read", img.nbytes)
+                images[idx] = img.astype(np.float64)
+
+        with profiler.stage("resample"):
+            resampled = images[lower]*(1 - weight) + images[upper]*weight
+        yield resampled
+
+def load_ct_folder_gaps(folder_dir, gaps=1, stats=False, profiler=NULL_PROFILER):
+    """loads the images of the folder and fills the gaps between them with linearly interpolated slices
+
+    gaps is the number of slices per image interval (see 'resample_depth'), if stats is set the value
+    statistics of the images are printed
+    """
+
+    volume = load_ct_folder_fast(folder_dir, stats=stats, profiler=profiler)
+    numpy_file = resample_depth(volume, gaps, profiler)
+
+    print(f"Filled gaps between the {volume.shape[2]} images with {gaps} slices per image")
     print(f"Dimensions: {numpy_file.shape}")
-    print(f"Max value: {numpy_file.max()}")
-    print(f"Min value: {numpy_file.min()}")
-    print(f"Mean value: {numpy_file.mean()}")
-    print(f"Median value: {np.median(numpy_file)}")
 
-    return numpy_file
\ No newline at end of file
+    return numpy_file
+
+def load_ct_volume(folder_dir, gaps=1, stats=False, profiler=NULL_PROFILER):
+    """loads the images of the folder in their native dtype, or resampled (float64) if gaps is not 1
+
+    if stats is set, the value statistics of the images are printed (see 'load_ct_folder_fast')
+    """
+
+    if gaps == 1:
+        return load_ct_folder_fast(folder_dir, stats=stats, profiler=profiler)
+    return load_ct_folder_gaps(folder_dir, gaps, stats, profiler)
@@ -0,0 +1,47 @@
+"""
+Single entry point of the command line tools.
+
+$ python marching.py cubes --input ./data/lower --output lower.stl --threshold 100
+$ python marching.py tetra --input ./data/lower --output lower.obj --engine stream
+$ python marching.py batch jobs.csv --workers 4
+
+The mode selects the tool and the other arguments are passed to it unchanged (see '<mode> --help').
+Only the modules of the chosen tool are imported, and the heavy dependencies only when its options
+need them: cv2 when images are read, numpy-stl when an stl mesh is built, numba with the numba
+backend and matplotlib when a mesh is plotted. The startup time of every mode is measured by
+'benchmark.py --startup'.
+"""
+
+import argparse
+import runpy
+import sys
+
+
+# mode: (module run as __main__, description)
+MODES = {
+    "cubes": ("marching_cubes", "Marching Cubes, vertices at the edge midpoints"),
+    "interp": ("marching_cubes_interp", "Marching Cubes with interpolated vertices, several thresholds, LOD"),
+    "tetra": ("marching_tetrahedra", "Marching Tetrahedra"),
+    "batch": ("batch_runner", "Batch of extraction jobs from a JSON or CSV manifest"),
+    "synthetic": ("synthetic_volumes", "Synthetic test volumes"),
+    "benchmark": ("benchmark", "Benchmark of the extractors and of the startup time"),
+}
+
+
+def run_mode(mode, args):
+    """runs the tool of a mode with the command line arguments args (as if it was run as a script)"""
+
+    module, _ = MODES[mode]
+    sys.argv = [module + ".py"] + list(args)
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Marching Cubes tools", formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="modes:\n" + "\n".join(f"  {mode:<10} {description}" for mode, (_, description) in MODES.items()))
+    parser.add_argument("mode", type=str, help="Tool to run", choices=list(MODES))
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments of the tool (see <mode> --help)")
+    args = parser.parse_args()
+
+    run_mode(args.mode, args.args)
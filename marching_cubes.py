@@ -6,9 +6,11 @@ This is a simple implementation of the algorithm, and it doesn't include interpo
 
 import numpy as np
 
-from stl import mesh
+from stl_writer import triangle_buffer, triangles_to_mesh
 from mc_lookup_table import get_edges, edge_idx_to_unit_square_mapping
-import argparse
+from indexed_mesh import IndexedMeshBuilder, key_strides, cube_edge_key_offsets
+from mc_vectorized import iter_cells, count_cells, marching_cubes_vectorized
+from profiling import NULL_PROFILER
 ############### MARCHING CUBES IMPLEMENTATION ###############
 #        Vertex Layout                  Edge Layout
 #
@@ -51,77 +53,102 @@ import argparse
 def apply_translation(triangle, delta_x, delta_y, delta_z):
     return [(x + delta_x, y + delta_y, z + delta_z) for x, y, z in triangle]
     
-def marching_cubes_naive(voxel, threshold=100):
+def marching_cubes_naive(voxel, threshold=100, indexed=False, active=None, backend="python", profiler=NULL_PROFILER):
+    """returns an stl mesh, or a (vertices, faces) tuple if indexed is set
+
+    active is an optional (cells, cases) result of 'mc_vectorized.active_cells', only those cells are visited.
+    backend is "python" (this loop), "numpy" or "numba" (see 'mc_numba.py'), all give the same mesh.
+    profiler records the extract and assemble stages and the cell counts (see 'profiling.py').
+    """
+
+    if backend != "python":
+        return marching_cubes_vectorized(voxel, threshold, indexed=indexed, interpolate=False, active=active, backend=backend, profiler=profiler)
 
     output_dim = np.array(voxel.shape) - 1      # compute the output dimension
 
     vector_list = []
 
-    # assume i, j, k
-    for i in range(output_dim[0]):
-        for j in range(output_dim[1]):
-            for k in range(output_dim[2]):
-
-                # compute the edge encoding
-                # follow the order of the vertex layout above
-                binary_0 = int(voxel[i+1][j][k] > threshold)
-                binary_1 = int(voxel[i+1][j+1][k] >  threshold)
-                binary_2 = int(voxel[i][j][k] >  threshold)
-                binary_3 = int(voxel[i][j+1][k] >  threshold)
-                binary_4 = int(voxel[i+1][j][k+1] >  threshold)
-                binary_5 = int(voxel[i+1][j+1][k+1] >  threshold)
-                binary_6 = int(voxel[i][j][k+1] >  threshold)
-                binary_7 = int(voxel[i][j+1][k+1] >  threshold)
-
-                bit_encoding = [binary_7, binary_6, binary_5, binary_4, binary_3, binary_2, binary_1, binary_0]
-                # convert to number
-                lookup_idx = np.packbits(bit_encoding)[0]
-                edges = get_edges(lookup_idx)
-
-                if len(edges) == 0:
-                    continue    # no triangles to build
-                
-                # build triangles from edges
-
-                # convert edge index to unit square mapping
-                unit_square_coordinates = [[edge_idx_to_unit_square_mapping(e) for e in e_list] for e_list in edges]
-
-                # apply translation
-                delta_x = j
-                delta_y = output_dim[0] - i
-                delta_z = -k
-                translated_coordinates = [apply_translation(triangle, delta_x, delta_y, delta_z) for triangle in unit_square_coordinates]
-
-                # add to vector list
-                vector_list.extend(translated_coordinates)
-
-    final_mesh = mesh.Mesh(np.zeros(len(vector_list), dtype=mesh.Mesh.dtype))
-    for triangle_i, triangle in enumerate(vector_list):
-        final_mesh.vectors[triangle_i][:] = np.array(triangle)
+    if indexed:
+        builder = IndexedMeshBuilder()
+        key_offsets = cube_edge_key_offsets(voxel.shape).tolist()
+        stride_i, stride_j, stride_k = key_strides(voxel.shape).tolist()
+
+    n_empty = 0
+    with profiler.stage("extract"):
+        # assume i, j, k
+        for i, j, k in iter_cells(output_dim, active):
+
+            # compute the edge encoding
+            # follow the order of the vertex layout above
+            binary_0 = int(voxel[i+1][j][k] > threshold)
+            binary_1 = int(voxel[i+1][j+1][k] >  threshold)
+            binary_2 = int(voxel[i][j][k] >  threshold)
+            binary_3 = int(voxel[i][j+1][k] >  threshold)
+            binary_4 = int(voxel[i+1][j][k+1] >  threshold)
+            binary_5 = int(voxel[i+1][j+1][k+1] >  threshold)
+            binary_6 = int(voxel[i][j][k+1] >  threshold)
+            binary_7 = int(voxel[i][j+1][k+1] >  threshold)
+
+            bit_encoding = [binary_7, binary_6, binary_5, binary_4, binary_3, binary_2, binary_1, binary_0]
+            # convert to number
+            lookup_idx = np.packbits(bit_encoding)[0]
+            edges = get_edges(lookup_idx)
+
+            if len(edges) == 0:
+                n_empty += 1
+                continue    # no triangles to build
+        
+            # build triangles from edges
+
+            # convert edge index to unit square mapping
+            unit_square_coordinates = [[edge_idx_to_unit_square_mapping(e) for e in e_list] for e_list in edges]
+
+            # apply translation
+            delta_x = j
+            delta_y = output_dim[0] - i
+            delta_z = -k
+            translated_coordinates = [apply_translation(triangle, delta_x, delta_y, delta_z) for triangle in unit_square_coordinates]
+
+            if indexed:
+                # key the vertices by global edge ID (base key of voxel[i][j][k] + edge offset)
+                base_key = i*stride_i + j*stride_j + k*stride_k
+                for triangle_edges, triangle in zip(edges, translated_coordinates):
+                    builder.add_face([builder.add_vertex(base_key + key_offsets[e], xyz) for e, xyz in zip(triangle_edges, triangle)])
+                continue
+
+            # add to vector list
+            vector_list.extend(translated_coordinates)
+
+    n_cells = np.prod(output_dim) if active is None else len(active[0])
+    count_cells(profiler, n_cells, n_cells - n_empty)
+
+    if indexed:
+        vertices, faces = builder.build()
+        profiler.count("triangles", len(faces))
+        return vertices, faces
+
+    profiler.count("triangles", len(vector_list))
+    with profiler.stage("assemble"):
+        # the triangles are converted in one call, straight into the vectors of the mesh records
+        triangles = triangle_buffer(len(vector_list))
+        triangles[:] = np.reshape(vector_list, (-1, 3, 3))
+        final_mesh = triangles_to_mesh(triangles)
 
     return final_mesh
 
 
 if __name__ == "__main__":
 
-    from myplot import plot_mesh
-    from load_voxels import *
-    parser = argparse.ArgumentParser(description="Marching Cubes")
-    parser.add_argument("--input", type=str, help="Path to input images", default="./data/lower")
-    parser.add_argument("--output", type=str, help="Path to output STL file", default="output.stl")
-    parser.add_argument("--threshold", type=float, help="Threshold for binarization", default=0)
-    parser.add_argument("--gaps", type=int, help="Gaps between images", default=1)
-    args = parser.parse_args()
-
-    example = load_ct_folder_gaps(args.input, args.gaps)
-    cubes = marching_cubes_naive(example, args.threshold)
-    cubes.save(args.output)
+    from cli import main
+    main("cubes", marching_cubes_naive)
+
     # example = create_multiple_objects()
     # example = load_ct_folder("./lower")
     # cubes = marching_cubes_naive(example)
 
     # # to plot the mesh (suggested for mesh under 64x64x64)
+    # from myplot import plot_mesh
     # # plot_mesh(cubes)
 
     # # # save to stl (suggested for mesh larger than 64x64x64)
-    # cubes.save('cube.stl')
\ No newline at end of file
+    # cubes.save('cube.stl')
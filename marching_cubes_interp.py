@@ -9,9 +9,11 @@ edge crosses the surface (0 value) is calculated by linear interpolation.
 """
 
 import numpy as np
-import argparse
-from stl import mesh
+from stl_writer import triangle_buffer, triangles_to_mesh
 from mc_lookup_table import get_edges, edge_to_vertex, edge_idx_to_unit_square_mapping
+from indexed_mesh import IndexedMeshBuilder, key_strides, cube_edge_key_offsets
+from mc_vectorized import iter_cells, count_cells, marching_cubes_vectorized
+from profiling import NULL_PROFILER
 
 
 def compute_unit_vertices(edge_set, neighbors, threshold):
@@ -50,48 +52,81 @@ def compute_unit_vertices(edge_set, neighbors, threshold):
 def apply_translation(triangle, delta_x, delta_y, delta_z):
     return [(x + delta_x, y + delta_y, z + delta_z) for x, y, z in triangle]
 
-def marching_cubes_iterpolation(voxel, threshold=0.0):
+def marching_cubes_iterpolation(voxel, threshold=0.0, indexed=False, active=None, backend="python", profiler=NULL_PROFILER):
+    """returns an stl mesh, or a (vertices, faces) tuple if indexed is set
 
-    output_dim = np.array(voxel.shape) - 1      # compute the output dimension
-
-    vector_list = []
+    active is an optional (cells, cases) result of 'mc_vectorized.active_cells', only those cells are visited.
+    backend is "python" (this loop), "numpy" or "numba" (see 'mc_numba.py'), all give the same mesh.
+    profiler records the extract and assemble stages and the cell counts (see 'profiling.py').
+    """
 
-    # assume i, j, k
-    for i in range(output_dim[0]):
-        for j in range(output_dim[1]):
-            for k in range(output_dim[2]):
+    if backend != "python":
+        return marching_cubes_vectorized(voxel, threshold, indexed=indexed, active=active, backend=backend, profiler=profiler)
 
-                # compute the edge encoding
-
-                # follow ordering from 0 to 7 of the vertex layout
-                neighbors = np.array([voxel[i+1][j][k], voxel[i+1][j+1][k], voxel[i][j][k], voxel[i][j+1][k],
-                                voxel[i+1][j][k+1], voxel[i+1][j+1][k+1], voxel[i][j][k+1], voxel[i][j+1][k+1]])
-                
-                # get the binary encoding (need to reverse so order is from 7 -> 0)
-                bit_encoding = (neighbors > threshold).astype(int)[::-1]
-
-                # convert to base 10 number
-                lookup_idx = np.packbits(bit_encoding)[0]
-                edges = get_edges(lookup_idx)
+    output_dim = np.array(voxel.shape) - 1      # compute the output dimension
 
-                if len(edges) == 0:
-                    continue    # no triangles to build
+    vector_list = []
 
-                # compute unit vertices
-                unit_square_coordinates = compute_unit_vertices(edges, neighbors, threshold)
+    if indexed:
+        builder = IndexedMeshBuilder()
+        key_offsets = cube_edge_key_offsets(voxel.shape).tolist()
+        stride_i, stride_j, stride_k = key_strides(voxel.shape).tolist()
 
-                # apply translation
-                delta_x = j
-                delta_y = output_dim[0] - i - 1
-                delta_z = -k
-                translated_coordinates = [apply_translation(triangle, delta_x, delta_y, delta_z) for triangle in unit_square_coordinates]
+    n_empty = 0
+    with profiler.stage("extract"):
+        # assume i, j, k
+        for i, j, k in iter_cells(output_dim, active):
 
-                # add to vector list
-                vector_list.extend(translated_coordinates)
+            # compute the edge encoding
 
-    final_mesh = mesh.Mesh(np.zeros(len(vector_list), dtype=mesh.Mesh.dtype))
-    for triangle_i, triangle in enumerate(vector_list):
-        final_mesh.vectors[triangle_i][:] = np.array(triangle)
+            # follow ordering from 0 to 7 of the vertex layout
+            neighbors = np.array([voxel[i+1][j][k], voxel[i+1][j+1][k], voxel[i][j][k], voxel[i][j+1][k],
+                            voxel[i+1][j][k+1], voxel[i+1][j+1][k+1], voxel[i][j][k+1], voxel[i][j+1][k+1]], dtype=np.float64)
+        
+            # get the binary encoding (need to reverse so order is from 7 -> 0)
+            bit_encoding = (neighbors > threshold).astype(int)[::-1]
+
+            # convert to base 10 number
+            lookup_idx = np.packbits(bit_encoding)[0]
+            edges = get_edges(lookup_idx)
+
+            if len(edges) == 0:
+                n_empty += 1
+                continue    # no triangles to build
+
+            # compute unit vertices
+            unit_square_coordinates = compute_unit_vertices(edges, neighbors, threshold)
+
+            # apply translation
+            delta_x = j
+            delta_y = output_dim[0] - i - 1
+            delta_z = -k
+            translated_coordinates = [apply_translation(triangle, delta_x, delta_y, delta_z) for triangle in unit_square_coordinates]
+
+            if indexed:
+                # key the vertices by global edge ID (base key of voxel[i][j][k] + edge offset)
+                base_key = i*stride_i + j*stride_j + k*stride_k
+                for triangle_edges, triangle in zip(edges, translated_coordinates):
+                    builder.add_face([builder.add_vertex(base_key + key_offsets[e], xyz) for e, xyz in zip(triangle_edges, triangle)])
+                continue
+
+            # add to vector list
+            vector_list.extend(translated_coordinates)
+
+    n_cells = np.prod(output_dim) if active is None else len(active[0])
+    count_cells(profiler, n_cells, n_cells - n_empty)
+
+    if indexed:
+        vertices, faces = builder.build()
+        profiler.count("triangles", len(faces))
+        return vertices, faces
+
+    profiler.count("triangles", len(vector_list))
+    with profiler.stage("assemble"):
+        # the triangles are converted in one call, straight into the vectors of the mesh records
+        triangles = triangle_buffer(len(vector_list))
+        triangles[:] = np.reshape(vector_list, (-1, 3, 3))
+        final_mesh = triangles_to_mesh(triangles)
 
     # # let's translate the mesh to the origin
     # center_of_mass = final_mesh.get_mass_properties()[1]
@@ -103,28 +138,8 @@ def marching_cubes_iterpolation(voxel, threshold=0.0):
 
 if __name__ == "__main__":
 
-    from myplot import plot_mesh
-    from load_voxels import *
-    import time
-
     # example = create_sphere_voxels(space_val=-1, object_val=5)
-    parser = argparse.ArgumentParser(description="Marching Cubes")
-    parser.add_argument("--input", type=str, help="Path to input images", default="./data/lower")
-    parser.add_argument("--output", type=str, help="Path to output STL file", default="output.stl")
-    parser.add_argument("--threshold", type=float, help="Threshold for binarization", default=100)
-    parser.add_argument("--gaps", type=int, help="Gaps between images", default=1)
-    args = parser.parse_args()
-    # example = load_ct_folder(args.input)
     # example = np.ones((3, 3, 3))*-1
     # example[1, 1, 1] = 1
-    example = load_ct_folder_gaps(args.input, args.gaps)
-    start_time = time.time()
-    cubes = marching_cubes_iterpolation(example, threshold=args.threshold)
-    print(f"Marching Cube took: {time.time() - start_time} seconds")
-
-    # to plot the mesh (suggested for mesh under 64x64x64)
-    # plot_mesh(cubes)
-
-    # save to stl (suggested for mesh larger than 64x64x64)
-    cubes.save(args.output)
-
+    from cli import main
+    main("interp", marching_cubes_iterpolation)
@@ -4,30 +4,27 @@ This is an implementation of the Marching Tetrahedra algorithm with interpolatio
 
 import numpy as np
 
-from stl import mesh
+from stl_writer import triangle_buffer, triangles_to_mesh
 from tetrahedra_lookup_table import edge_to_vertex, \
-    edge_idx_to_unit_tetrahedra_mapping, binary_to_base10, get_edge
-import argparse
+    edge_idx_to_unit_tetrahedra_mapping, binary_to_base10, get_edge, CUBE_TETRA_VERTICES
+from indexed_mesh import IndexedMeshBuilder, key_strides, tetra_edge_key_offsets
+from mc_vectorized import iter_cells, count_cells
+from profiling import NULL_PROFILER
+from mt_vectorized import marching_tetrahedra_vectorized
+
 def inverse_linear_interpolation(threshold, v1, v2):
     return (threshold - v1)/(v2 - v1)
 
-def process_cubic_voxel(voxel, threshold):
-    """process the 2x2x2 (cubic) voxel"""
+def process_cubic_voxel(voxel, threshold, face_edges=None):
+    """process the 2x2x2 (cubic) voxel
 
-    # each cubic voxel consists of 6 tetrahedrons
-    cube_tetra_vertices = [
-        [0, 2, 3, 7],
-        [0, 1, 3, 7],
-        [0, 1, 5, 7],
-        [0, 2, 6, 7],
-        [0, 4, 6, 7],
-        [0, 4, 5, 7]
-    ]
+    if face_edges is a list, the (tetra_idx, edge_idx) of every triangle corner is appended to it
+    """
 
     # process each tetrahedra
     face_coordinates = []
 
-    for tetra_i, t_vertices in enumerate(cube_tetra_vertices):
+    for tetra_i, t_vertices in enumerate(CUBE_TETRA_VERTICES):
 
         # get values of tetrahedra
         tetra_values = voxel[t_vertices]
@@ -66,65 +63,95 @@ def process_cubic_voxel(voxel, threshold):
                 edge_coordinates = edge_idx_to_unit_tetrahedra_mapping(edge, tetra_i, alpha=alpha)
                 triangle_coordinates.append(edge_coordinates)
             face_coordinates.append(triangle_coordinates)
+            if face_edges is not None:
+                face_edges.append([(tetra_i, edge) for edge in edge_set])
         
     return face_coordinates
 
 def apply_translation(triangle, delta_x, delta_y, delta_z):
     return [(x + delta_x, y + delta_y, z + delta_z) for x, y, z in triangle]
 
-def marching_tetrahedra(voxel, threshold=0.0):
+def marching_tetrahedra(voxel, threshold=0.0, indexed=False, active=None, backend="python", profiler=NULL_PROFILER):
+    """returns an stl mesh, or a (vertices, faces) tuple if indexed is set
+
+    active is an optional (cells, cases) result of 'mc_vectorized.active_cells', only those cells are visited.
+    backend is "python" (this loop), "numpy" or "numba" (see 'mc_numba.py'), all give the same mesh.
+    profiler records the extract and assemble stages and the cell counts (see 'profiling.py').
+    """
+
+    if backend != "python":
+        return marching_tetrahedra_vectorized(voxel, threshold, indexed=indexed, active=active, backend=backend, profiler=profiler)
 
     output_dim = np.array(voxel.shape) - 1      # compute the output dimension
 
     vector_list = []
 
-    # iterate through the voxel grid
-    for i in range(output_dim[0]):
-        for j in range(output_dim[1]):
-            for k in range(output_dim[2]):
-
-                # follow ordering from 0 to 7 of the vertex layout (use same as Marching Cubes)
-                neighbors = np.array([voxel[i+1][j][k], voxel[i+1][j+1][k], voxel[i][j][k], voxel[i][j+1][k],
-                                voxel[i+1][j][k+1], voxel[i+1][j+1][k+1], voxel[i][j][k+1], voxel[i][j+1][k+1]])
-                
-                # process each cubic voxel
-                unit_tetra_coordinates = process_cubic_voxel(neighbors, threshold)
-
-                # translate
-                delta_x = j
-                delta_y = k
-                delta_z = output_dim[0] - i - 1
-                translated_coordinates = [apply_translation(triangle, delta_x, delta_y, delta_z) for triangle in unit_tetra_coordinates]
-
-                # add to vector list
-                vector_list.extend(translated_coordinates)
-
-                # final_mesh = mesh.Mesh(np.zeros(len(vector_list), dtype=mesh.Mesh.dtype))
-                # for triangle_i, triangle in enumerate(vector_list):
-                #     final_mesh.vectors[triangle_i][:] = np.array(triangle)
-
-                # print(i, j, k)
-                # print(translated_coordinates)
-                # plot_mesh(final_mesh)
-    
-    final_mesh = mesh.Mesh(np.zeros(len(vector_list), dtype=mesh.Mesh.dtype))
-    for triangle_i, triangle in enumerate(vector_list):
-        final_mesh.vectors[triangle_i][:] = np.array(triangle)
+    if indexed:
+        builder = IndexedMeshBuilder()
+        key_offsets = tetra_edge_key_offsets(voxel.shape).tolist()
+        stride_i, stride_j, stride_k = key_strides(voxel.shape).tolist()
+        face_edges = []
+    else:
+        face_edges = None
+
+    n_empty = 0
+    with profiler.stage("extract"):
+        # iterate through the voxel grid
+        for i, j, k in iter_cells(output_dim, active):
+
+            # follow ordering from 0 to 7 of the vertex layout (use same as Marching Cubes)
+            neighbors = np.array([voxel[i+1][j][k], voxel[i+1][j+1][k], voxel[i][j][k], voxel[i][j+1][k],
+                            voxel[i+1][j][k+1], voxel[i+1][j+1][k+1], voxel[i][j][k+1], voxel[i][j+1][k+1]], dtype=np.float64)
+        
+            # process each cubic voxel
+            unit_tetra_coordinates = process_cubic_voxel(neighbors, threshold, face_edges)
+            if not unit_tetra_coordinates:
+                n_empty += 1
+
+            # translate
+            delta_x = j
+            delta_y = k
+            delta_z = output_dim[0] - i - 1
+            translated_coordinates = [apply_translation(triangle, delta_x, delta_y, delta_z) for triangle in unit_tetra_coordinates]
+
+            if indexed:
+                # key the vertices by global edge ID (base key of voxel[i][j][k] + edge offset)
+                base_key = i*stride_i + j*stride_j + k*stride_k
+                for triangle_edges, triangle in zip(face_edges, translated_coordinates):
+                    builder.add_face([builder.add_vertex(base_key + key_offsets[t][e], xyz) for (t, e), xyz in zip(triangle_edges, triangle)])
+                face_edges.clear()
+                continue
+
+            # add to vector list
+            vector_list.extend(translated_coordinates)
+
+            # final_mesh = mesh.Mesh(np.zeros(len(vector_list), dtype=mesh.Mesh.dtype))
+            # for triangle_i, triangle in enumerate(vector_list):
+            #     final_mesh.vectors[triangle_i][:] = np.array(triangle)
+
+            # print(i, j, k)
+            # print(translated_coordinates)
+            # plot_mesh(final_mesh)
+
+    n_cells = np.prod(output_dim) if active is None else len(active[0])
+    count_cells(profiler, n_cells, n_cells - n_empty)
+
+    if indexed:
+        vertices, faces = builder.build()
+        profiler.count("triangles", len(faces))
+        return vertices, faces
+
+    profiler.count("triangles", len(vector_list))
+    with profiler.stage("assemble"):
+        # the triangles are converted in one call, straight into the vectors of the mesh records
+        triangles = triangle_buffer(len(vector_list))
+        triangles[:] = np.reshape(vector_list, (-1, 3, 3))
+        final_mesh = triangles_to_mesh(triangles)
 
     return final_mesh
 
 if __name__ == "__main__":
 
-    from myplot import plot_mesh
-    from load_voxels import *
-    import time
-    parser = argparse.ArgumentParser(description="Marching Cubes")
-    parser.add_argument("--input", type=str, help="Path to input images", default="./data/lower")
-    parser.add_argument("--output", type=str, help="Path to output STL file", default="tetrahedra.stl")
-    parser.add_argument("--threshold", type=float, help="Threshold for binarization", default=0)
-    parser.add_argument("--gaps", type=int, help="Gaps between images", default=1)
-    args = parser.parse_args()
-    
     # create a simple 2x2x2 voxel grid
     # example = np.ones((2, 2, 2))*-1
     # example[0, 0 ,0] = 1    # ok
@@ -138,18 +165,5 @@ if __name__ == "__main__":
 
     # print(example)
     # example = create_sphere_voxels()
-
-    # example = np.ones((3, 3, 3))*-1
-    # example[1, 1, 1] = 1
-
-    # example = create_multiple_objects()
-    # example = load_ct_folder(args.input)
-    example = load_ct_folder_gaps(args.input, gaps=args.gaps)
-    
-    tetra_mesh = marching_tetrahedra(example, threshold=args.threshold)
-
-    # to plot the mesh (suggested for mesh under 64x64x64)
-    # plot_mesh(tetra_mesh)
-
-    tetra_mesh.save(args.output)
-
+    from cli import main
+    main("tetra", marching_tetrahedra)
@@ -0,0 +1,309 @@
+"""
+Level-of-detail extraction for previews.
+
+Pyramid: 'volume_pyramid' builds the downsampled levels of a volume once (2x, 4x, 8x, ...).
+Level l + 1 keeps every second sample of level l along each axis, filtered with [1, 2, 1]/4,
+so sample i of level l lies on voxel 2^l * i of the volume. 'marching_cubes_lod' extracts a
+level with the vectorized engine and places the mesh in the coordinates of the full resolution
+mesh, so the levels can be swapped in a viewer. The levels can also be cached on disk next to
+the volume (see 'volume_cache.load_lod_cached').
+
+Adaptive: 'marching_cubes_adaptive' uses coarse cells where the surface is flat and fine cells
+where it bends. The grid is split into bricks of 2^max_level cells (see 'brick_index.py'), and
+each brick crossed by the surface is given the coarsest level l (cells of 2^l voxels, with the
+corners sampled from the volume) whose trilinear approximation of the brick moves the surface by at
+most tolerance voxels. Neighboring bricks differ by at most one level.
+
+Coarse and fine cells do not share their edges, so the triangles of Marching Cubes would leave
+cracks at the level transitions. The adaptive mode is instead extracted with the dual method
+used on octrees by Dual Contouring (Surface Nets vertex placement): every leaf cell crossed by
+the surface gets one vertex, at the mean of the crossing points of its crossed edges, and every
+crossed minimal edge (an edge of the smallest cells around it) emits a quad joining the vertices
+of the (up to 4) cells around it. A quad around a transition edge joins cells of different sizes
+(two of its corners may be the same coarse cell, then it is a triangle), so the mesh has no
+cracks by construction.
+"""
+
+import numpy as np
+
+from brick_index import BrickIndex
+from mc_vectorized import marching_cubes_vectorized, gather_bricks
+from indexed_mesh import indexed_to_mesh, face_dtype
+from profiling import NULL_PROFILER
+
+
+def downsample(volume):
+    """halves the resolution of the volume, keeps samples 2i (filtered with [1, 2, 1]/4), returns float32"""
+
+    for axis in range(3):
+        volume = np.moveaxis(volume, axis, 0)
+        n = volume.shape[0]
+        center = np.arange(0, n, 2)
+        lower = np.maximum(center - 1, 0)
+        upper = np.minimum(center + 1, n - 1)
+        volume = (volume[lower].astype(np.float32) + 2*volume[center] + volume[upper])*0.25
+        volume = np.moveaxis(volume, 0, axis)
+
+    return np.ascontiguousarray(volume)
+
+
+def volume_pyramid(volume, levels=3):
+    """returns [volume, volume/2, volume/4, ...] (levels + 1 volumes)"""
+
+    pyramid = [volume]
+    for _ in range(levels):
+        pyramid.append(downsample(pyramid[-1]))
+    return pyramid
+
+
+def lod_offset(full_shape, level_shape, level, interpolate=True, spacing=(1.0, 1.0, 1.0)):
+    """y offset that moves the mesh of a pyramid level onto the full resolution mesh
+
+    the vertical axis is flipped (y = height - 1 - i with interpolation, height - i without),
+    which depends on the height of the level
+    """
+
+    flip = 1 if interpolate else 0
+    return ((full_shape[0] - flip) - 2**level*(level_shape[0] - flip))*spacing[0]
+
+
+def marching_cubes_lod(pyramid, threshold=0.0, level=1, indexed=False, interpolate=True, spacing=(1.0, 1.0, 1.0),
+                       bricks=None, backend="numpy", profiler=NULL_PROFILER):
+    """extracts the isosurface of pyramid[level] (see 'volume_pyramid') in the coordinates of pyramid[0]
+
+    returns an stl mesh, or a (vertices, faces) tuple if indexed is set. bricks is an optional
+    brick index of pyramid[level].
+    """
+
+    volume = pyramid[level]
+    level_spacing = tuple(2**level*s for s in spacing)
+    offset = lod_offset(pyramid[0].shape, volume.shape, level, interpolate, spacing)
+
+    result = marching_cubes_vectorized(volume, threshold, indexed=indexed, interpolate=interpolate, bricks=bricks,
+                                       spacing=level_spacing, backend=backend, profiler=profiler)
+    if indexed:
+        vertices, faces = result
+        vertices[:, 1] += offset
+        return vertices, faces
+
+    result.vectors[:, :, 1] += offset
+    return result
+
+
+def _upsample(coarse, s):
+    """trilinear upsampling by s of gathered (bricks, n, n, n) samples"""
+
+    n = coarse.shape[1]
+    x = np.arange((n - 1)*s + 1)
+    lower = np.minimum(x // s, n - 2)
+    weight = ((x - lower*s)/s).astype(np.float32)
+
+    for axis in (1, 2, 3):
+        shape = [1, 1, 1, 1]
+        shape[axis] = -1
+        w = weight.reshape(shape)
+        coarse = np.take(coarse, lower, axis)*(1 - w) + np.take(coarse, lower + 1, axis)*w
+    return coarse
+
+
+def _max_aligned_level(brick_origins, size, grid_shape):
+    """coarsest level whose cells fit the brick (the bricks at the end of the grid may be shorter)"""
+
+    extent = np.minimum(size, np.array(grid_shape) - 1 - brick_origins)
+    # number of trailing zero bits of the extent along each axis
+    return np.log2(extent & -extent).astype(np.int8).min(axis=1)
+
+
+def brick_levels(brick_origins, brick_voxels, threshold, grid_shape, tolerance=0.5, max_level=3):
+    """coarsest level of each gathered brick (see 'mc_vectorized.gather_bricks') that approximates it well enough
+
+    The error of a level is the largest difference between the voxels around the surface and the
+    trilinear interpolation of the level samples, divided by the mean gradient magnitude of the
+    brick around the surface (an estimate of how far the surface moves, in voxels). The mean
+    rather than the local gradient keeps the noise of scans from rejecting every coarse level.
+    """
+
+    size = brick_voxels.shape[1] - 1
+    values = brick_voxels.astype(np.float32)
+
+    gradient = np.sqrt(sum(g**2 for g in np.gradient(values, axis=(1, 2, 3))))
+    near = np.abs(values - threshold) <= 2*gradient
+    mean_gradient = (gradient*near).sum(axis=(1, 2, 3))/np.maximum(near.sum(axis=(1, 2, 3)), 1)
+    scale = 1/np.maximum(mean_gradient, 1e-12)
+
+    max_aligned = _max_aligned_level(brick_origins, size, grid_shape)
+    levels = np.zeros(len(values), dtype=np.int8)
+    for level in range(1, max_level + 1):
+        s = 2**level
+        deviation = np.abs(values - _upsample(values[:, ::s, ::s, ::s], s))
+        error = np.where(near, deviation, 0).max(axis=(1, 2, 3), initial=0)*scale
+        levels[(error <= tolerance) & (level <= max_aligned)] = level
+
+    return levels
+
+
+def balance_levels(levels):
+    """lowers the levels of the brick grid until face neighbors differ by at most one level"""
+
+    levels = levels.copy()
+    while True:
+        limit = levels.copy()
+        for axis in range(3):
+            lim, lev = np.moveaxis(limit, axis, 0), np.moveaxis(levels, axis, 0)
+            np.minimum(lim[1:], lev[:-1] + 1, out=lim[1:])
+            np.minimum(lim[:-1], lev[1:] + 1, out=lim[:-1])
+        if (limit == levels).all():
+            return levels
+        levels = limit
+
+
+def _minimal_edges(brick_origins, brick_voxels, brick_level, level_grid, threshold, grid_shape, size):
+    """crossed edges of the leaf cells that are not split by a smaller neighboring cell
+
+    returns (start voxel, axis, length, start value, end value) of every edge
+    """
+
+    grid_shape = np.array(grid_shape)
+    edges = [(np.empty((0, 3), dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+              np.empty(0, dtype=np.float32), np.empty(0, dtype=np.float32))]
+    for level in np.unique(brick_level):
+        s = 2**int(level)
+        selected = brick_level == level
+        origins = brick_origins[selected]
+        samples = brick_voxels[selected][:, ::s, ::s, ::s]
+        inside = samples > threshold
+
+        for axis in range(3):
+            # edges along axis whose endpoints are on both sides of the threshold
+            head = [slice(None)]*4
+            tail = [slice(None)]*4
+            head[axis + 1] = slice(None, -1)
+            tail[axis + 1] = slice(1, None)
+            brick, li, lj, lk = np.nonzero(inside[tuple(head)] != inside[tuple(tail)])
+            local = np.stack([li, lj, lk], axis=1)
+            start = origins[brick] + s*local
+            end_local = local.copy()
+            end_local[:, axis] += 1
+
+            # the padding of the bricks at the end of the grid repeats the last voxels
+            in_grid = (start < grid_shape).all(axis=1) & (start[:, axis] + s < grid_shape[axis])
+
+            # the edge is minimal if no brick around it has smaller cells
+            minimal = np.ones(len(start), dtype=bool)
+            u, w = (axis + 1) % 3, (axis + 2) % 3
+            brick_ijk = start // size
+            for du in (0, -1):
+                for dw in (0, -1):
+                    around = brick_ijk.copy()
+                    around[:, u] += du
+                    around[:, w] += dw
+                    exists = (around >= 0).all(axis=1) & (around < level_grid.shape).all(axis=1)
+                    # the bricks before the edge only touch it if it lies on their face
+                    exists &= ((du == 0) | (start[:, u] % size == 0)) & ((dw == 0) | (start[:, w] % size == 0))
+                    around_level = level_grid[tuple(np.where(exists[:, None], around, 0).T)]
+                    minimal &= ~exists | (around_level >= level)
+
+            keep = in_grid & minimal
+            brick_voxel_idx = np.flatnonzero(selected)[brick[keep]]
+            start_val = brick_voxels[(brick_voxel_idx, *(s*local[keep]).T)]
+            end_val = brick_voxels[(brick_voxel_idx, *(s*end_local[keep]).T)]
+            edges.append((start[keep], np.full(keep.sum(), axis), np.full(keep.sum(), s), start_val, end_val))
+
+    start, axis, length, start_val, end_val = (np.concatenate(parts) for parts in zip(*edges))
+
+    # an edge on the face of two bricks of the same level is found by both
+    keys = np.ravel_multi_index(tuple(start.T), tuple(grid_shape))*3 + axis
+    _, first = np.unique(keys, return_index=True)
+    return start[first], axis[first], length[first], start_val[first], end_val[first]
+
+
+def marching_cubes_adaptive(voxel, threshold=0.0, tolerance=0.5, max_level=3, indexed=False, interpolate=True,
+                            spacing=(1.0, 1.0, 1.0), bricks=None, profiler=NULL_PROFILER):
+    """octree adaptive dual extraction (see the module docstring), crack-free across the level transitions
+
+    tolerance is the largest distance in voxels the coarse cells may move the surface (0 gives
+    fine cells everywhere). bricks is an optional brick index of the volume with bricks of
+    2^max_level cells. Returns an stl mesh, or a (vertices, faces) tuple if indexed is set.
+    """
+
+    size = 2**max_level
+    grid_shape = np.array(voxel.shape)
+    if bricks is None:
+        with profiler.stage("index"):
+            bricks = BrickIndex(voxel, size)
+    if bricks.shape != voxel.shape or bricks.brick_size != size:
+        raise ValueError(f"brick index of shape {bricks.shape} and brick size {bricks.brick_size} does not match the "
+                         f"voxel grid {voxel.shape} and brick size {size}")
+
+    with profiler.stage("levels"):
+        active = bricks.active_bricks(threshold)
+        brick_origins, brick_voxels = gather_bricks(voxel, bricks, active)
+        brick_voxels = brick_voxels.astype(np.float32)
+        levels = brick_levels(brick_origins, brick_voxels, threshold, voxel.shape, tolerance, max_level)
+
+        # the bricks without surface do not constrain their neighbors
+        level_grid = np.full(active.shape, max_level, dtype=np.int8)
+        level_grid[active] = levels
+        level_grid = balance_levels(level_grid)
+        levels = level_grid[active]
+    profiler.count("bricks", len(levels))
+
+    with profiler.stage("interpolate"):
+        start, axis, length, start_val, end_val = _minimal_edges(brick_origins, brick_voxels, levels, level_grid,
+                                                                 threshold, voxel.shape, size)
+
+        # crossing point of every edge, in voxel coordinates
+        alpha = (threshold - start_val)/(end_val - start_val) if interpolate else np.full(len(start), 0.5)
+        points = start.astype(np.float64)
+        points[np.arange(len(start)), axis] += alpha*length
+
+        # the (up to) 4 leaf cells around every edge, in counterclockwise order around the edge axis
+        u, w = (axis + 1) % 3, (axis + 2) % 3
+        rows = np.arange(len(start))
+        leaves = np.empty((len(start), 4), dtype=np.int64)
+        valid = np.empty((len(start), 4), dtype=bool)
+        for corner, (du, dw) in enumerate([(-1, -1), (0, -1), (0, 0), (-1, 0)]):
+            cell = start.copy()
+            cell[rows, u] += du
+            cell[rows, w] += dw
+            valid[:, corner] = ((cell >= 0) & (cell < grid_shape - 1)).all(axis=1)
+            cell = np.where(valid[:, corner, None], cell, 0)
+
+            # origin of the leaf cell containing the voxel cell
+            cell_level = level_grid[tuple((cell // size).T)].astype(np.int64)[:, None]
+            leaf = (cell >> cell_level) << cell_level
+            leaves[:, corner] = np.ravel_multi_index(tuple(leaf.T), tuple(grid_shape - 1))
+
+        # one vertex per leaf cell, at the mean of the crossing points of its edges
+        leaf_ids, vertex_idx = np.unique(leaves[valid], return_inverse=True)
+        edge_of = np.repeat(rows, valid.sum(axis=1))
+        counts = np.bincount(vertex_idx, minlength=len(leaf_ids))
+        ijk = np.stack([np.bincount(vertex_idx, points[edge_of, a], len(leaf_ids)) for a in range(3)], axis=1)
+        ijk = ijk/counts[:, None]
+        profiler.count("active_cells", len(leaf_ids))
+
+    with profiler.stage("assemble"):
+        # quads of the edges inside the grid, oriented by the side of the surface the start voxel is on
+        quads = np.full((len(start), 4), -1, dtype=np.int64)
+        quads[valid] = vertex_idx
+        complete = valid.all(axis=1)
+        quads, inside = quads[complete], (start_val > threshold)[complete]
+        quads[~inside] = quads[~inside][:, ::-1]
+
+        # split the quads, the corners shared by a coarse cell give degenerate triangles
+        faces = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+        faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+        used, faces = np.unique(faces, return_inverse=True)
+        faces = faces.reshape(-1, 3).astype(face_dtype(len(used)))
+
+        # (i, j, k) voxel coordinates to the (x, y, z) coordinates of the other extractors
+        ijk = ijk[used]
+        flip = 1 if interpolate else 0
+        vertices = np.stack([ijk[:, 1]*spacing[1], (grid_shape[0] - flip - ijk[:, 0])*spacing[0], -ijk[:, 2]*spacing[2]],
+                            axis=1).astype(np.float32)
+    profiler.count("triangles", len(faces))
+
+    if indexed:
+        return vertices, faces
+    with profiler.stage("assemble"):
+        return indexed_to_mesh(vertices, faces)
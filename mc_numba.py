@@ -0,0 +1,523 @@
+"""
+Numba backend of the vectorized engines.
+
+The per-cell work of 'mc_vectorized.extract_block' and 'mt_vectorized.extract_tetra_block' is
+done by JIT-compiled kernels in two passes over the grid (or over a list of active cells):
+
+1. count: the cube index of every cell is computed and the number of triangles of each row
+   of cells (along the first axis) is summed,
+2. fill: the rows are processed again, each one writing its triangles (and their global edge
+   IDs for indexed output) straight into its own range of the preallocated output.
+
+No intermediate per-edge arrays or Python lists are built, and the triangles come out in the
+same order (with the same float32 coordinates) as with the NumPy backend. The smooth facet normals
+(normals=True) are interpolated from the gradients of the field in the same pass.
+
+The kernels are single threaded: like the NumPy backend, they are run on slabs by the processes
+of 'mc_parallel.py' (the numba threading layers do not all survive the fork of the workers).
+
+The collapse loop of the mesh decimation ('mesh_decimation.collapse_edges') is also compiled
+here: '_collapse_edges' keeps the faces of every vertex in a flat array instead of Python sets,
+and makes the same collapses in the same order as the Python loop.
+
+Numba is optional: 'block_extractor' falls back to the NumPy extractors (with a warning)
+when it is not installed, and 'mesh_decimation.edge_collapser' to the Python loop.
+"""
+
+import heapq
+import warnings
+
+import numpy as np
+
+from mc_lookup_table import VERTEX_OFFSETS, TRI_TABLE, TRI_COUNT, EDGE_VERTICES, EDGE_ORIGIN, EDGE_DIRECTION
+from tetrahedra_lookup_table import TETRA_TRI_TABLE, TETRA_TRI_COUNT, TETRA_EDGE_CUBE_VERTICES, \
+    TETRA_EDGE_ORIGIN, TETRA_EDGE_DIRECTION, CUBE_TO_TETRA_CASE
+from mc_vectorized import active_cells, extract_block, check_normals
+from mt_vectorized import extract_tetra_block
+from indexed_mesh import key_strides, cube_edge_key_offsets, tetra_edge_key_offsets, deduplicate_keys, face_dtype
+from profiling import NULL_PROFILER
+from stl_writer import STL_RECORD_DTYPE, triangle_buffer, triangle_records
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # the kernels stay plain Python functions (block_extractor never selects them)
+    def njit(*args, **kwargs):
+        return lambda function: function
+    NUMBA_AVAILABLE = False
+
+
+BACKENDS = ("numpy", "numba")
+
+# number of triangles of a cube for each cube index
+CUBE_TRI_COUNT = TRI_COUNT.astype(np.int64)
+TETRA_CUBE_TRI_COUNT = TETRA_TRI_COUNT[CUBE_TO_TETRA_CASE].sum(axis=1).astype(np.int64)
+
+# the lookup tables are passed to the kernels as arguments (numba cannot cache functions using large global arrays)
+CUBE_TABLES = (TRI_TABLE, TRI_COUNT, EDGE_VERTICES, EDGE_ORIGIN, EDGE_DIRECTION)
+TETRA_TABLES = (CUBE_TO_TETRA_CASE, TETRA_TRI_TABLE, TETRA_TRI_COUNT, TETRA_EDGE_CUBE_VERTICES, TETRA_EDGE_ORIGIN,
+                TETRA_EDGE_DIRECTION)
+
+
+@njit(cache=True)
+def _cube_case(voxel, i, j, k, threshold):
+    case = 0
+    for bit in range(8):
+        if voxel[i + VERTEX_OFFSETS[bit, 0], j + VERTEX_OFFSETS[bit, 1], k + VERTEX_OFFSETS[bit, 2]] > threshold:
+            case |= 1 << bit
+    return case
+
+
+@njit(cache=True)
+def _gradient(voxel, i, j, k, spacing):
+    """central-difference gradient at voxel (i, j, k), see 'mc_vectorized.voxel_gradients'"""
+
+    i0, i1 = max(i - 1, 0), min(i + 1, voxel.shape[0] - 1)
+    j0, j1 = max(j - 1, 0), min(j + 1, voxel.shape[1] - 1)
+    k0, k1 = max(k - 1, 0), min(k + 1, voxel.shape[2] - 1)
+    gi = (float(voxel[i1, j, k]) - float(voxel[i0, j, k]))/((i1 - i0)*spacing[0])
+    gj = (float(voxel[i, j1, k]) - float(voxel[i, j0, k]))/((j1 - j0)*spacing[1])
+    gk = (float(voxel[i, j, k1]) - float(voxel[i, j, k0]))/((k1 - k0)*spacing[2])
+    return gi, gj, gk
+
+
+@njit(cache=True)
+def _edge_gradient(voxel, i, j, k, start, end, alpha, spacing):
+    """gradient at the crossing point of the edge from cube vertex start to end, along the (i, j, k) axes"""
+
+    si, sj, sk = _gradient(voxel, i + VERTEX_OFFSETS[start, 0], j + VERTEX_OFFSETS[start, 1], k + VERTEX_OFFSETS[start, 2], spacing)
+    ei, ej, ek = _gradient(voxel, i + VERTEX_OFFSETS[end, 0], j + VERTEX_OFFSETS[end, 1], k + VERTEX_OFFSETS[end, 2], spacing)
+    return si*(1 - alpha) + ei*alpha, sj*(1 - alpha) + ej*alpha, sk*(1 - alpha) + ek*alpha
+
+
+@njit(cache=True)
+def _unit(x, y, z):
+    length = np.sqrt(x*x + y*y + z*z)
+    if length > 0:
+        return x/length, y/length, z/length
+    return x, y, z
+
+
+@njit(cache=True)
+def _emit_cube(voxel, threshold, i, j, k, case, pos, origin, grid_height, interpolate, scale, spacing, strides,
+               key_offsets, triangles, keys, indexed, normals, with_normals, tables):
+    """writes the triangles of a cell from triangle pos, returns the position of the next triangle
+
+    with_normals also writes the smooth facet normals (see 'mc_vectorized.smooth_facet_normals')
+    """
+
+    TRI_TABLE, TRI_COUNT, EDGE_VERTICES, EDGE_ORIGIN, EDGE_DIRECTION = tables
+
+    base_key = (i + origin[0])*strides[0] + (j + origin[1])*strides[1] + (k + origin[2])*strides[2]
+    for t in range(TRI_COUNT[case]):
+        nx, ny, nz = 0.0, 0.0, 0.0
+        for c in range(3):
+            e = TRI_TABLE[case, 3*t + c]
+            start, end = EDGE_VERTICES[e, 0], EDGE_VERTICES[e, 1]
+
+            if interpolate:
+                start_val = float(voxel[i + VERTEX_OFFSETS[start, 0], j + VERTEX_OFFSETS[start, 1], k + VERTEX_OFFSETS[start, 2]]) - threshold
+                end_val = float(voxel[i + VERTEX_OFFSETS[end, 0], j + VERTEX_OFFSETS[end, 1], k + VERTEX_OFFSETS[end, 2]]) - threshold
+                alpha = start_val/(start_val - end_val)
+                delta_y = grid_height - 2 - (i + origin[0])
+            else:
+                alpha = 0.5
+                delta_y = grid_height - 1 - (i + origin[0])
+
+            triangles[pos + t, c, 0] = ((EDGE_ORIGIN[e, 0] + alpha*EDGE_DIRECTION[e, 0]) + (j + origin[1]))*scale[0]
+            triangles[pos + t, c, 1] = ((EDGE_ORIGIN[e, 1] + alpha*EDGE_DIRECTION[e, 1]) + delta_y)*scale[1]
+            triangles[pos + t, c, 2] = ((EDGE_ORIGIN[e, 2] + alpha*EDGE_DIRECTION[e, 2]) - (k + origin[2]))*scale[2]
+            if indexed:
+                keys[3*(pos + t) + c] = base_key + key_offsets[0, e]
+
+            if with_normals:
+                # x = j, y = -i, z = -k (see 'mc_vectorized.CUBE_NORMAL_AXES')
+                gi, gj, gk = _edge_gradient(voxel, i, j, k, start, end, alpha, spacing)
+                x, y, z = _unit(gj, -gi, -gk)
+                nx, ny, nz = nx + x, ny + y, nz + z
+
+        if with_normals:
+            normals[pos + t, 0], normals[pos + t, 1], normals[pos + t, 2] = _unit(nx, ny, nz)
+
+    return pos + TRI_COUNT[case]
+
+
+@njit(cache=True)
+def _emit_tetra(voxel, threshold, i, j, k, case, pos, origin, grid_height, interpolate, scale, spacing, strides,
+                key_offsets, triangles, keys, indexed, normals, with_normals, tables):
+    """same as _emit_cube for the 6 tetrahedra of the cell"""
+
+    CUBE_TO_TETRA_CASE, TETRA_TRI_TABLE, TETRA_TRI_COUNT, TETRA_EDGE_CUBE_VERTICES, TETRA_EDGE_ORIGIN, TETRA_EDGE_DIRECTION = tables
+
+    base_key = (i + origin[0])*strides[0] + (j + origin[1])*strides[1] + (k + origin[2])*strides[2]
+    for tetra in range(6):
+        tetra_case = CUBE_TO_TETRA_CASE[case, tetra]
+        for t in range(TETRA_TRI_COUNT[tetra_case]):
+            nx, ny, nz = 0.0, 0.0, 0.0
+            for c in range(3):
+                e = TETRA_TRI_TABLE[tetra_case, 3*t + c]
+                start, end = TETRA_EDGE_CUBE_VERTICES[tetra, e, 0], TETRA_EDGE_CUBE_VERTICES[tetra, e, 1]
+
+                alpha = 0.5
+                if interpolate:
+                    start_val = float(voxel[i + VERTEX_OFFSETS[start, 0], j + VERTEX_OFFSETS[start, 1], k + VERTEX_OFFSETS[start, 2]])
+                    end_val = float(voxel[i + VERTEX_OFFSETS[end, 0], j + VERTEX_OFFSETS[end, 1], k + VERTEX_OFFSETS[end, 2]])
+                    alpha = (threshold - start_val)/(end_val - start_val)
+
+                triangles[pos, c, 0] = ((TETRA_EDGE_ORIGIN[tetra, e, 0] + alpha*TETRA_EDGE_DIRECTION[tetra, e, 0]) + (j + origin[1]))*scale[0]
+                triangles[pos, c, 1] = ((TETRA_EDGE_ORIGIN[tetra, e, 1] + alpha*TETRA_EDGE_DIRECTION[tetra, e, 1]) + (k + origin[2]))*scale[1]
+                triangles[pos, c, 2] = ((TETRA_EDGE_ORIGIN[tetra, e, 2] + alpha*TETRA_EDGE_DIRECTION[tetra, e, 2]) + (grid_height - 2 - (i + origin[0])))*scale[2]
+                if indexed:
+                    keys[3*pos + c] = base_key + key_offsets[tetra, e]
+
+                if with_normals:
+                    # x = j, y = k, z = -i (see 'mt_vectorized.TETRA_NORMAL_AXES')
+                    gi, gj, gk = _edge_gradient(voxel, i, j, k, start, end, alpha, spacing)
+                    x, y, z = _unit(gj, gk, -gi)
+                    nx, ny, nz = nx + x, ny + y, nz + z
+
+            if with_normals:
+                normals[pos, 0], normals[pos, 1], normals[pos, 2] = _unit(nx, ny, nz)
+            pos += 1
+
+    return pos
+
+
+@njit(cache=True)
+def _count_rows(voxel, threshold, cell_tri_count):
+    """first pass: number of triangles of every row of cells (along the first axis)"""
+
+    counts = np.zeros(voxel.shape[0] - 1, dtype=np.int64)
+    for i in range(voxel.shape[0] - 1):
+        count = 0
+        for j in range(voxel.shape[1] - 1):
+            for k in range(voxel.shape[2] - 1):
+                count += cell_tri_count[_cube_case(voxel, i, j, k, threshold)]
+        counts[i] = count
+    return counts
+
+
+@njit(cache=True)
+def _fill_rows(voxel, threshold, row_offsets, tetra, origin, grid_height, interpolate, scale, spacing, strides,
+               key_offsets, triangles, keys, indexed, normals, with_normals, cube_tables, tetra_tables):
+    """second pass: every row writes its triangles from its offset"""
+
+    for i in range(voxel.shape[0] - 1):
+        pos = row_offsets[i]
+        for j in range(voxel.shape[1] - 1):
+            for k in range(voxel.shape[2] - 1):
+                case = _cube_case(voxel, i, j, k, threshold)
+                if case == 0 or case == 255:
+                    continue
+                if tetra:
+                    pos = _emit_tetra(voxel, threshold, i, j, k, case, pos, origin, grid_height, interpolate, scale,
+                                      spacing, strides, key_offsets, triangles, keys, indexed, normals, with_normals,
+                                      tetra_tables)
+                else:
+                    pos = _emit_cube(voxel, threshold, i, j, k, case, pos, origin, grid_height, interpolate, scale,
+                                     spacing, strides, key_offsets, triangles, keys, indexed, normals, with_normals,
+                                     cube_tables)
+
+
+@njit(cache=True)
+def _fill_cells(voxel, threshold, cells, cases, cell_offsets, tetra, origin, grid_height, interpolate, scale, spacing,
+                strides, key_offsets, triangles, keys, indexed, normals, with_normals, cube_tables, tetra_tables):
+    """second pass over a list of active cells (the offsets are computed from their cube indices)"""
+
+    n_j, n_k = voxel.shape[1] - 1, voxel.shape[2] - 1
+    for n in range(len(cells)):
+        i, j, k = cells[n] // (n_j*n_k), (cells[n] // n_k) % n_j, cells[n] % n_k
+        if tetra:
+            _emit_tetra(voxel, threshold, i, j, k, cases[n], cell_offsets[n], origin, grid_height, interpolate, scale,
+                        spacing, strides, key_offsets, triangles, keys, indexed, normals, with_normals, tetra_tables)
+        else:
+            _emit_cube(voxel, threshold, i, j, k, cases[n], cell_offsets[n], origin, grid_height, interpolate, scale,
+                       spacing, strides, key_offsets, triangles, keys, indexed, normals, with_normals, cube_tables)
+
+
+def _extract(voxel, threshold, origin, grid_shape, indexed, interpolate, bricks, active, spacing, normals, tetra, profiler):
+    check_normals(normals, indexed)
+    grid_shape = voxel.shape if grid_shape is None else grid_shape
+    cell_tri_count = TETRA_CUBE_TRI_COUNT if tetra else CUBE_TRI_COUNT
+    threshold = float(threshold)
+
+    # the (x, y, z) axes are along the (j, i, k) voxel axes for cubes and (j, k, i) for tetrahedra
+    scale = np.asarray(spacing, dtype=np.float64)[[1, 2, 0] if tetra else [1, 0, 2]]
+    strides = key_strides(grid_shape)
+    key_offsets = tetra_edge_key_offsets(grid_shape) if tetra else cube_edge_key_offsets(grid_shape)[None]
+    origin = np.asarray(origin, dtype=np.int64)
+    args = (origin, int(grid_shape[0]), bool(interpolate), scale, np.asarray(spacing, dtype=np.float64), strides, key_offsets)
+
+    if active is None and bricks is not None:
+        active = active_cells(voxel, threshold, bricks, profiler)
+
+    # first pass, count the triangles (the active cells of a grid scan are not counted)
+    with profiler.stage("count"):
+        if active is None:
+            counts = _count_rows(voxel, threshold, cell_tri_count)
+            profiler.count("cells_visited", np.prod(np.array(voxel.shape) - 1))
+        else:
+            cells, cases = active
+            counts = cell_tri_count[cases]
+        offsets = np.cumsum(counts) - counts
+
+    # second pass, fill the preallocated outputs
+    with profiler.stage("fill"):
+        n_triangles = int(counts.sum())
+        # the triangles of a soup are written straight into a triangle buffer (see 'stl_writer.triangle_buffer')
+        triangles = np.empty((n_triangles, 3, 3), dtype=np.float32) if indexed else triangle_buffer(n_triangles)
+        keys = np.empty(3*n_triangles if indexed else 0, dtype=np.int64)
+        # the normals are written into the records of the triangle buffer (an empty record array when not set)
+        records = np.zeros(0, dtype=STL_RECORD_DTYPE) if indexed else triangle_records(triangles)
+        outputs = (triangles, keys, indexed, records["normals"], bool(normals))
+        if active is None:
+            _fill_rows(voxel, threshold, offsets, tetra, *args, *outputs, CUBE_TABLES, TETRA_TABLES)
+        else:
+            _fill_cells(voxel, threshold, np.asarray(cells, dtype=np.int64), cases, offsets, tetra, *args, *outputs,
+                        CUBE_TABLES, TETRA_TABLES)
+    profiler.count("triangles", n_triangles)
+
+    if not indexed:
+        return triangles
+
+    # every occurrence of a vertex has the same coordinates, keep the first one
+    with profiler.stage("deduplicate"):
+        first, vertex_idx = deduplicate_keys(keys)
+        vertices = triangles.reshape(-1, 3)[first]
+        faces = vertex_idx.reshape(-1, 3).astype(face_dtype(len(vertices)))
+    return keys[first], vertices, faces
+
+
+def extract_block_numba(voxel, threshold, origin=(0, 0, 0), grid_shape=None, indexed=False, interpolate=True, bricks=None,
+                        active=None, spacing=(1.0, 1.0, 1.0), normals=False, profiler=NULL_PROFILER):
+    """compiled equivalent of 'mc_vectorized.extract_block' (same interface and output)"""
+    return _extract(voxel, threshold, origin, grid_shape, indexed, interpolate, bricks, active, spacing, normals, False,
+                    profiler)
+
+
+def extract_tetra_block_numba(voxel, threshold, origin=(0, 0, 0), grid_shape=None, indexed=False, interpolate=True,
+                              bricks=None, active=None, spacing=(1.0, 1.0, 1.0), normals=False, profiler=NULL_PROFILER):
+    """compiled equivalent of 'mt_vectorized.extract_tetra_block' (same interface and output)"""
+    return _extract(voxel, threshold, origin, grid_shape, indexed, interpolate, bricks, active, spacing, normals, True,
+                    profiler)
+
+
+def block_extractor(backend="numpy", tetra=False):
+    """block extractor of a backend ("numpy" or "numba"), numba falls back to numpy if it is not installed"""
+
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+
+    if backend == "numba" and not NUMBA_AVAILABLE:
+        warnings.warn("numba is not installed, falling back to the numpy backend")
+        backend = "numpy"
+
+    if backend == "numba":
+        return extract_tetra_block_numba if tetra else extract_block_numba
+    return extract_tetra_block if tetra else extract_block
+
+
+@njit(cache=True)
+def _quadric_error(q, x, y, z):
+    return (q[0]*x*x + 2*q[1]*x*y + 2*q[2]*x*z + 2*q[3]*x + q[4]*y*y + 2*q[5]*y*z + 2*q[6]*y
+            + q[7]*z*z + 2*q[8]*z + q[9])
+
+
+@njit(cache=True)
+def _collapse_cost(q, pu, pv):
+    """compiled 'mesh_decimation.collapse_cost'"""
+
+    aa, ab, ac, ad, bb, bc, bd, cc, cd = q[0], q[1], q[2], q[3], q[4], q[5], q[6], q[7], q[8]
+    m0, m1, m2 = bb*cc - bc*bc, ab*cc - bc*ac, ab*bc - bb*ac
+    det = aa*m0 - ab*m1 + ac*m2
+    trace = aa + bb + cc
+    if abs(det) > 1e-3*trace*trace*trace:
+        x = (-ad*m0 + ab*(bd*cc - bc*cd) - ac*(bd*bc - bb*cd))/det
+        y = (aa*(-bd*cc + cd*bc) + ad*m1 + ac*(ab*cd - bd*ac))/det
+        z = (aa*(-bb*cd + bc*bd) - ab*(-ab*cd + bd*ac) - ad*m2)/det
+        return _quadric_error(q, x, y, z), x, y, z
+
+    x, y, z = pu[0], pu[1], pu[2]
+    best_error, best_x, best_y, best_z = _quadric_error(q, x, y, z), x, y, z
+    x, y, z = pv[0], pv[1], pv[2]
+    error = _quadric_error(q, x, y, z)
+    if error < best_error:
+        best_error, best_x, best_y, best_z = error, x, y, z
+    x, y, z = (pu[0] + x)*0.5, (pu[1] + y)*0.5, (pu[2] + z)*0.5
+    error = _quadric_error(q, x, y, z)
+    if error < best_error:
+        best_error, best_x, best_y, best_z = error, x, y, z
+    return best_error, best_x, best_y, best_z
+
+
+@njit(cache=True)
+def _face_lists(faces, alive, n_vertices, capacity):
+    """(refs, start, count, end): the alive faces of vertex v are refs[start[v]:start[v] + count[v]]"""
+
+    count = np.zeros(n_vertices, dtype=np.int64)
+    for f in range(len(faces)):
+        if alive[f]:
+            for c in range(3):
+                count[faces[f, c]] += 1
+    start = np.zeros(n_vertices, dtype=np.int64)
+    end = 0
+    for v in range(n_vertices):
+        start[v] = end
+        end += count[v]
+    refs = np.empty(capacity, dtype=np.int64)
+    fill = start.copy()
+    for f in range(len(faces)):
+        if alive[f]:
+            for c in range(3):
+                v = faces[f, c]
+                refs[fill[v]] = f
+                fill[v] += 1
+    return refs, start, count, end
+
+
+@njit(cache=True)
+def _collapse_edges(positions, quadrics, faces, locked, normals, errors, keep, remove, position, n_remove, max_cost):
+    n_vertices, n_faces = len(positions), len(faces)
+    alive = np.ones(n_faces, dtype=np.bool_)
+    version = np.zeros(n_vertices, dtype=np.int64)
+
+    # the face lists of the kept vertices are appended at the end of refs, which is rebuilt when it is full
+    capacity = 6*n_faces + 64
+    refs, start, count, end = _face_lists(faces, alive, n_vertices, capacity)
+
+    # vertices of a ring are marked with the current stamp
+    mark = np.zeros(n_vertices, dtype=np.int64)
+    stamp = 0
+
+    heap = [(0.0, 0, 0, 0, 0, 0.0, 0.0, 0.0)]
+    heap.pop()
+    for n in range(len(errors)):
+        heap.append((errors[n], keep[n], remove[n], 0, 0, position[n, 0], position[n, 1], position[n, 2]))
+    heapq.heapify(heap)
+
+    moved = np.empty(64, dtype=np.int64)
+    moved_normals = np.empty((64, 3))
+    qv = np.empty(10)
+    removed = 0
+    while len(heap) > 0 and removed < n_remove:
+        error, k, o, keep_version, other_version, x, y, z = heapq.heappop(heap)
+        if error > max_cost:
+            break
+        if version[k] != keep_version or version[o] != other_version:
+            continue
+
+        # link condition: the ends may only share the neighbors of the faces of the edge
+        n_shared = 0
+        stamp += 1
+        for r in range(start[k], start[k] + count[k]):
+            f = refs[r]
+            if alive[f]:
+                if faces[f, 0] == o or faces[f, 1] == o or faces[f, 2] == o:
+                    n_shared += 1
+                for c in range(3):
+                    mark[faces[f, c]] = stamp
+        if n_shared == 0:
+            continue
+        stamp += 1
+        common = 0
+        for r in range(start[o], start[o] + count[o]):
+            f = refs[r]
+            if alive[f]:
+                for c in range(3):
+                    v = faces[f, c]
+                    if mark[v] == stamp - 1:
+                        common += 1
+                    mark[v] = stamp
+        if common != n_shared + 2:
+            continue
+
+        # new normals of the faces around the edge, none may flip (or become degenerate)
+        n_moved = 0
+        flipped = False
+        for v0 in (k, o):
+            for r in range(start[v0], start[v0] + count[v0]):
+                f = refs[r]
+                if not alive[f]:
+                    continue
+                has_k = faces[f, 0] == k or faces[f, 1] == k or faces[f, 2] == k
+                has_o = faces[f, 0] == o or faces[f, 1] == o or faces[f, 2] == o
+                if has_k and has_o:
+                    continue
+                a, b, c = faces[f, 0], faces[f, 1], faces[f, 2]
+                ax, ay, az = (x, y, z) if a == k or a == o else (positions[a, 0], positions[a, 1], positions[a, 2])
+                bx, by, bz = (x, y, z) if b == k or b == o else (positions[b, 0], positions[b, 1], positions[b, 2])
+                cx, cy, cz = (x, y, z) if c == k or c == o else (positions[c, 0], positions[c, 1], positions[c, 2])
+                ux, uy, uz, wx, wy, wz = bx - ax, by - ay, bz - az, cx - ax, cy - ay, cz - az
+                nx, ny, nz = uy*wz - uz*wy, uz*wx - ux*wz, ux*wy - uy*wx
+                ox, oy, oz = normals[f, 0], normals[f, 1], normals[f, 2]
+                if nx*ox + ny*oy + nz*oz <= 0 and (ox != 0 or oy != 0 or oz != 0):
+                    flipped = True
+                    break
+                if n_moved == len(moved):
+                    moved = np.concatenate((moved, np.empty_like(moved)))
+                    moved_normals = np.concatenate((moved_normals, np.empty_like(moved_normals)))
+                moved[n_moved] = f
+                moved_normals[n_moved, 0], moved_normals[n_moved, 1], moved_normals[n_moved, 2] = nx, ny, nz
+                n_moved += 1
+            if flipped:
+                break
+        if flipped:
+            continue
+
+        # collapse o into k, the new face list of k is appended to refs
+        if end + count[k] + count[o] > capacity:
+            refs, start, count, end = _face_lists(faces, alive, n_vertices, capacity)
+        new_start = end
+        for r in range(start[k], start[k] + count[k]):
+            f = refs[r]
+            if alive[f]:
+                if faces[f, 0] == o or faces[f, 1] == o or faces[f, 2] == o:
+                    alive[f] = False
+                else:
+                    refs[end] = f
+                    end += 1
+        for r in range(start[o], start[o] + count[o]):
+            f = refs[r]
+            if alive[f]:
+                for c in range(3):
+                    if faces[f, c] == o:
+                        faces[f, c] = k
+                refs[end] = f
+                end += 1
+        start[k], count[k], count[o] = new_start, end - new_start, 0
+        for n in range(n_moved):
+            normals[moved[n]] = moved_normals[n]
+        positions[k, 0], positions[k, 1], positions[k, 2] = x, y, z
+        quadrics[k] += quadrics[o]
+        version[k] += 1
+        version[o] = -1
+        removed += n_shared
+
+        # the edges of k changed, push them again (never the edges of the locked vertices)
+        stamp += 1
+        mark[k] = stamp
+        for r in range(start[k], start[k] + count[k]):
+            f = refs[r]
+            for c in range(3):
+                v = faces[f, c]
+                if mark[v] == stamp:
+                    continue
+                mark[v] = stamp
+                if locked[v]:
+                    continue
+                for n in range(10):
+                    qv[n] = quadrics[k, n] + quadrics[v, n]
+                error, px, py, pz = _collapse_cost(qv, positions[k], positions[v])
+                heapq.heappush(heap, (error, k, v, version[k], version[v], px, py, pz))
+
+    return positions, quadrics, faces[alive]
+
+
+def collapse_edges_numba(positions, quadrics, faces, locked, normals, collapses, n_remove, max_cost):
+    """compiled equivalent of 'mesh_decimation.collapse_edges' (same interface and output)"""
+
+    errors, keep, remove, position = collapses
+    return _collapse_edges(positions.copy(), quadrics.copy(), faces.astype(np.int64), locked, normals.copy(),
+                           errors, keep.astype(np.int64), remove.astype(np.int64), position, int(n_remove),
+                           float(max_cost))
@@ -0,0 +1,127 @@
+"""
+Multiprocess slab-parallel extraction.
+
+The voxel grid is split along the first axis into slabs that overlap by one slice (the last
+slice of a slab is the first slice of the next one), so every cell belongs to exactly one slab.
+Each slab is extracted by a process of the pool with 'extract_block' (or
+'mt_vectorized.extract_tetra_block' for tetrahedra) and the partial meshes are
+merged in slab order, which gives the same triangles (in the same order) as a single process run.
+
+The workers never receive a pickled copy of the volume: a memmapped volume (e.g. from
+np.load(mmap_mode='r')) is reopened from its file, any other volume is copied once into a
+shared memory block that every worker attaches to.
+
+With indexed output, the vertices are keyed by global edge ID, so the vertices on the slice
+shared by two slabs are merged like any other shared vertex.
+"""
+
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from stl_writer import triangle_buffer, triangles_to_mesh
+from mc_vectorized import extract_block
+from indexed_mesh import deduplicate_keys, face_dtype
+from profiling import NULL_PROFILER
+
+
+# volume of the worker process (attached once by _init_worker)
+_worker_volume = None
+_worker_shm = None
+
+
+def split_slabs(n_points, n_slabs):
+    """splits range(n_points) into n_slabs (start, stop) voxel ranges sharing their boundary slice"""
+
+    n_slabs = max(1, min(n_slabs, n_points - 1))
+    bounds = np.linspace(0, n_points - 1, n_slabs + 1).round().astype(int)
+    return [(int(start), int(stop) + 1) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _volume_spec(voxel):
+    """describes where the workers can find the volume (memmap file or shared memory block)"""
+
+    if isinstance(voxel, np.memmap) and isinstance(voxel.base, mmap.mmap) and voxel.filename is not None:
+        order = "F" if voxel.flags.f_contiguous and not voxel.flags.c_contiguous else "C"
+        return ("memmap", voxel.filename, voxel.offset, voxel.shape, voxel.dtype.str, order), None
+
+    shm = shared_memory.SharedMemory(create=True, size=max(voxel.nbytes, 1))
+    shared = np.ndarray(voxel.shape, dtype=voxel.dtype, buffer=shm.buf)
+    shared[:] = voxel
+    return ("shm", shm.name, 0, voxel.shape, voxel.dtype.str, "C"), shm
+
+
+def _init_worker(spec):
+    global _worker_volume, _worker_shm
+
+    kind, name, offset, shape, dtype, order = spec
+    if kind == "memmap":
+        _worker_volume = np.memmap(name, dtype=dtype, mode="r", offset=offset, shape=shape, order=order)
+    else:
+        _worker_shm = shared_memory.SharedMemory(name=name)
+        _worker_volume = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+
+
+def _extract_slab(task):
+    extract, start, stop, threshold, indexed, interpolate, spacing = task
+    slab = _worker_volume[start:stop]
+    return extract(slab, threshold, origin=(start, 0, 0), grid_shape=_worker_volume.shape,
+                   indexed=indexed, interpolate=interpolate, spacing=spacing)
+
+
+def merge_indexed(parts):
+    """merges (keys, vertices, faces) parts, vertices with the same global edge ID are merged"""
+
+    keys = np.concatenate([part_keys for part_keys, _, _ in parts])
+    vertices = np.concatenate([part_vertices for _, part_vertices, _ in parts])
+
+    # offset the faces of each part into the concatenated vertices
+    offsets = np.cumsum([0] + [len(part_keys) for part_keys, _, _ in parts[:-1]])
+    faces = np.concatenate([part_faces.astype(np.int64) + offset for (_, _, part_faces), offset in zip(parts, offsets)])
+
+    first, vertex_idx = deduplicate_keys(keys)
+    vertices = vertices[first]
+    faces = vertex_idx[faces].astype(face_dtype(len(vertices)))
+
+    return keys[first], vertices, faces
+
+
+def marching_cubes_parallel(voxel, threshold=0.0, workers=None, indexed=False, interpolate=True, n_slabs=None,
+                            extract=extract_block, spacing=(1.0, 1.0, 1.0), profiler=NULL_PROFILER):
+    """same as 'marching_cubes_vectorized', with the slabs of the grid extracted by a pool of processes
+
+    returns an stl mesh, or a (vertices, faces) tuple if indexed is set. profiler only records the
+    stages of this process (the work of the pool is the extract stage).
+    """
+
+    workers = workers or os.cpu_count()
+    tasks = [(extract, start, stop, threshold, indexed, interpolate, spacing) for start, stop in split_slabs(voxel.shape[0], n_slabs or 4*workers)]
+
+    with profiler.stage("share"):
+        spec, shm = _volume_spec(voxel)
+    try:
+        with profiler.stage("extract"), \
+                ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(spec,)) as pool:
+            parts = list(pool.map(_extract_slab, tasks))
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    if indexed:
+        with profiler.stage("merge"):
+            _, vertices, faces = merge_indexed(parts)
+        profiler.count("triangles", len(faces))
+        return vertices, faces
+
+    with profiler.stage("merge"):
+        triangles = np.concatenate(parts, out=triangle_buffer(sum(len(part) for part in parts)))
+    profiler.count("triangles", len(triangles))
+
+    with profiler.stage("assemble"):
+        final_mesh = triangles_to_mesh(triangles)
+
+    return final_mesh
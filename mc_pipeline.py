@@ -0,0 +1,145 @@
+"""
+Asyncio pipeline of the stream engine.
+
+'marching_cubes_stream' over 'load_voxels.iter_ct_slices' decodes an image, extracts the cells
+below it and hands the chunk to the writer one step after the other, so the CPU waits while the
+images are read (on a network file system, mostly) and the disk waits while the cells are
+extracted. 'run_pipeline' runs the three stages concurrently, connected by bounded queues:
+
+1. decode: the images are decoded by a pool of threads (cv2 releases the GIL), up to prefetch
+   images ahead of the slice being resampled,
+2. extract: the slices go through 'marching_cubes_stream' on a thread of its own,
+3. write: the chunks are appended to the STL (or OBJ) file on another thread.
+
+The event loop only moves the slices and chunks between the queues. Each queue holds at most
+max_pending items, so the memory stays bounded like with the stream engine, and the output file is
+the same. The stages overlap, so their times in the profile add up to more than the wall time.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from indexed_mesh import write_obj_chunk
+from load_voxels import read_ct_image, slice_positions
+from mc_vectorized import extract_block, marching_cubes_stream
+from profiling import NULL_PROFILER
+from stl_writer import StlWriter
+
+
+def _decode(path, profiler):
+    with profiler.stage("read"):
+        img = read_ct_image(path)
+    profiler.count("slices")
+    profiler.add_bytes("read", img.nbytes)
+    return img.astype(np.float64)
+
+
+async def _decode_slices(folder_dir, gaps, slices, pool, prefetch, profiler):
+    """puts the slices of the folder (same as 'load_voxels.iter_ct_slices') in the slices queue, then None"""
+
+    loop = asyncio.get_running_loop()
+    files = sorted(os.listdir(folder_dir))
+
+    images = {}
+    n_started = 0
+    for lower, upper, weight in zip(*slice_positions(len(files), gaps)):
+        # keep decoding up to prefetch images ahead, and drop the images below the slice
+        while n_started < min(upper + 1 + prefetch, len(files)):
+            images[n_started] = loop.run_in_executor(pool, _decode, os.path.join(folder_dir, files[n_started]), profiler)
+            n_started += 1
+        for idx in list(images):
+            if idx < lower:
+                del images[idx]
+
+        lower_image, upper_image = await images[lower], await images[upper]
+        with profiler.stage("resample"):
+            resampled = lower_image*(1 - weight) + upper_image*weight
+        await slices.put(resampled)
+
+    await slices.put(None)
+
+
+def _iter_queue(queue, loop):
+    """iterates over the items of an asyncio queue from a worker thread, until None"""
+
+    while True:
+        item = asyncio.run_coroutine_threadsafe(queue.get(), loop).result()
+        if item is None:
+            return
+        yield item
+
+
+async def _extract_chunks(slices, chunks, thread, stream_args):
+    """runs 'marching_cubes_stream' on the slices queue (on the thread) and puts the chunks in the chunks queue, then None"""
+
+    loop = asyncio.get_running_loop()
+
+    def extract():
+        for chunk in marching_cubes_stream(_iter_queue(slices, loop), **stream_args):
+            asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+    await loop.run_in_executor(thread, extract)
+    await chunks.put(None)
+
+
+async def _write_chunks(chunks, output, thread, profiler):
+    """writes the chunks of the queue to an STL file (or an OBJ file of indexed chunks), returns the number of faces"""
+
+    loop = asyncio.get_running_loop()
+    save_obj = output.endswith(".obj")
+    n_faces = 0
+
+    def write(chunk):
+        with profiler.stage("write"):
+            if save_obj:
+                write_obj_chunk(f, *chunk)
+            else:
+                f.write(chunk)
+
+    with open(output, "w") if save_obj else StlWriter(output) as f:
+        while (chunk := await chunks.get()) is not None:
+            await loop.run_in_executor(thread, write, chunk)
+            n_faces += len(chunk[1] if save_obj else chunk)
+
+    profiler.add_bytes("write", os.path.getsize(output))
+    return n_faces
+
+
+async def _pipeline(folder_dir, output, gaps, prefetch, max_pending, pools, stream_args, profiler):
+    slices = asyncio.Queue(maxsize=max_pending)
+    chunks = asyncio.Queue(maxsize=max_pending)
+    decode_pool, extract_thread, write_thread = pools
+
+    _, _, n_faces = await asyncio.gather(_decode_slices(folder_dir, gaps, slices, decode_pool, prefetch, profiler),
+                                         _extract_chunks(slices, chunks, extract_thread, stream_args),
+                                         _write_chunks(chunks, output, write_thread, profiler))
+    return n_faces
+
+
+def run_pipeline(folder_dir, output, threshold=0.0, gaps=1, indexed=False, interpolate=True, extract=extract_block,
+                 spacing=(1.0, 1.0, 1.0), workers=4, prefetch=8, max_pending=8, profiler=NULL_PROFILER):
+    """extracts the isosurface of the images of the folder with the stream engine and writes it to output
+
+    The images are decoded by workers threads (up to prefetch images ahead), while the cells are
+    extracted and the chunks written (see the module docstring). The output is an STL file, or an
+    OBJ file of the indexed mesh if indexed is set. threshold, interpolate, extract and spacing are
+    passed to 'marching_cubes_stream'. Returns the number of faces written.
+    """
+
+    if indexed != output.endswith(".obj"):
+        raise ValueError("indexed meshes are written as .obj files, and triangle soups as .stl files")
+    if prefetch < 0 or max_pending < 1:
+        raise ValueError(f"prefetch must be >= 0 and max_pending >= 1, got {prefetch} and {max_pending}")
+
+    stream_args = dict(threshold=threshold, indexed=indexed, interpolate=interpolate, extract=extract, spacing=spacing,
+                       profiler=profiler)
+
+    # the pools outlive the event loop: when a stage fails, asyncio.run cancels the queue operations
+    # the threads are waiting on before the pools are shut down
+    with ThreadPoolExecutor(max_workers=workers) as decode_pool, ThreadPoolExecutor(max_workers=1) as extract_thread, \
+            ThreadPoolExecutor(max_workers=1) as write_thread:
+        pools = (decode_pool, extract_thread, write_thread)
+        return asyncio.run(_pipeline(folder_dir, output, gaps, prefetch, max_pending, pools, stream_args, profiler))
@@ -0,0 +1,485 @@
+"""
+This is a vectorized implementation of the Marching Cubes algorithm with interpolation.
+It produces the same triangles (in the same order) as 'marching_cubes_interp.py', but
+instead of looping over every cell in Python:
+
+1. all the cube indices are computed at once with strided array operations (optionally only
+   in the bricks of a 'brick_index.BrickIndex' that can contain the isosurface),
+2. the triangle edges of the active cells are gathered from a flat lookup array,
+3. every active edge is interpolated in one batch.
+
+With `indexed=True`, the crossing point of each global edge is interpolated only once and
+a shared-vertex mesh is returned (see 'indexed_mesh.py').
+
+`marching_cubes_multi` extracts the isosurfaces of several thresholds, sharing the brick
+index and the gathered bricks between them.
+
+With `normals=True`, the normals of the surface are interpolated along the edges in the same batch,
+from the central-difference gradients of the field, and written into the STL records.
+
+`marching_cubes_stream` runs the same engine on a stream of slices, one pair of adjacent
+slices at a time, so the whole volume never has to be loaded.
+"""
+
+import itertools
+
+import numpy as np
+
+from stl_writer import triangle_buffer, triangle_records, triangles_to_mesh
+from mc_lookup_table import VERTEX_OFFSETS, TRI_TABLE, TRI_COUNT, EDGE_VERTICES, EDGE_ORIGIN, EDGE_DIRECTION
+from brick_index import BrickIndex
+from indexed_mesh import key_strides, cube_edge_key_offsets, key_plane, deduplicate_keys, face_dtype
+from profiling import NULL_PROFILER
+
+# voxel axis and sign of the (x, y, z) axes of the mesh (x = j, y = -i, z = -k), the normals point
+# along the gradient of the field, on the same side as the winding of the triangles
+CUBE_NORMAL_AXES = ([1, 0, 2], np.array([1.0, -1.0, -1.0]))
+
+
+def compute_cube_indices(voxel, threshold):
+    """computes the lookup index of every cell, returns an uint8 array of shape (voxel.shape - 1)"""
+
+    inside = voxel > threshold
+    nx, ny, nz = np.array(inside.shape) - 1
+
+    cube_idx = np.zeros((nx, ny, nz), dtype=np.uint8)
+    for bit, (di, dj, dk) in enumerate(VERTEX_OFFSETS):
+        # strided view of vertex 'bit' for every cell
+        corner = inside[di:di + nx, dj:dj + ny, dk:dk + nz]
+        cube_idx |= corner.view(np.uint8) << np.uint8(bit)
+
+    return cube_idx
+
+
+def active_cells(voxel, threshold, bricks=None, profiler=NULL_PROFILER):
+    """finds the cells crossed by the isosurface, returns (flat cell indices, uint8 cube indices)
+
+    The result is a compact classification of the grid for the threshold: it can be kept and passed
+    (as active=) to any extractor to re-extract the surface without scanning the grid again.
+
+    if bricks (a 'brick_index.BrickIndex' of voxel) is given, only the cells of the bricks
+    straddling the threshold are classified
+    """
+
+    if bricks is not None and bricks.shape != voxel.shape:
+        raise ValueError(f"brick index of shape {bricks.shape} does not match the voxel grid {voxel.shape}")
+
+    with profiler.stage("classify"):
+        if bricks is None:
+            cube_idx = compute_cube_indices(voxel, threshold)
+            cells = np.flatnonzero((cube_idx != 0) & (cube_idx != 255))
+            active, n_visited = (cells, cube_idx.reshape(-1)[cells]), cube_idx.size
+        else:
+            cells, cases, n_visited = brick_active_cells(voxel, bricks, threshold)
+            active = cells, cases
+
+    count_cells(profiler, n_visited, len(active[0]))
+    return active
+
+
+def count_cells(profiler, n_visited, n_active):
+    """records the cells visited by a classification, and how many were active or skipped as empty"""
+
+    profiler.count("cells_visited", n_visited)
+    profiler.count("active_cells", n_active)
+    profiler.count("empty_skips", n_visited - n_active)
+
+
+def iter_cells(output_dim, active=None):
+    """yields the (i, j, k) index of every cell of the grid, or of the active cells (see active_cells), in grid order"""
+
+    if active is None:
+        return itertools.product(*(range(n) for n in output_dim))
+    return zip(*(idx.tolist() for idx in np.unravel_index(active[0], tuple(output_dim))))
+
+
+def brick_runs(brick_mask):
+    """(i, j, first k, end k) brick indices of the runs of consecutive masked bricks along the third axis"""
+
+    edges = np.diff(np.pad(brick_mask.astype(np.int8), ((0, 0), (0, 0), (1, 1))), axis=2)
+    bi, bj, starts = np.nonzero(edges == 1)
+    return bi, bj, starts, np.nonzero(edges == -1)[2]
+
+
+def brick_active_cells(voxel, bricks, threshold):
+    """active cells (see active_cells) of the bricks straddling the threshold, returns (flat cell indices, uint8 cube
+    indices, number of cells classified)
+
+    each run of active bricks along the third axis is classified as one sliced block of the volume (no voxel is
+    copied), and only the crossed cells of the blocks are shifted to grid indices and sorted in grid order
+    """
+
+    size = bricks.brick_size
+    ny, nz = voxel.shape[1] - 1, voxel.shape[2] - 1
+    # cell index and cube index of every crossed cell in one int64 key, sorted together
+    keys = [np.empty(0, dtype=np.int64)]
+    n_visited = 0
+    for bi, bj, start, end in zip(*(idx.tolist() for idx in brick_runs(bricks.active_bricks(threshold)))):
+        i, j, k0, k1 = bi*size, bj*size, start*size, end*size
+        block = compute_cube_indices(voxel[i:i + size + 1, j:j + size + 1, k0:k1 + 1], threshold)
+        local = np.flatnonzero((block != 0) & (block != 255))
+        rows, dk = np.divmod(local, block.shape[2])
+        di, dj = np.divmod(rows, block.shape[1])
+        keys.append((((i + di)*ny + j + dj)*nz + k0 + dk) << 8 | block.reshape(-1)[local])
+        n_visited += block.size
+
+    keys = np.sort(np.concatenate(keys))
+    return keys >> 8, (keys & 255).astype(np.uint8), n_visited
+
+
+def gather_bricks(voxel, bricks, brick_mask):
+    """gathers the voxels of the masked bricks, returns (brick origins, (bricks, size + 1, size + 1, size + 1) voxels)
+
+    the bricks at the end of the grid are padded by repeating the last voxel
+    """
+
+    size = bricks.brick_size
+    output_dim = np.array(voxel.shape) - 1
+    brick_origins = np.argwhere(brick_mask)*size
+    local = np.arange(size + 1)
+    ii, jj, kk = (np.minimum(brick_origins[:, axis, None] + local, output_dim[axis]) for axis in range(3))
+    brick_voxels = voxel[ii[:, :, None, None], jj[:, None, :, None], kk[:, None, None, :]]
+
+    return brick_origins, brick_voxels
+
+
+def classify_bricks(brick_origins, brick_voxels, threshold, grid_shape):
+    """finds the crossed cells of gathered bricks (see gather_bricks), returns (flat cell indices, cube indices)"""
+
+    # compute the cube indices of all the bricks at once
+    size = brick_voxels.shape[1] - 1
+    output_dim = np.array(grid_shape) - 1
+    cube_idx = np.zeros((len(brick_origins), size, size, size), dtype=np.uint8)
+    inside = brick_voxels > threshold
+    for bit, (di, dj, dk) in enumerate(VERTEX_OFFSETS):
+        cube_idx |= inside[:, di:di + size, dj:dj + size, dk:dk + size].view(np.uint8) << np.uint8(bit)
+
+    # keep the crossed cells that are inside the grid, in grid order
+    brick, li, lj, lk = np.nonzero((cube_idx != 0) & (cube_idx != 255))
+    cell_ijk = brick_origins[brick] + np.stack([li, lj, lk], axis=1)
+    in_grid = (cell_ijk < output_dim).all(axis=1)
+    cells = np.ravel_multi_index(tuple(cell_ijk[in_grid].T), output_dim)
+    cases = cube_idx[brick, li, lj, lk][in_grid]
+
+    order = np.argsort(cells)
+    return cells[order], cases[order]
+
+
+def gather_triangle_edges(cells, cases):
+    """gathers the edges of the triangles of the active cells, returns (cell index of each triangle, (T, 3) edges)"""
+
+    counts = TRI_COUNT[cases].astype(np.intp)
+
+    # one row per triangle, following the order of the cells and of the lookup table
+    tri_cell = np.repeat(np.arange(len(cells)), counts)
+    tri_slot = np.arange(len(tri_cell)) - np.repeat(np.cumsum(counts) - counts, counts)
+    edges = TRI_TABLE[cases[tri_cell][:, None], 3*tri_slot[:, None] + np.arange(3)]
+
+    return cells[tri_cell], edges.astype(np.intp)
+
+
+def voxel_gradients(voxel, i, j, k, spacing=(1.0, 1.0, 1.0)):
+    """central-difference gradients of the field at the voxels (i, j, k), one-sided on the faces of the grid
+
+    same values as np.gradient(voxel, *spacing) at those voxels, returns an (N, 3) float64 array
+    along the (i, j, k) axes
+    """
+
+    index = (i, j, k)
+    gradients = np.empty((len(i), 3))
+    for axis in range(3):
+        before = np.maximum(index[axis] - 1, 0)
+        after = np.minimum(index[axis] + 1, voxel.shape[axis] - 1)
+        before_val = voxel[index[:axis] + (before,) + index[axis + 1:]].astype(np.float64)
+        after_val = voxel[index[:axis] + (after,) + index[axis + 1:]].astype(np.float64)
+        gradients[:, axis] = (after_val - before_val)/((after - before)*float(spacing[axis]))
+
+    return gradients
+
+
+def unit_vectors(vectors):
+    """normalizes the rows of an (N, 3) array, zero rows stay zero"""
+
+    length = np.sqrt(vectors[:, 0]*vectors[:, 0] + vectors[:, 1]*vectors[:, 1] + vectors[:, 2]*vectors[:, 2])
+    return vectors/np.where(length > 0, length, 1.0)[:, None]
+
+
+def smooth_facet_normals(vertex_normals):
+    """unit facet normals of (T, 3, 3) per-corner normals, the mean direction of the corners"""
+    return unit_vectors(vertex_normals[:, 0] + vertex_normals[:, 1] + vertex_normals[:, 2])
+
+
+def interpolate_edges(voxel, threshold, cells, edges, origin=(0, 0, 0), grid_shape=None, interpolate=True,
+                      spacing=(1.0, 1.0, 1.0), normals=False):
+    """computes the (x, y, z) coordinates of the crossing point on every (cell, edge) pair in one batch
+
+    voxel may be a block of a larger grid (of shape grid_shape) starting at the voxel index origin,
+    in which case cells are flat cell indices of the block and the coordinates are those of the grid.
+    If interpolate is False, the points are placed at the middle of the edges, like 'marching_cubes_naive'.
+    spacing is the (i, j, k) size of the voxels, e.g. (1, 1, slice thickness) for a CT volume.
+
+    if normals is set, returns (coordinates, normals): the unit normals of the surface at the points,
+    interpolated along the edges from the gradients of the field at their ends (see voxel_gradients)
+    """
+
+    grid_shape = voxel.shape if grid_shape is None else grid_shape
+    i, j, k = np.unravel_index(cells, np.array(voxel.shape) - 1)
+
+    start_offset = VERTEX_OFFSETS[EDGE_VERTICES[edges, 0]]
+    end_offset = VERTEX_OFFSETS[EDGE_VERTICES[edges, 1]]
+    start = i + start_offset[:, 0], j + start_offset[:, 1], k + start_offset[:, 2]
+    end = i + end_offset[:, 0], j + end_offset[:, 1], k + end_offset[:, 2]
+
+    if not interpolate:
+        # same placement and translation as 'marching_cubes_naive' (delta_y = output_dim[0] - i)
+        xyz = EDGE_ORIGIN[edges] + 0.5*EDGE_DIRECTION[edges]
+        xyz[:, 0] += j + origin[1]
+        xyz[:, 1] += grid_shape[0] - 1 - (i + origin[0])
+        xyz[:, 2] -= k + origin[2]
+        xyz *= np.asarray(spacing, dtype=np.float64)[[1, 0, 2]]
+        if normals:
+            return xyz, edge_normals(voxel, start, end, 0.5, spacing, CUBE_NORMAL_AXES)
+        return xyz
+
+    # get the values of the start and end vertex points of every edge
+    start_val = voxel[start].astype(np.float64)
+    end_val = voxel[end].astype(np.float64)
+
+    # subtract by the threshold (to enable crossing) and compute the interpolated point
+    start_val -= threshold
+    end_val -= threshold
+    alpha = start_val/(start_val - end_val)
+
+    # compute the unit square coordinates and apply translation (delta_y = output_dim[0] - i - 1)
+    xyz = EDGE_ORIGIN[edges] + alpha[:, None]*EDGE_DIRECTION[edges]
+    xyz[:, 0] += j + origin[1]
+    xyz[:, 1] += grid_shape[0] - 2 - (i + origin[0])
+    xyz[:, 2] -= k + origin[2]
+
+    # scale the (x, y, z) axes, which are along the (j, i, k) voxel axes
+    xyz *= np.asarray(spacing, dtype=np.float64)[[1, 0, 2]]
+
+    if normals:
+        return xyz, edge_normals(voxel, start, end, alpha, spacing, CUBE_NORMAL_AXES)
+    return xyz
+
+
+def edge_normals(voxel, start, end, alpha, spacing, axes):
+    """unit normals at the crossing points, from the gradients at the (i, j, k) voxels of the start and end of the edges
+
+    axes are the (voxel axis, sign) of the (x, y, z) axes of the mesh, e.g. CUBE_NORMAL_AXES
+    """
+
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=np.float64), start[0].shape)[:, None]
+    gradients = voxel_gradients(voxel, *start, spacing)*(1 - alpha) + voxel_gradients(voxel, *end, spacing)*alpha
+    axis, sign = axes
+    return unit_vectors(gradients[:, axis]*sign)
+
+
+def edge_keys(voxel, cells, edges, origin=(0, 0, 0), grid_shape=None):
+    """global edge ID (see 'indexed_mesh.py') of every (cell, edge) pair"""
+
+    grid_shape = voxel.shape if grid_shape is None else grid_shape
+    i, j, k = np.unravel_index(cells, np.array(voxel.shape) - 1)
+    stride_i, stride_j, stride_k = key_strides(grid_shape)
+
+    base_keys = (i + origin[0])*stride_i + (j + origin[1])*stride_j + (k + origin[2])*stride_k
+    return base_keys + cube_edge_key_offsets(grid_shape)[edges]
+
+
+def check_normals(normals, indexed):
+    """the normals are written into the STL records of a triangle soup, there are none for an indexed mesh"""
+    if normals and indexed:
+        raise ValueError("normals are only computed for triangle soups (indexed=False)")
+
+
+def extract_block(voxel, threshold, origin=(0, 0, 0), grid_shape=None, indexed=False, interpolate=True, bricks=None,
+                  active=None, spacing=(1.0, 1.0, 1.0), normals=False, profiler=NULL_PROFILER):
+    """runs marching cubes on a block of the grid (see interpolate_edges)
+
+    returns a (T, 3, 3) float32 array of triangles, or if indexed is set, a (keys, vertices, faces)
+    tuple where keys are the global edge IDs of the vertices. bricks is an optional brick index
+    of the block used to skip empty space (see active_cells). active is an optional precomputed
+    (cells, cases) result of active_cells. spacing is the voxel size (see interpolate_edges).
+    With normals set, the smooth facet normals (see smooth_facet_normals) are written into the
+    records of the triangle buffer. profiler records the classify and interpolate stages (see 'profiling.py').
+    """
+
+    check_normals(normals, indexed)
+    if active is None:
+        active = active_cells(voxel, threshold, bricks, profiler)
+
+    with profiler.stage("interpolate"):
+        tri_cells, tri_edges = gather_triangle_edges(*active)
+        profiler.count("triangles", len(tri_cells))
+
+        # one (cell, edge) pair per (triangle, corner)
+        cells = np.repeat(tri_cells, 3)
+        edges = tri_edges.reshape(-1)
+
+        if indexed:
+            keys = edge_keys(voxel, cells, edges, origin, grid_shape)
+            first, vertex_idx = deduplicate_keys(keys)
+
+            # interpolate each shared vertex only once
+            vertices = interpolate_edges(voxel, threshold, cells[first], edges[first], origin, grid_shape, interpolate,
+                                         spacing).astype(np.float32)
+            faces = vertex_idx.reshape(-1, 3).astype(face_dtype(len(vertices)))
+            return keys[first], vertices, faces
+
+        # cast straight into a triangle buffer (see 'stl_writer.triangle_buffer')
+        triangles = triangle_buffer(len(tri_cells))
+        xyz = interpolate_edges(voxel, threshold, cells, edges, origin, grid_shape, interpolate, spacing, normals)
+        if normals:
+            xyz, vertex_normals = xyz
+            triangle_records(triangles)["normals"] = smooth_facet_normals(vertex_normals.reshape(-1, 3, 3))
+        triangles[:] = xyz.reshape(-1, 3, 3)
+        return triangles
+
+
+def marching_cubes_vectorized(voxel, threshold=0.0, indexed=False, interpolate=True, bricks=None, spacing=(1.0, 1.0, 1.0),
+                              active=None, backend="numpy", normals=False, profiler=NULL_PROFILER):
+    """returns an stl mesh, or a (vertices, faces) tuple if indexed is set
+
+    with interpolate=False, the output is the same as 'marching_cubes_naive'. spacing is the
+    (i, j, k) size of the voxels, so an anisotropic volume does not have to be resampled.
+    active is an optional precomputed result of active_cells (the grid is then not scanned).
+    backend is "numpy" or "numba" (see 'mc_numba.py'). normals sets the smooth facet normals of
+    the mesh (see extract_block). profiler records the stages (see 'profiling.py').
+    """
+
+    extract = extract_block
+    if backend != "numpy":
+        from mc_numba import block_extractor    # mc_numba imports this module
+        extract = block_extractor(backend)
+
+    if indexed:
+        _, vertices, faces = extract(voxel, threshold, indexed=True, interpolate=interpolate, bricks=bricks,
+                                     active=active, spacing=spacing, profiler=profiler)
+        return vertices, faces
+
+    triangles = extract(voxel, threshold, interpolate=interpolate, bricks=bricks, active=active, spacing=spacing,
+                        normals=normals, profiler=profiler)
+
+    with profiler.stage("assemble"):
+        final_mesh = triangles_to_mesh(triangles)
+
+    return final_mesh
+
+
+def marching_cubes_multi(voxel, thresholds, indexed=False, interpolate=True, bricks=None, extract=extract_block,
+                         spacing=(1.0, 1.0, 1.0), normals=False, profiler=NULL_PROFILER):
+    """extracts one isosurface per threshold, returns a list of stl meshes (or of (vertices, faces) tuples)
+
+    The brick index (built with the default brick size if not given) and the gathered voxels of
+    the bricks straddling any of the thresholds are shared by all the thresholds, so the volume
+    is only scanned once. extract is the block extractor (see 'marching_cubes_stream').
+    """
+
+    check_normals(normals, indexed)
+
+    if bricks is None:
+        bricks = BrickIndex(voxel)
+    elif bricks.shape != voxel.shape:
+        raise ValueError(f"brick index of shape {bricks.shape} does not match the voxel grid {voxel.shape}")
+
+    # gather the bricks that are active for at least one threshold
+    with profiler.stage("gather"):
+        brick_mask = np.zeros(bricks.brick_min.shape, dtype=bool)
+        for threshold in thresholds:
+            brick_mask |= bricks.active_bricks(threshold)
+        brick_origins, brick_voxels = gather_bricks(voxel, bricks, brick_mask)
+
+    results = []
+    for threshold in thresholds:
+        # the gathered bricks that are active for this threshold
+        with profiler.stage("classify"):
+            selected = bricks.active_bricks(threshold)[brick_mask]
+            active = classify_bricks(brick_origins[selected], brick_voxels[selected], threshold, voxel.shape)
+        # the bricks at the end of the grid have fewer cells, like the blocks of 'brick_active_cells'
+        origins = brick_origins[selected]
+        extents = np.minimum(origins + bricks.brick_size, np.array(voxel.shape) - 1) - origins
+        count_cells(profiler, int(extents.prod(axis=1).sum()), len(active[0]))
+
+        if indexed:
+            _, vertices, faces = extract(voxel, threshold, indexed=True, interpolate=interpolate, active=active,
+                                         spacing=spacing, profiler=profiler)
+            results.append((vertices, faces))
+            continue
+
+        triangles = extract(voxel, threshold, interpolate=interpolate, active=active, spacing=spacing, normals=normals,
+                            profiler=profiler)
+
+        with profiler.stage("assemble"):
+            final_mesh = triangles_to_mesh(triangles)
+        results.append(final_mesh)
+
+    return results
+
+
+def marching_cubes_stream(slices, threshold=0.0, indexed=False, interpolate=True, extract=extract_block,
+                          spacing=(1.0, 1.0, 1.0), profiler=NULL_PROFILER):
+    """runs marching cubes on a stream of 2D slices (stacked along the third axis, like 'load_ct_folder')
+
+    Only two adjacent slices are held at a time: the cells between them are extracted and yielded
+    as a chunk before the next slice is read. Yields (T, 3, 3) float32 triangle chunks, or if indexed
+    is set, (new vertices, faces) chunks where the faces index into all the vertices yielded so far
+    (the vertices on the slice shared with the previous pair are not repeated).
+
+    extract is the block extractor ('extract_block', or 'mt_vectorized.extract_tetra_block' for tetrahedra)
+    """
+
+    def parts():
+        prev_slice = None
+        for k, cur_slice in enumerate(slices):
+            if prev_slice is None:
+                prev_slice = cur_slice
+                continue
+
+            # cells between slices k - 1 and k (the depth of grid_shape is not used)
+            pair = np.stack([prev_slice, cur_slice], axis=2)
+            prev_slice = cur_slice
+
+            if not indexed:
+                yield extract(pair, threshold, origin=(0, 0, k - 1), grid_shape=pair.shape, interpolate=interpolate,
+                              spacing=spacing, profiler=profiler)
+                continue
+
+            keys, vertices, faces = extract(pair, threshold, origin=(0, 0, k - 1), grid_shape=pair.shape,
+                                            indexed=True, interpolate=interpolate, spacing=spacing, profiler=profiler)
+            yield keys, vertices, faces, key_plane(keys, pair.shape) == k
+
+    if not indexed:
+        yield from parts()
+        return
+    yield from chain_indexed_parts(parts())
+
+
+def chain_indexed_parts(parts):
+    """chains the indexed meshes of consecutive slabs of the grid into (new vertices, faces) chunks
+
+    parts yields the (keys, vertices, faces) of each slab and a mask of its vertices lying on the
+    slice it shares with the next slab. The faces of a chunk index into all the vertices yielded so
+    far: the vertices of a slab found on the shared slice of the previous slab are not repeated.
+    """
+
+    n_vertices = 0
+    shared_keys = np.empty(0, dtype=np.int64)
+    shared_index = np.empty(0, dtype=np.int64)
+
+    for keys, vertices, faces, top in parts:
+        # reuse the vertices lying on the slice shared with the previous slab, which were yielded with it
+        pos = np.searchsorted(shared_keys, keys).clip(max=max(len(shared_keys) - 1, 0))
+        found = shared_keys[pos] == keys if len(shared_keys) else np.zeros(len(keys), dtype=bool)
+
+        global_index = np.empty(len(keys), dtype=np.int64)
+        global_index[found] = shared_index[pos[found]]
+        global_index[~found] = n_vertices + np.arange(len(keys) - found.sum())
+        n_vertices += len(keys) - found.sum()
+
+        # remember the vertices lying on the slice shared with the next slab
+        order = np.argsort(keys[top])
+        shared_keys = keys[top][order]
+        shared_index = global_index[top][order]
+
+        yield vertices[~found], global_index[faces]
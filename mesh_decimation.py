@@ -0,0 +1,360 @@
+"""
+Quadric error decimation of indexed meshes.
+
+The meshes of Marching Cubes have about 2 triangles per voxel of surface, far more than a
+viewer needs on smooth anatomy. 'decimate_mesh' collapses edges (Garland and Heckbert, "Surface
+Simplification Using Quadric Error Metrics") until the mesh has the target number of faces or
+the next collapse would move the surface by more than the error bound:
+    every vertex starts with the quadric of the planes of its faces (the sum of the squared
+    distances to those planes), the edges of open boundaries add a plane perpendicular to
+    their face so the boundaries are kept in place
+    the cost of an edge is the quadric error of the position minimizing the sum of the
+    quadrics of its two vertices, the cheapest edge is collapsed first (a heap of the edges,
+    the entries of the edges that changed are skipped when they are popped)
+    a collapse is rejected if it would make the mesh non-manifold or flip a face
+
+The quadrics and the initial edge costs are computed for all the vertices and edges at once with
+NumPy, only the collapse loop runs in Python. To bound its memory, the faces are split into slabs
+of at most block_faces faces along the longest axis of the mesh, and the slabs are decimated one
+at a time with the vertices they share with the other slabs locked (their edges are never
+collapsed, the link condition needs all the faces of both ends). A second pass on slabs shifted
+by half a slab decimates the seams left by the first one. The mesh itself is kept in arrays.
+
+    vertices, faces = marching_cubes_vectorized(volume, 100, indexed=True)
+    vertices, faces = decimate_mesh(vertices, faces, target_faces=len(faces)//10)
+"""
+
+import heapq
+import warnings
+
+import numpy as np
+
+from indexed_mesh import face_dtype
+from profiling import NULL_PROFILER
+
+
+# weight of the planes that keep the open boundaries in place
+BOUNDARY_WEIGHT = 10.0
+
+# (row, column) of the 10 coefficients of a symmetric 4x4 quadric, in the order of the flat quadrics
+QUADRIC_INDICES = [(0, 0), (0, 1), (0, 2), (0, 3), (1, 1), (1, 2), (1, 3), (2, 2), (2, 3), (3, 3)]
+
+
+def plane_quadrics(planes):
+    """(N, 10) flat quadrics of (N, 4) planes (a, b, c, d) with a unit normal"""
+    return np.stack([planes[:, r]*planes[:, c] for r, c in QUADRIC_INDICES], axis=1)
+
+
+def edge_keys(start, end, n_vertices):
+    """key of the undirected edges (start, end)"""
+    return np.minimum(start, end).astype(np.int64)*n_vertices + np.maximum(start, end)
+
+
+def _accumulate(vertex_ids, quadrics, n_vertices):
+    """sums the (N, 10) quadrics per vertex"""
+    return np.stack([np.bincount(vertex_ids, quadrics[:, c], n_vertices) for c in range(10)], axis=1)
+
+
+def vertex_quadrics(vertices, faces):
+    """(V, 10) quadric of every vertex: the planes of its faces, and the boundary planes of its boundary edges"""
+
+    corners = vertices[faces].astype(np.float64)
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    normals /= np.maximum(lengths, 1e-30)[:, None]
+    planes = np.concatenate([normals, -np.einsum("ij,ij->i", normals, corners[:, 0])[:, None]], axis=1)
+
+    quadrics = _accumulate(faces.ravel(), np.repeat(plane_quadrics(planes), 3, axis=0), len(vertices))
+
+    # the edges used by a single face are on a boundary
+    start = faces.ravel()
+    end = faces[:, [1, 2, 0]].ravel()
+    _, inverse, counts = np.unique(edge_keys(start, end, len(vertices)), return_inverse=True, return_counts=True)
+    boundary = counts[inverse] == 1
+    if boundary.any():
+        face = np.repeat(np.arange(len(faces)), 3)[boundary]
+        start, end = start[boundary], end[boundary]
+        p0, p1 = vertices[start].astype(np.float64), vertices[end].astype(np.float64)
+        normals = np.cross(p1 - p0, planes[face, :3])
+        normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-30)[:, None]
+        boundary_planes = np.concatenate([normals, -np.einsum("ij,ij->i", normals, p0)[:, None]], axis=1)
+        boundary_quadrics = BOUNDARY_WEIGHT*plane_quadrics(boundary_planes)
+        quadrics += _accumulate(np.concatenate([start, end]), np.concatenate([boundary_quadrics, boundary_quadrics]),
+                                len(vertices))
+
+    return quadrics
+
+
+def quadric_error(q, x, y, z):
+    """error of the flat quadric q at the point (x, y, z) (floats, or arrays with q of shape (10, N))"""
+    return (q[0]*x*x + 2*q[1]*x*y + 2*q[2]*x*z + 2*q[3]*x + q[4]*y*y + 2*q[5]*y*z + 2*q[6]*y
+            + q[7]*z*z + 2*q[8]*z + q[9])
+
+
+def collapse_cost(q, pu, pv):
+    """(error, x, y, z) of the point minimizing the flat quadric q, or of the best of the edge ends and midpoint
+    if the quadric is (nearly) singular (flat or cylindric surface around the edge)"""
+
+    aa, ab, ac, ad, bb, bc, bd, cc, cd, _ = q
+    m0, m1, m2 = bb*cc - bc*bc, ab*cc - bc*ac, ab*bc - bb*ac
+    det = aa*m0 - ab*m1 + ac*m2
+    trace = aa + bb + cc
+    if abs(det) > 1e-3*trace*trace*trace:
+        x = (-ad*m0 + ab*(bd*cc - bc*cd) - ac*(bd*bc - bb*cd))/det
+        y = (aa*(-bd*cc + cd*bc) + ad*m1 + ac*(ab*cd - bd*ac))/det
+        z = (aa*(-bb*cd + bc*bd) - ab*(-ab*cd + bd*ac) - ad*m2)/det
+        return quadric_error(q, x, y, z), x, y, z
+
+    x, y, z = pu
+    best = (quadric_error(q, x, y, z), x, y, z)
+    x, y, z = pv
+    error = quadric_error(q, x, y, z)
+    if error < best[0]:
+        best = (error, x, y, z)
+    x, y, z = (pu[0] + x)*0.5, (pu[1] + y)*0.5, (pu[2] + z)*0.5
+    error = quadric_error(q, x, y, z)
+    if error < best[0]:
+        best = (error, x, y, z)
+    return best
+
+
+def _edge_costs(positions, quadrics, keep, remove):
+    """(error, x, y, z) of the collapses of the edges into keep (vectorized 'collapse_cost')"""
+
+    q = quadrics[keep] + quadrics[remove]
+    pu, pv = positions[keep], positions[remove]
+    aa, ab, ac, ad, bb, bc, bd, cc, cd = q[:, :9].T
+    m0, m1, m2 = bb*cc - bc*bc, ab*cc - bc*ac, ab*bc - bb*ac
+    det = aa*m0 - ab*m1 + ac*m2
+    trace = aa + bb + cc
+    regular = np.abs(det) > 1e-3*trace**3
+    with np.errstate(divide="ignore", invalid="ignore"):
+        optimal = np.stack([(-ad*m0 + ab*(bd*cc - bc*cd) - ac*(bd*bc - bb*cd))/det,
+                            (aa*(-bd*cc + cd*bc) + ad*m1 + ac*(ab*cd - bd*ac))/det,
+                            (aa*(-bb*cd + bc*bd) - ab*(-ab*cd + bd*ac) - ad*m2)/det], axis=1)
+
+    # best of the ends and the midpoint otherwise
+    candidates = np.stack([pu, pv, (pu + pv)*0.5])
+    errors = np.stack([quadric_error(q.T, *c.T) for c in candidates])
+    best = errors.argmin(axis=0)
+    position = np.where(regular[:, None], optimal, candidates[best, np.arange(len(q))])
+    return quadric_error(q.T, *position.T), position
+
+
+def initial_collapses(positions, quadrics, faces, locked):
+    """(error, keep, remove, position) of the collapse of every edge of the faces
+
+    the edges of the locked vertices are left out: the faces of a locked vertex are not all in the
+    block, so the link condition could not be checked for it
+    """
+
+    n = len(positions)
+    keys = np.unique(edge_keys(faces.ravel(), faces[:, [1, 2, 0]].ravel(), n))
+    edges = np.stack([keys // n, keys % n], axis=1)
+    edges = edges[~(locked[edges[:, 0]] | locked[edges[:, 1]])]
+    errors, position = _edge_costs(positions, quadrics, edges[:, 0], edges[:, 1])
+    return errors, edges[:, 0].copy(), edges[:, 1].copy(), position
+
+
+def face_normals(positions, faces):
+    """(F, 3) unnormalized normals of the faces"""
+    corners = positions[faces]
+    return np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+
+def collapse_edges(positions, quadrics, faces, locked, normals, collapses, n_remove, max_cost):
+    """collapses edges of the mesh until n_remove faces are removed, or until the next edge costs more than max_cost
+
+    normals are the face normals ('face_normals') and collapses the result of 'initial_collapses'.
+    Returns (positions, quadrics, faces) where the faces are the faces left (in order, with the
+    same vertex indices).
+    """
+
+    n_vertices = len(positions)
+    vertex_faces = [set() for _ in range(n_vertices)]
+    for f, face in enumerate(faces.tolist()):
+        for v in face:
+            vertex_faces[v].add(f)
+
+    # heap of (error, keep, remove, keep version, remove version, x, y, z)
+    errors, keep, remove, position = collapses
+    zeros = [0]*len(errors)
+    heap = list(zip(errors.tolist(), keep.tolist(), remove.tolist(), zeros, zeros, *position.T.tolist()))
+    heapq.heapify(heap)
+
+    positions = positions.tolist()
+    normals = normals.tolist()
+    quadrics = quadrics.tolist()
+    faces = faces.tolist()
+    locked = locked.tolist()
+    alive = [True]*len(faces)
+    version = [0]*n_vertices
+    removed = 0
+
+    while heap and removed < n_remove:
+        error, keep, other, keep_version, other_version, x, y, z = heapq.heappop(heap)
+        if error > max_cost:
+            break
+        if version[keep] != keep_version or version[other] != other_version:
+            continue    # an end moved (or was removed) since the edge was pushed
+
+        # link condition: the ends may only share the neighbors of the faces of the edge
+        keep_faces, other_faces = vertex_faces[keep], vertex_faces[other]
+        shared = keep_faces & other_faces
+        if not shared:
+            continue
+        keep_ring = {v for f in keep_faces for v in faces[f]}
+        other_ring = {v for f in other_faces for v in faces[f]}
+        if len(keep_ring & other_ring) != len(shared) + 2:
+            continue
+
+        # new normals of the faces around the edge, none may flip (or become degenerate)
+        moved = []
+        for f in (keep_faces | other_faces) - shared:
+            (ax, ay, az), (bx, by, bz), (cx, cy, cz) = ((x, y, z) if v == keep or v == other else positions[v]
+                                                        for v in faces[f])
+            ux, uy, uz, wx, wy, wz = bx - ax, by - ay, bz - az, cx - ax, cy - ay, cz - az
+            n = [uy*wz - uz*wy, uz*wx - ux*wz, ux*wy - uy*wx]
+            ox, oy, oz = normals[f]
+            if n[0]*ox + n[1]*oy + n[2]*oz <= 0 and (ox or oy or oz):
+                break
+            moved.append((f, n))
+        else:
+            # collapse other into keep
+            for f in shared:
+                alive[f] = False
+                for v in faces[f]:
+                    vertex_faces[v].discard(f)
+            for f in other_faces:
+                face = faces[f]
+                face[face.index(other)] = keep
+            keep_faces |= other_faces
+            vertex_faces[other] = set()
+            for f, n in moved:
+                normals[f] = n
+            positions[keep] = [x, y, z]
+            q = quadrics[keep] = [a + b for a, b in zip(quadrics[keep], quadrics[other])]
+            version[keep] += 1
+            version[other] = -1
+            removed += len(shared)
+
+            # the edges of keep changed, push them again (never the edges of the locked vertices)
+            keep_version = version[keep]
+            p = positions[keep]
+            for v in keep_ring | other_ring:
+                if v == keep or v == other or locked[v]:
+                    continue
+                qv = [a + b for a, b in zip(q, quadrics[v])]
+                error, px, py, pz = collapse_cost(qv, p, positions[v])
+                heapq.heappush(heap, (error, keep, v, keep_version, version[v], px, py, pz))
+
+    faces = np.array([face for face, a in zip(faces, alive) if a], dtype=np.int64).reshape(-1, 3)
+    return np.array(positions), np.array(quadrics), faces
+
+
+def _slabs(vertices, faces, block_faces, shift):
+    """splits the faces into slabs of at most block_faces faces along the longest axis, returns arrays of face indices"""
+
+    if len(faces) <= block_faces:
+        return [np.arange(len(faces))]
+    centroids = vertices[faces].mean(axis=1)
+    axis = np.ptp(centroids, axis=0).argmax() if len(faces) else 0
+    order = np.argsort(centroids[:, axis], kind="stable")
+    bounds = list(range(int(shift*block_faces), len(faces), block_faces))
+    return [block for block in np.split(order, bounds) if len(block)]
+
+
+def edge_collapser(backend="numpy"):
+    """collapse loop of a backend ("numpy" or "numba"), numba falls back to numpy if it is not installed"""
+
+    if backend == "numpy":
+        return collapse_edges
+
+    # numba is only imported by the numba backend
+    from mc_numba import BACKENDS, NUMBA_AVAILABLE, collapse_edges_numba
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+
+    if backend == "numba" and not NUMBA_AVAILABLE:
+        warnings.warn("numba is not installed, falling back to the numpy backend")
+        backend = "numpy"
+
+    return collapse_edges_numba if backend == "numba" else collapse_edges
+
+
+def decimate_mesh(vertices, faces, target_faces=None, max_error=None, block_faces=200_000, max_passes=4,
+                  backend="numpy", profiler=NULL_PROFILER):
+    """decimates an indexed mesh to about target_faces faces, or while the collapses move the surface by at most max_error
+
+    max_error is a distance in the units of the vertices (the square root of the quadric error).
+    Both can be given, the decimation stops at the first limit reached. block_faces bounds the
+    number of faces decimated at once, the slabs are shifted by half a slab between the passes
+    (see the module docstring). backend is "numpy" (Python collapse loop) or "numba", both give
+    the same mesh. Returns (vertices, faces).
+    """
+
+    if target_faces is None and max_error is None:
+        raise ValueError("a target face count or an error bound is required")
+    target_faces = 0 if target_faces is None else target_faces
+    max_cost = np.inf if max_error is None else max_error**2
+    collapse = edge_collapser(backend)
+
+    positions = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    with profiler.stage("quadrics"):
+        quadrics = vertex_quadrics(positions, faces)
+    profiler.count("faces_before", len(faces))
+
+    with profiler.stage("decimate"):
+        alive = np.ones(len(faces), dtype=bool)
+        n_alive = len(faces)
+        for n_pass in range(max_passes):
+            if n_alive <= target_faces:
+                break
+            n_start = n_alive
+            alive_idx = np.flatnonzero(alive)
+            uses = np.bincount(faces[alive].ravel(), minlength=len(positions))
+            for block in _slabs(positions, faces[alive], block_faces, 0.5*(n_pass % 2)):
+                block = alive_idx[block]
+
+                # the vertices of the block, locked if a face of another block uses them
+                ids, local = np.unique(faces[block].ravel(), return_inverse=True)
+                local = local.reshape(-1, 3)
+                locked = np.bincount(local.ravel(), minlength=len(ids)) < uses[ids]
+
+                # remove the share of the faces left to remove of the block
+                n_remove = int(np.ceil((n_alive - target_faces)*len(block)/n_alive)) if target_faces else len(block)
+                block_positions, quadrics[ids], block_left = collapse(
+                    positions[ids], quadrics[ids], local, locked, face_normals(positions[ids], local),
+                    initial_collapses(positions[ids], quadrics[ids], local, locked), n_remove, max_cost)
+
+                positions[ids] = block_positions
+                alive[block[len(block_left):]] = False
+                faces[block[:len(block_left)]] = ids[block_left]
+                n_alive -= len(block) - len(block_left)
+
+            # a single slab is decimated at once, the next passes only decimate the seams of the slabs
+            if len(alive_idx) <= block_faces or n_alive > n_start - 0.01*(n_start - target_faces):
+                break
+
+        # keep the used vertices
+        used, faces = np.unique(faces[alive].ravel(), return_inverse=True)
+        faces = faces.reshape(-1, 3).astype(face_dtype(len(used)))
+        vertices = positions[used].astype(np.float32)
+    profiler.count("faces_after", len(faces))
+
+    return vertices, faces
+
+
+def decimate_chunks(chunks, target_faces=None, max_error=None, backend="numpy", profiler=NULL_PROFILER):
+    """decimates a stream of (new vertices, faces) chunks (see 'indexed_mesh.save_obj_chunks') as one mesh
+
+    a target_faces below 1 is a fraction of the faces (0.1 for a 10x smaller mesh). Returns (vertices, faces).
+    """
+
+    chunks = list(chunks)
+    vertices = np.concatenate([vertices for vertices, _ in chunks])
+    faces = np.concatenate([faces.astype(np.int64) for _, faces in chunks])
+    if target_faces is not None and target_faces < 1:
+        target_faces = int(target_faces*len(faces))
+    return decimate_mesh(vertices, faces, target_faces, max_error, backend=backend, profiler=profiler)
@@ -0,0 +1,159 @@
+"""
+This is a vectorized implementation of the Marching Tetrahedra algorithm with interpolation.
+It produces the same triangles (in the same order) as 'marching_tetrahedra.py', but instead of
+looping over every cell and its 6 tetrahedra in Python:
+
+1. the cube indices of all the cells are computed at once (same as 'mc_vectorized.py') and the
+   lookup indices of the (active cells x 6) tetrahedra are read from the CUBE_TO_TETRA_CASE table,
+2. the triangle edges are gathered from the flat tetrahedra lookup table,
+3. every crossing is interpolated in a single pass, with the (tetra, edge) -> endpoint tables.
+"""
+
+import numpy as np
+
+from stl_writer import triangle_buffer, triangle_records, triangles_to_mesh
+from mc_lookup_table import VERTEX_OFFSETS
+from tetrahedra_lookup_table import TETRA_TRI_TABLE, TETRA_TRI_COUNT, TETRA_EDGE_CUBE_VERTICES, \
+    TETRA_EDGE_ORIGIN, TETRA_EDGE_DIRECTION, CUBE_TO_TETRA_CASE
+from mc_vectorized import active_cells, edge_normals, smooth_facet_normals, check_normals
+from indexed_mesh import key_strides, tetra_edge_key_offsets, deduplicate_keys, face_dtype
+from profiling import NULL_PROFILER
+
+
+# voxel axis and sign of the (x, y, z) axes of the mesh (x = j, y = k, z = -i, see 'mc_vectorized.CUBE_NORMAL_AXES')
+TETRA_NORMAL_AXES = ([1, 2, 0], np.array([1.0, 1.0, -1.0]))
+
+
+def gather_tetra_triangle_edges(cells, cases):
+    """gathers the edges of the triangles of the active cells (cases are their cube indices)
+
+    returns (cell index of each triangle, tetra index of each triangle, (T, 3) edges)
+    """
+
+    tetra_cases = CUBE_TO_TETRA_CASE[cases].reshape(-1)     # (cells x 6)
+    counts = TETRA_TRI_COUNT[tetra_cases].astype(np.intp)
+
+    # one row per triangle, following the order of the cells, of the tetrahedra and of the lookup table
+    tri_tetra = np.repeat(np.arange(len(tetra_cases)), counts)
+    tri_slot = np.arange(len(tri_tetra)) - np.repeat(np.cumsum(counts) - counts, counts)
+    edges = TETRA_TRI_TABLE[tetra_cases[tri_tetra][:, None], 3*tri_slot[:, None] + np.arange(3)]
+
+    return cells[tri_tetra // 6], tri_tetra % 6, edges.astype(np.intp)
+
+
+def interpolate_tetra_edges(voxel, threshold, cells, tetras, edges, origin=(0, 0, 0), grid_shape=None, interpolate=True,
+                            spacing=(1.0, 1.0, 1.0), normals=False):
+    """computes the (x, y, z) coordinates of the crossing point on every (cell, tetra, edge) in one batch
+
+    see 'mc_vectorized.interpolate_edges' for origin, grid_shape, spacing and normals. If interpolate
+    is False, the points are placed at the middle of the edges.
+    """
+
+    grid_shape = voxel.shape if grid_shape is None else grid_shape
+    i, j, k = np.unravel_index(cells, np.array(voxel.shape) - 1)
+
+    start_offset = VERTEX_OFFSETS[TETRA_EDGE_CUBE_VERTICES[tetras, edges, 0]]
+    end_offset = VERTEX_OFFSETS[TETRA_EDGE_CUBE_VERTICES[tetras, edges, 1]]
+    start = i + start_offset[:, 0], j + start_offset[:, 1], k + start_offset[:, 2]
+    end = i + end_offset[:, 0], j + end_offset[:, 1], k + end_offset[:, 2]
+
+    if interpolate:
+        # get the values of the start and end vertex points of every edge
+        start_val = voxel[start].astype(np.float64)
+        end_val = voxel[end].astype(np.float64)
+
+        # inverse linear interpolation
+        alpha = (threshold - start_val)/(end_val - start_val)
+    else:
+        alpha = np.full(len(cells), 0.5)
+
+    # compute the unit tetrahedra coordinates and apply translation (delta_z = output_dim[0] - i - 1)
+    xyz = TETRA_EDGE_ORIGIN[tetras, edges] + alpha[:, None]*TETRA_EDGE_DIRECTION[tetras, edges]
+    xyz[:, 0] += j + origin[1]
+    xyz[:, 1] += k + origin[2]
+    xyz[:, 2] += grid_shape[0] - 2 - (i + origin[0])
+
+    # scale the (x, y, z) axes, which are along the (j, k, i) voxel axes
+    xyz *= np.asarray(spacing, dtype=np.float64)[[1, 2, 0]]
+
+    if normals:
+        return xyz, edge_normals(voxel, start, end, alpha, spacing, TETRA_NORMAL_AXES)
+    return xyz
+
+
+def tetra_edge_keys(voxel, cells, tetras, edges, origin=(0, 0, 0), grid_shape=None):
+    """global edge ID (see 'indexed_mesh.py') of every (cell, tetra, edge)"""
+
+    grid_shape = voxel.shape if grid_shape is None else grid_shape
+    i, j, k = np.unravel_index(cells, np.array(voxel.shape) - 1)
+    stride_i, stride_j, stride_k = key_strides(grid_shape)
+
+    base_keys = (i + origin[0])*stride_i + (j + origin[1])*stride_j + (k + origin[2])*stride_k
+    return base_keys + tetra_edge_key_offsets(grid_shape)[tetras, edges]
+
+
+def extract_tetra_block(voxel, threshold, origin=(0, 0, 0), grid_shape=None, indexed=False, interpolate=True, bricks=None,
+                        active=None, spacing=(1.0, 1.0, 1.0), normals=False, profiler=NULL_PROFILER):
+    """runs marching tetrahedra on a block of the grid (same interface as 'mc_vectorized.extract_block')"""
+
+    check_normals(normals, indexed)
+
+    # a tetrahedra is only crossed if its cube is crossed
+    if active is None:
+        active = active_cells(voxel, threshold, bricks, profiler)
+
+    with profiler.stage("interpolate"):
+        tri_cells, tri_tetras, tri_edges = gather_tetra_triangle_edges(*active)
+        profiler.count("triangles", len(tri_cells))
+
+        # one (cell, tetra, edge) per (triangle, corner)
+        cells = np.repeat(tri_cells, 3)
+        tetras = np.repeat(tri_tetras, 3)
+        edges = tri_edges.reshape(-1)
+
+        if indexed:
+            keys = tetra_edge_keys(voxel, cells, tetras, edges, origin, grid_shape)
+            first, vertex_idx = deduplicate_keys(keys)
+
+            # interpolate each shared vertex only once
+            vertices = interpolate_tetra_edges(voxel, threshold, cells[first], tetras[first], edges[first],
+                                               origin, grid_shape, interpolate, spacing).astype(np.float32)
+            faces = vertex_idx.reshape(-1, 3).astype(face_dtype(len(vertices)))
+            return keys[first], vertices, faces
+
+        # cast straight into a triangle buffer (see 'stl_writer.triangle_buffer')
+        triangles = triangle_buffer(len(tri_cells))
+        xyz = interpolate_tetra_edges(voxel, threshold, cells, tetras, edges, origin, grid_shape, interpolate, spacing,
+                                      normals)
+        if normals:
+            xyz, vertex_normals = xyz
+            triangle_records(triangles)["normals"] = smooth_facet_normals(vertex_normals.reshape(-1, 3, 3))
+        triangles[:] = xyz.reshape(-1, 3, 3)
+        return triangles
+
+
+def marching_tetrahedra_vectorized(voxel, threshold=0.0, indexed=False, bricks=None, spacing=(1.0, 1.0, 1.0), active=None,
+                                   backend="numpy", normals=False, profiler=NULL_PROFILER):
+    """returns an stl mesh, or a (vertices, faces) tuple if indexed is set
+
+    spacing is the (i, j, k) voxel size, active an optional result of 'mc_vectorized.active_cells'
+    and backend is "numpy" or "numba" (see 'mc_numba.py'). normals sets the smooth facet normals
+    (see 'mc_vectorized.extract_block'). profiler records the stages (see 'profiling.py').
+    """
+
+    extract = extract_tetra_block
+    if backend != "numpy":
+        from mc_numba import block_extractor    # mc_numba imports this module
+        extract = block_extractor(backend, tetra=True)
+
+    if indexed:
+        _, vertices, faces = extract(voxel, threshold, indexed=True, bricks=bricks, active=active, spacing=spacing,
+                                     profiler=profiler)
+        return vertices, faces
+
+    triangles = extract(voxel, threshold, bricks=bricks, active=active, spacing=spacing, normals=normals, profiler=profiler)
+
+    with profiler.stage("assemble"):
+        final_mesh = triangles_to_mesh(triangles)
+
+    return final_mesh
@@ -0,0 +1,111 @@
+"""
+Per-stage profiling of the load and extract pipeline.
+
+The loaders and the extractors take an optional profiler (profiler=) that records
+    stages: wall time of named stages, summed over all their calls (e.g. over the chunks of a stream)
+    counts: slices loaded, cells visited, active cells, empty cells skipped, triangles emitted
+    bytes: bytes produced by a stage, reported as the throughput of the stage
+The default NULL_PROFILER does nothing, so the profiling costs nothing when it is disabled.
+The counts are only recorded where they are known (e.g. the numba backend does not count the
+active cells when it scans the whole grid).
+
+    profiler = Profiler()
+    volume = load_ct_volume("./data/lower", profiler=profiler)
+    marching_cubes_vectorized(volume, 100, profiler=profiler)
+    profiler.print_report()
+
+A callback(kind, name, value) can be given to follow the events as they happen (kind is
+"stage" with the seconds of the call, "count" or "bytes").
+"""
+
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Profiler:
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+        self.bytes = {}
+        # the stages of the pipeline engine and the loader threads record into the same profiler
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """times the enclosed block as stage name"""
+
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.times[name] = self.times.get(name, 0.0) + seconds
+                self.calls[name] = self.calls.get(name, 0) + 1
+            if self.callback is not None:
+                self.callback("stage", name, seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + int(n)
+        if self.callback is not None:
+            self.callback("count", name, int(n))
+
+    def add_bytes(self, stage, n):
+        """records n bytes produced by the stage"""
+
+        with self.lock:
+            self.bytes[stage] = self.bytes.get(stage, 0) + int(n)
+        if self.callback is not None:
+            self.callback("bytes", stage, int(n))
+
+    def report(self):
+        """returns the stages (seconds, calls, bytes and MB/s) and the counts as a JSON serializable dict"""
+
+        with self.lock:
+            times, calls, counts, nbytes = dict(self.times), dict(self.calls), dict(self.counts), dict(self.bytes)
+
+        stages = {}
+        for name in times.keys() | nbytes.keys():
+            stage = {"seconds": times.get(name, 0.0), "calls": calls.get(name, 0)}
+            if name in nbytes:
+                stage["bytes"] = nbytes[name]
+                stage["mb_per_s"] = nbytes[name]/2**20/stage["seconds"] if stage["seconds"] > 0 else None
+            stages[name] = stage
+
+        return {"stages": dict(sorted(stages.items(), key=lambda item: -item[1]["seconds"])), "counts": counts}
+
+    def print_report(self, file=sys.stderr):
+        report = self.report()
+        print("Profile:", file=file)
+        for name, stage in report["stages"].items():
+            line = f"  {name:<12} {stage['seconds']:9.4f} s  {stage['calls']:6d} calls"
+            if stage.get("mb_per_s") is not None:
+                line += f"  {stage['bytes']/2**20:9.1f} MB  {stage['mb_per_s']:9.1f} MB/s"
+            print(line, file=file)
+        for name, value in report["counts"].items():
+            print(f"  {name:<14} {value:12d}", file=file)
+
+
+class NullProfiler:
+    """profiler that records nothing (the default of the loaders and extractors)"""
+
+    callback = None
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def count(self, name, n=1):
+        pass
+
+    def add_bytes(self, stage, n):
+        pass
+
+
+_NULL_STAGE = nullcontext()
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,185 @@
+"""
+Incremental binary STL writer.
+
+A binary STL file is an 80-byte header, the number of triangles (uint32) and one 50-byte
+record per triangle (normal and 3 vertices as float32, uint16 attribute). The writer emits
+the header with a placeholder count, appends the records chunk by chunk as the extractors
+produce them and patches the count when it is closed, so the whole mesh never has to be
+held in memory.
+
+With background=True, the records are written by a separate thread (behind a bounded queue),
+so writing to disk overlaps with the extraction of the next chunk.
+
+The extractors write their triangles into a 'triangle_buffer', the 'vectors' field of zeroed
+STL records, so the records can be wrapped as an stl mesh ('triangles_to_mesh') or written
+to the file without copying the triangles. The extractors can also fill the normals of the
+records with smooth normals (see 'mc_vectorized.extract_block'), which are then written as they are.
+"""
+
+import queue
+import struct
+import threading
+
+import numpy as np
+
+
+# same record layout as stl.mesh.Mesh.dtype
+STL_RECORD_DTYPE = np.dtype([
+    ("normals", "<f4", (3,)),
+    ("vectors", "<f4", (3, 3)),
+    ("attr", "<u2", (1,)),
+])
+
+MAX_TRIANGLES = 2**32 - 1
+
+# seconds between the checks for an error of the writer thread while the queue is full
+PUT_TIMEOUT = 0.1
+
+
+def facet_normals(triangles):
+    """(unnormalized) facet normals, computed the same way as numpy-stl does when saving"""
+    return np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+
+
+def triangle_buffer(n_triangles):
+    """(n_triangles, 3, 3) float32 array that is the 'vectors' field of zeroed STL records"""
+    return np.zeros(n_triangles, dtype=STL_RECORD_DTYPE)["vectors"]
+
+
+def triangle_records(triangles):
+    """returns the STL records of a 'triangle_buffer', or None if the triangles are not one"""
+
+    records = triangles.base
+    if isinstance(records, np.ndarray) and records.dtype == STL_RECORD_DTYPE and records.shape == triangles.shape[:1] \
+            and records["vectors"].__array_interface__ == triangles.__array_interface__:
+        return records
+    return None
+
+
+def triangles_to_mesh(triangles):
+    """wraps (T, 3, 3) triangles as an stl mesh, without copying them if they are a 'triangle_buffer'
+
+    the normals of a triangle buffer are kept, they are left at zero otherwise (numpy-stl computes
+    them when the mesh is saved)
+    """
+
+    from stl import mesh
+
+    records = triangle_records(triangles)
+    if records is None:
+        records = np.zeros(len(triangles), dtype=STL_RECORD_DTYPE)
+        records["vectors"] = triangles
+    return mesh.Mesh(records, calculate_normals=False)
+
+
+class StlWriter:
+
+    def __init__(self, filename, name="marching cubes", background=False, max_pending=8):
+        self.filename = filename
+        self.n_triangles = 0
+        self.file = open(filename, "wb")
+
+        # header (padded to 80 bytes) and a placeholder triangle count
+        header = name.encode("ascii", "replace")[:80].ljust(80, b" ")
+        self.file.write(header)
+        self.file.write(struct.pack("<I", 0))
+
+        self.pending = None
+        self.thread = None
+        self.error = None
+        if background:
+            self.pending = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._write_pending, daemon=True)
+            self.thread.start()
+
+    def write(self, triangles, normals=None):
+        """appends a (T, 3, 3) chunk of triangles
+
+        the normals are computed from the vertices if not given, unless the triangles are a triangle
+        buffer whose normals were set by the extractor
+        """
+
+        triangles = np.asarray(triangles, dtype=np.float32).reshape(-1, 3, 3)
+        if self.n_triangles + len(triangles) > MAX_TRIANGLES:
+            raise ValueError(f"binary STL files are limited to {MAX_TRIANGLES} triangles")
+
+        # the records of a triangle buffer are written as they are
+        records = triangle_records(triangles)
+        if records is None:
+            records = np.zeros(len(triangles), dtype=STL_RECORD_DTYPE)
+            records["vectors"] = triangles
+        if normals is not None:
+            records["normals"] = normals
+        elif not records["normals"].any():
+            records["normals"] = facet_normals(triangles)
+        self.n_triangles += len(records)
+
+        if self.pending is None:
+            records.tofile(self.file)
+        else:
+            self._put(records)
+
+    def write_indexed(self, vertices, faces, normals=None):
+        """appends the faces of an indexed mesh"""
+        self.write(vertices[faces], normals)
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        try:
+            if self.thread is not None:
+                if self.error is None:
+                    self._put(None)
+                self.thread.join()
+
+            # patch the triangle count
+            self.file.seek(80)
+            self.file.write(struct.pack("<I", self.n_triangles))
+        finally:
+            self.file.close()
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_pending(self):
+        # any error stops the thread, and is raised by the next write or close
+        try:
+            while True:
+                records = self.pending.get()
+                if records is None:
+                    return
+                records.tofile(self.file)
+        except BaseException as error:
+            self.error = error
+
+    def _put(self, records):
+        """queues records (or None to stop) for the writer thread, raises its error instead of waiting for a dead thread"""
+
+        while True:
+            self._check_error()
+            if not self.thread.is_alive():
+                raise RuntimeError(f"the writer thread of {self.filename} stopped")
+            try:
+                self.pending.put(records, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+def save_stl_chunks(filename, chunks, background=True):
+    """writes a stream of (T, 3, 3) triangle chunks to a binary STL file, returns the number of triangles"""
+
+    with StlWriter(filename, background=background) as writer:
+        for triangles in chunks:
+            writer.write(triangles)
+
+    return writer.n_triangles
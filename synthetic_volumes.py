@@ -0,0 +1,192 @@
+"""
+Synthetic volumes for benchmarks and stress tests.
+
+The volumes are sampled from signed distance functions (SDF, negative inside the objects). An
+SDF is a function of the (i, j, k) voxel coordinates given as open grids (like np.ogrid), so a
+primitive is evaluated with a few broadcast array operations instead of a Python loop over the
+voxels:
+    sphere, box, torus: solid primitives
+    gyroid: triply periodic surface, a dense worst case with a lot of surface per cell
+    noise: smooth random field (gaussian noise on a coarse grid, linearly upsampled)
+    union, intersection, difference: CSG combinations of SDFs
+
+'sample_volume' evaluates the SDF slab by slab along the first axis on a pool of threads, so
+the temporaries stay small, and stores -sdf (positive inside, the surface is the isosurface at
+threshold 0). With filename, the slabs are written to a memory-mapped .npy file, so volumes
+larger than memory can be generated and opened with np.load(mmap_mode='r').
+
+    center = (256, 256, 256)
+    volume = sample_volume((512, 512, 512), difference(box(center, 150), sphere(center, 180)))
+
+$ python synthetic_volumes.py --scene gyroid --size 1024 --output gyroid.npy
+"""
+
+import argparse
+import functools
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def sphere(center, radius):
+    ci, cj, ck = center
+
+    def sdf(i, j, k):
+        # only the last sum and the square root are full size
+        distance = np.sqrt((i - ci)**2 + (j - cj)**2 + (k - ck)**2)
+        distance -= radius
+        return distance
+    return sdf
+
+
+def box(center, half_size):
+    """axis-aligned box, half_size is a scalar or one half size per axis"""
+
+    half_size = np.broadcast_to(half_size, (3,))
+
+    def sdf(i, j, k):
+        qi, qj, qk = (np.abs(x - c) - h for x, c, h in zip((i, j, k), center, half_size))
+        outside = np.sqrt(np.maximum(qi, 0)**2 + np.maximum(qj, 0)**2 + np.maximum(qk, 0)**2)
+        inside = np.maximum(qi, qj)
+        inside = np.maximum(inside, qk)
+        np.minimum(inside, 0, out=inside)
+        outside += inside
+        return outside
+    return sdf
+
+
+def torus(center, major_radius, minor_radius):
+    """torus around the first axis"""
+
+    ci, cj, ck = center
+
+    def sdf(i, j, k):
+        ring = np.sqrt((j - cj)**2 + (k - ck)**2) - major_radius
+        distance = np.sqrt(ring**2 + (i - ci)**2)
+        distance -= minor_radius
+        return distance
+    return sdf
+
+
+def gyroid(period=32.0, thickness=0.3):
+    """sheet of the gyroid sin(x)cos(y) + sin(y)cos(z) + sin(z)cos(x) = 0, approximately thickness*period/(2 pi) thick"""
+
+    w = 2*np.pi/period
+
+    def sdf(i, j, k):
+        # the sines and cosines are only computed on the 1D coordinates
+        si, sj, sk = np.sin(w*i), np.sin(w*j), np.sin(w*k)
+        ci, cj, ck = np.cos(w*i), np.cos(w*j), np.cos(w*k)
+        return (np.abs(si*cj + sj*ck + sk*ci) - thickness)/w
+    return sdf
+
+
+def noise(shape, scale=8, seed=0):
+    """smooth random field over a volume of the shape: gaussian noise on a grid scale times coarser, linearly upsampled"""
+
+    coarse = np.random.default_rng(seed).standard_normal(tuple(-(-n // scale) + 1 for n in shape)).astype(np.float32)
+
+    def sdf(i, j, k):
+        # (lower coarse index, weight) of every coordinate of each axis
+        axes = []
+        for x, n in zip((i, j, k), coarse.shape):
+            position = np.asarray(x, dtype=np.float32).reshape(-1)/scale
+            lower = np.minimum(position.astype(int), n - 2)
+            axes.append((lower, position - lower))
+        (li, wi), (lj, wj), (lk, wk) = axes
+
+        # upsample one axis at a time, starting with the coarse rows the slab needs
+        lo = li.min()
+        values = coarse[lo:li.max() + 2]
+        values = values[:, :, lk]*(1 - wk) + values[:, :, lk + 1]*wk
+        values = values[:, lj]*(1 - wj)[:, None] + values[:, lj + 1]*wj[:, None]
+        return values[li - lo]*(1 - wi)[:, None, None] + values[li + 1 - lo]*wi[:, None, None]
+    return sdf
+
+
+def union(*sdfs):
+    def sdf(i, j, k):
+        return functools.reduce(np.minimum, (f(i, j, k) for f in sdfs))
+    return sdf
+
+
+def intersection(*sdfs):
+    def sdf(i, j, k):
+        return functools.reduce(np.maximum, (f(i, j, k) for f in sdfs))
+    return sdf
+
+
+def difference(base, *sdfs):
+    """base minus the union of the sdfs"""
+
+    subtracted = union(*sdfs)
+
+    def sdf(i, j, k):
+        return np.maximum(base(i, j, k), -subtracted(i, j, k))
+    return sdf
+
+
+def scene(name, shape):
+    """SDF of a test scene scaled to the volume shape: 'sphere', 'shapes', 'gyroid' or 'noise'"""
+
+    n = min(shape)
+    center = tuple(s/2 for s in shape)
+    if name == "sphere":
+        return sphere(center, n/4)
+    if name == "shapes":
+        # hollowed box and slotted sphere on opposite corners, torus in the center and small spheres on the other corners
+        corner = tuple(s/4 for s in shape)
+        opposite = tuple(3*s/4 for s in shape)
+        corners = [c for c in itertools.product(*((s/4, 3*s/4) for s in shape)) if c not in (corner, opposite)]
+        return union(difference(box(corner, n/8), sphere(corner, n/6.5)),
+                     difference(sphere(opposite, n/6), box(opposite, (n/24, n, n))),
+                     torus(center, n/5, n/16),
+                     *(sphere(c, n/10) for c in corners))
+    if name == "gyroid":
+        return intersection(gyroid(period=n/8), sphere(center, n/2 - 2))
+    if name == "noise":
+        return noise(shape)
+    raise ValueError(f"unknown scene {name!r}")
+
+
+def sample_volume(shape, sdf, dtype=np.float32, filename=None, slab_size=16, workers=None):
+    """samples -sdf on the (i, j, k) voxel grid of the shape, returns the volume (memory-mapped if filename is set)"""
+
+    shape = tuple(int(n) for n in shape)
+    if filename is None:
+        volume = np.empty(shape, dtype=dtype)
+    else:
+        volume = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+
+    j = np.arange(shape[1], dtype=np.float32).reshape(1, -1, 1)
+    k = np.arange(shape[2], dtype=np.float32).reshape(1, 1, -1)
+
+    def sample(start):
+        stop = min(start + slab_size, shape[0])
+        i = np.arange(start, stop, dtype=np.float32).reshape(-1, 1, 1)
+        volume[start:stop] = -sdf(i, j, k)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(sample, range(0, shape[0], slab_size)))
+
+    if filename is not None:
+        volume.flush()
+    return volume
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Synthetic volume generator")
+    parser.add_argument("--scene", type=str, help="Scene to sample", choices=["sphere", "shapes", "gyroid", "noise"], default="shapes")
+    parser.add_argument("--size", type=int, nargs="+", help="Size of the volume (one value for a cube, or three)", default=[256])
+    parser.add_argument("--dtype", type=str, help="Data type of the volume", default="float32")
+    parser.add_argument("--output", type=str, help="Path to output .npy file (memory-mapped while it is written)", default="volume.npy")
+    args = parser.parse_args()
+
+    shape = tuple(args.size)*3 if len(args.size) == 1 else tuple(args.size)
+    start = time.time()
+    volume = sample_volume(shape, scene(args.scene, shape), dtype=args.dtype, filename=args.output)
+    print(f"Sampled the {args.scene} scene on a {shape} grid in {time.time() - start:.2f} seconds")
+    print(f"Saved to {args.output} (threshold 0)")
@@ -0,0 +1,59 @@
+import os
+import sys
+
+# the modules of the repository are flat scripts at its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+import pytest
+
+
+def smooth_noise(shape, frequency=0.6, seed=0):
+    """smooth field in [-1, 1], a sum of random plane waves"""
+    rng = np.random.default_rng(seed)
+    points = np.indices(shape, dtype=np.float64).reshape(len(shape), -1)
+    waves = rng.normal(scale=frequency, size=(8, len(shape))) @ points + rng.uniform(0, 2*np.pi, size=(8, 1))
+    return np.sin(waves).mean(axis=0).reshape(shape)
+
+
+def write_ct_folder(folder, volume):
+    """writes the slices of a uint8 volume (third axis) as PNG images, like a CT folder"""
+    os.makedirs(folder, exist_ok=True)
+    for k in range(volume.shape[2]):
+        cv2.imwrite(os.path.join(folder, f"slice_{k:03d}.png"), volume[:, :, k])
+    return str(folder)
+
+
+def sorted_triangles(triangles):
+    """the triangles in a canonical order (the engines emit them in different orders)"""
+    rows = np.asarray(triangles).reshape(-1, 9)
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+def edge_face_counts(faces):
+    """number of faces of every edge of the mesh"""
+    edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    return counts
+
+
+def read_obj(path):
+    """(vertices, faces) of an OBJ file of triangles"""
+    vertices, faces = [], []
+    with open(path) as f:
+        for line in f:
+            kind, *values = line.split()
+            (vertices if kind == "v" else faces).append(values)
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3), np.array(faces, dtype=np.int64).reshape(-1, 3) - 1
+
+
+@pytest.fixture
+def ct_volume():
+    """smooth uint8 volume of 40x36x12 voxels with a surface around 128"""
+    return (128 + 100*smooth_noise((40, 36, 12), frequency=0.25, seed=1)).clip(0, 255).astype(np.uint8)
+
+
+@pytest.fixture
+def ct_folder(tmp_path, ct_volume):
+    return write_ct_folder(tmp_path / "images", ct_volume)
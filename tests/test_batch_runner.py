@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+import batch_runner
+from batch_runner import parse_job, run_job
+
+
+def test_failed_write_removes_partial_output(ct_folder, tmp_path, monkeypatch):
+    def failing_save(filename, chunks):
+        with open(filename, "wb") as f:
+            f.write(b"partial")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(batch_runner, "save_stl_chunks", failing_save)
+    output = tmp_path / "out" / "mesh.stl"
+    job = parse_job({"input": ct_folder, "output": str(output), "threshold": 128})
+    with pytest.raises(OSError, match="disk full"):
+        run_job(job, cache_dir=str(tmp_path / "cache"))
+
+    assert os.listdir(tmp_path / "out") == []
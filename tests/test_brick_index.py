@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from brick_index import BrickIndex
+from mc_vectorized import active_cells, marching_cubes_multi
+from profiling import Profiler
+from synthetic_volumes import scene, sample_volume
+
+
+@pytest.mark.parametrize("name", ["sphere", "shapes", "gyroid"])
+@pytest.mark.parametrize("brick_size", [4, 7, 32])
+def test_brick_skipping_classifies_like_full_scan(name, brick_size):
+    shape = (45, 38, 29)
+    volume = sample_volume(shape, scene(name, shape))
+    cells, cases = active_cells(volume, 0.0)
+    brick_cells, brick_cases = active_cells(volume, 0.0, bricks=BrickIndex(volume, brick_size))
+    np.testing.assert_array_equal(brick_cells, cells)
+    np.testing.assert_array_equal(brick_cases, cases)
+
+
+@pytest.mark.parametrize("brick_size", [4, 7, 32])
+def test_multi_threshold_counts_the_cells_of_each_threshold(brick_size):
+    shape = (45, 38, 29)
+    volume = sample_volume(shape, scene("shapes", shape))
+    bricks = BrickIndex(volume, brick_size)
+    thresholds = [-2.0, 0.0, 1.5]
+
+    # the bricks at the end of the grid are only counted with their cells inside the grid
+    single = Profiler()
+    for threshold in thresholds:
+        active_cells(volume, threshold, bricks, single)
+    multi = Profiler()
+    marching_cubes_multi(volume, thresholds, bricks=bricks, profiler=multi)
+    for name in ["cells_visited", "active_cells", "empty_skips"]:
+        assert multi.counts[name] == single.counts[name]
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from brick_volume import convert_ct_folder, marching_cubes_bricked
+from conftest import sorted_triangles
+from load_voxels import load_ct_volume
+from mc_vectorized import marching_cubes_vectorized
+
+
+@pytest.mark.parametrize("gaps", [1, 2.5])
+@pytest.mark.parametrize("threshold", [110, 128, 150])
+def test_bricked_matches_in_memory(ct_folder, tmp_path, gaps, threshold):
+    volume = convert_ct_folder(ct_folder, str(tmp_path / "bricks"), gaps, brick_size=8)
+    expected = marching_cubes_vectorized(load_ct_volume(ct_folder, gaps), threshold).vectors
+
+    chunks = list(marching_cubes_bricked(volume, threshold))
+    triangles = np.concatenate(chunks) if chunks else np.zeros((0, 3, 3), dtype=np.float32)
+    assert len(triangles) == len(expected)
+    np.testing.assert_array_equal(sorted_triangles(triangles), sorted_triangles(expected))
@@ -0,0 +1,14 @@
+import pytest
+
+from cli import main
+from marching_cubes_interp import marching_cubes_iterpolation
+
+
+@pytest.mark.parametrize("stats", [False, True])
+@pytest.mark.parametrize("options", [["--gaps", "1"], ["--gaps", "2.5"], ["--cache-dir", "cache"]])
+def test_stats_are_printed_on_request(ct_folder, tmp_path, monkeypatch, capsys, stats, options):
+    monkeypatch.chdir(tmp_path)
+    main("interp", marching_cubes_iterpolation,
+         ["--input", ct_folder, "--output", "mesh.stl", "--threshold", "128"] + options + ["--stats"]*stats)
+    assert ("Max value" in capsys.readouterr().out) == stats
+    assert (tmp_path / "mesh.stl").exists()
@@ -0,0 +1,26 @@
+from conftest import edge_face_counts
+from mc_vectorized import marching_cubes_vectorized
+from mesh_decimation import decimate_mesh
+from synthetic_volumes import scene, sample_volume
+
+
+def shapes_mesh(size=64):
+    shape = (size,)*3
+    return marching_cubes_vectorized(sample_volume(shape, scene("shapes", shape)), 0.0, indexed=True)
+
+
+def test_sliced_decimation_is_manifold():
+    vertices, faces = shapes_mesh()
+    assert (edge_face_counts(faces) == 2).all()
+
+    # small slabs, so that most of the collapses are next to a locked vertex
+    _, decimated = decimate_mesh(vertices, faces, target_faces=len(faces)//10, block_faces=2000)
+    assert len(decimated) < len(faces)//5
+    assert (edge_face_counts(decimated) == 2).all()
+
+
+def test_sliced_decimation_matches_single_slab_size():
+    vertices, faces = shapes_mesh()
+    _, single = decimate_mesh(vertices, faces, target_faces=len(faces)//4)
+    _, sliced = decimate_mesh(vertices, faces, target_faces=len(faces)//4, block_faces=3000)
+    assert abs(len(sliced) - len(single)) < 0.05*len(single)
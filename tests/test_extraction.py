@@ -0,0 +1,128 @@
+from functools import lru_cache, partial
+
+import numpy as np
+import pytest
+
+from conftest import smooth_noise, sorted_triangles
+from marching_cubes import marching_cubes_naive
+from marching_cubes_interp import marching_cubes_iterpolation
+from marching_tetrahedra import marching_tetrahedra
+from mc_vectorized import marching_cubes_vectorized, marching_cubes_stream, extract_block
+from mt_vectorized import marching_tetrahedra_vectorized, extract_tetra_block
+
+
+# algorithm: (loop implementation, vectorized extractor, block extractor, interpolated vertices)
+ALGORITHMS = {
+    "cubes": (marching_cubes_naive, partial(marching_cubes_vectorized, interpolate=False), extract_block, False),
+    "interp": (marching_cubes_iterpolation, marching_cubes_vectorized, extract_block, True),
+    "tetra": (marching_tetrahedra, marching_tetrahedra_vectorized, extract_tetra_block, True),
+}
+
+
+def sphere_volume():
+    # signed distance to a sphere, positive inside
+    i, j, k = np.indices((14, 12, 10), dtype=np.float64)
+    return 4.5 - np.sqrt((i - 6.5)**2 + (j - 5.5)**2 + (k - 4.5)**2), 0.0
+
+
+def noise_volume():
+    return 128 + 60*smooth_noise((13, 11, 9), seed=2), 128.0
+
+
+def ties_volume():
+    # small integers, many corners are equal to the threshold
+    return np.random.default_rng(3).integers(0, 4, size=(9, 8, 7)).astype(np.uint8), 2
+
+
+VOLUMES = {"sphere": sphere_volume, "noise": noise_volume, "ties": ties_volume}
+
+
+@lru_cache(maxsize=None)
+def loop_mesh(name, algorithm, indexed):
+    """mesh of the loop implementation of an algorithm (the reference), computed once per test session"""
+    voxel, threshold = VOLUMES[name]()
+    return ALGORITHMS[algorithm][0](voxel, threshold, indexed=indexed)
+
+
+def triangles(result, indexed):
+    """(n, 3, 3) triangles of an extractor result or stream chunk"""
+    if indexed:
+        vertices, faces = result
+        return vertices[faces]
+    return getattr(result, "vectors", result)
+
+
+def assert_same_mesh(result, expected, indexed):
+    if indexed:
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+    else:
+        np.testing.assert_array_equal(result.vectors, expected.vectors)
+
+
+@pytest.fixture(params=list(VOLUMES))
+def name(request):
+    return request.param
+
+
+@pytest.mark.parametrize("algorithm", list(ALGORITHMS))
+def test_vectorized_matches_loop(name, algorithm):
+    voxel, threshold = VOLUMES[name]()
+    vectorized = ALGORITHMS[algorithm][1]
+    expected = loop_mesh(name, algorithm, False)
+    assert len(triangles(expected, False))
+
+    assert_same_mesh(vectorized(voxel, threshold), expected, False)
+
+
+@pytest.mark.filterwarnings("ignore:numba is not installed")
+@pytest.mark.parametrize("algorithm", list(ALGORITHMS))
+@pytest.mark.parametrize("indexed", [False, True])
+def test_numba_backend_matches_loop(name, algorithm, indexed):
+    voxel, threshold = VOLUMES[name]()
+    vectorized = ALGORITHMS[algorithm][1]
+    expected = loop_mesh(name, algorithm, indexed)
+
+    assert_same_mesh(vectorized(voxel, threshold, indexed=indexed, backend="numba"), expected, indexed)
+
+
+@pytest.mark.filterwarnings("ignore:numba is not installed")
+@pytest.mark.parametrize("algorithm", list(ALGORITHMS))
+@pytest.mark.parametrize("indexed", [False, True])
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+def test_loop_backends_match_loop(name, algorithm, indexed, backend):
+    voxel, threshold = VOLUMES[name]()
+    loop = ALGORITHMS[algorithm][0]
+    expected = loop_mesh(name, algorithm, indexed)
+
+    assert_same_mesh(loop(voxel, threshold, indexed=indexed, backend=backend), expected, indexed)
+
+
+@pytest.mark.parametrize("algorithm", list(ALGORITHMS))
+def test_indexed_matches_loop(name, algorithm):
+    voxel, threshold = VOLUMES[name]()
+    vectorized = ALGORITHMS[algorithm][1]
+    expected = loop_mesh(name, algorithm, True)
+    assert len(triangles(expected, True))
+
+    assert_same_mesh(vectorized(voxel, threshold, indexed=True), expected, True)
+
+
+@pytest.mark.parametrize("algorithm", list(ALGORITHMS))
+@pytest.mark.parametrize("indexed", [False, True])
+def test_stream_matches_loop(name, algorithm, indexed):
+    voxel, threshold = VOLUMES[name]()
+    _, _, extract, interpolate = ALGORITHMS[algorithm]
+    expected = triangles(loop_mesh(name, algorithm, indexed), indexed)
+
+    chunks = list(marching_cubes_stream((voxel[:, :, k] for k in range(voxel.shape[2])), threshold, indexed=indexed,
+                                        interpolate=interpolate, extract=extract))
+    if indexed:
+        # the faces of a chunk index into the vertices of all the chunks so far, which are never repeated
+        vertices = np.concatenate([chunk[0] for chunk in chunks])
+        result = vertices[np.concatenate([chunk[1] for chunk in chunks])]
+        assert len(vertices) == len(loop_mesh(name, algorithm, indexed)[0])
+    else:
+        result = np.concatenate([triangles(chunk, indexed) for chunk in chunks])
+    # the stream engine emits the triangles slab by slab
+    np.testing.assert_array_equal(sorted_triangles(result), sorted_triangles(expected))
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from stl import mesh
+
+from brick_volume import BrickVolume, convert_ct_folder
+from conftest import read_obj
+from indexed_mesh import save_obj_chunks
+from load_voxels import load_ct_volume
+from stl_writer import StlWriter, facet_normals, save_stl_chunks
+from volume_cache import load_ct_folder_cached
+
+
+def random_triangles(n, seed=0):
+    return np.random.default_rng(seed).normal(scale=10, size=(n, 3, 3)).astype(np.float32)
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_stl_round_trip(tmp_path, background):
+    chunks = [random_triangles(n, seed) for seed, n in enumerate([5, 0, 17])]
+    path = str(tmp_path / "mesh.stl")
+    assert save_stl_chunks(path, chunks, background=background) == 22
+
+    loaded = mesh.Mesh.from_file(path, calculate_normals=False)
+    triangles = np.concatenate(chunks)
+    np.testing.assert_array_equal(loaded.vectors, triangles)
+    np.testing.assert_allclose(loaded.normals, facet_normals(triangles), rtol=1e-6)
+
+
+def test_stl_writer_keeps_given_normals(tmp_path):
+    vertices = np.random.default_rng(0).normal(size=(6, 3)).astype(np.float32)
+    faces = np.array([[0, 1, 2], [2, 3, 4], [4, 5, 0]])
+    normals = np.random.default_rng(1).normal(size=(3, 3)).astype(np.float32)
+    path = str(tmp_path / "mesh.stl")
+    with StlWriter(path) as writer:
+        writer.write_indexed(vertices, faces, normals)
+
+    loaded = mesh.Mesh.from_file(path, calculate_normals=False)
+    np.testing.assert_array_equal(loaded.vectors, vertices[faces])
+    np.testing.assert_array_equal(loaded.normals, normals)
+
+
+def test_stl_writer_raises_the_error_of_its_thread(tmp_path):
+    writer = StlWriter(str(tmp_path / "mesh.stl"), background=True, max_pending=1)
+    # the writer thread fails with a ValueError (flush of closed file) instead of waiting on a full queue
+    writer.file.close()
+    with pytest.raises(ValueError, match="closed file"):
+        for seed in range(10):
+            writer.write(random_triangles(5, seed))
+
+
+def test_obj_round_trip(tmp_path):
+    # the faces of the second chunk also use the vertices of the first one
+    first = (np.random.default_rng(0).uniform(-50, 50, size=(5, 3)), np.array([[0, 1, 2], [2, 3, 4]]))
+    second = (np.random.default_rng(1).uniform(-50, 50, size=(3, 3)), np.array([[4, 5, 6], [6, 7, 0], [1, 7, 5]]))
+    path = str(tmp_path / "mesh.obj")
+    save_obj_chunks(path, [first, second])
+
+    vertices, faces = read_obj(path)
+    np.testing.assert_allclose(vertices, np.concatenate([first[0], second[0]]), atol=1e-6)
+    np.testing.assert_array_equal(faces, np.concatenate([first[1], second[1]]))
+
+
+@pytest.mark.parametrize("gaps", [1, 2.5])
+def test_volume_cache_round_trip(ct_folder, tmp_path, capsys, gaps):
+    expected = load_ct_volume(ct_folder, gaps)
+    cache_dir = str(tmp_path / "cache")
+
+    capsys.readouterr()
+    saved = load_ct_folder_cached(ct_folder, gaps, cache_dir)
+    assert "Opened cached volume" not in capsys.readouterr().out
+    opened = load_ct_folder_cached(ct_folder, gaps, cache_dir)
+    assert "Opened cached volume" in capsys.readouterr().out
+
+    for volume in (saved, opened):
+        assert volume.dtype == expected.dtype
+        np.testing.assert_array_equal(volume, expected)
+
+
+@pytest.mark.parametrize("compression", ["raw", "zlib"])
+@pytest.mark.parametrize("gaps", [1, 2.5])
+def test_bricked_volume_round_trip(ct_folder, tmp_path, compression, gaps):
+    expected = load_ct_volume(ct_folder, gaps)
+    path = str(tmp_path / "bricks")
+    convert_ct_folder(ct_folder, path, gaps, brick_size=8, compression=compression)
+
+    volume = BrickVolume(path)
+    assert volume.shape == expected.shape
+    assert volume.dtype == expected.dtype
+    np.testing.assert_array_equal(volume[:, :, :], expected)
+    # regions across brick boundaries, and inside a single brick
+    for region in [np.s_[3:17, 5:30, 2:9], np.s_[9:10, 0:36, 7:8], np.s_[1:4, 2:5, 3:6]]:
+        np.testing.assert_array_equal(volume[region], expected[region])
+
+    # the brick bounds are the brick index of the volume
+    for brick in np.ndindex(*volume.n_bricks):
+        _, voxels = volume.brick_block(brick)
+        assert volume.index.brick_min[brick] == voxels.min()
+        assert volume.index.brick_max[brick] == voxels.max()
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from conftest import edge_face_counts
+from mc_lod import marching_cubes_adaptive, marching_cubes_lod, volume_pyramid
+from mc_vectorized import marching_cubes_vectorized
+from mesh_decimation import decimate_mesh
+from synthetic_volumes import sample_volume, scene, torus
+
+
+def assert_closed_manifold(faces, genus=0):
+    """every edge has exactly 2 faces that use it in opposite directions, and the Euler characteristic matches the genus"""
+
+    assert len(faces)
+    assert (edge_face_counts(faces) == 2).all()
+
+    # consistently oriented: every directed edge is used once
+    directed = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    assert len(np.unique(directed, axis=0)) == len(directed)
+
+    n_vertices = len(np.unique(faces))
+    n_edges = len(directed)//2
+    assert n_vertices - n_edges + len(faces) == 2 - 2*genus
+
+
+def sphere_volume(size=40):
+    # the surface stays away from the border of the grid, so the mesh is closed
+    shape = (size, size - 4, size - 8)
+    return sample_volume(shape, scene("sphere", shape))
+
+
+def torus_volume(size=48):
+    shape = (size,)*3
+    c = (size - 1)/2
+    return sample_volume(shape, torus((c, c, c), size/4, size/10))
+
+
+@pytest.mark.parametrize("level", [0, 1, 2])
+def test_lod_is_closed_manifold(level):
+    pyramid = volume_pyramid(sphere_volume(), levels=2)
+    _, faces = marching_cubes_lod(pyramid, 0.0, level=level, indexed=True)
+    assert_closed_manifold(faces)
+
+
+@pytest.mark.parametrize("tolerance", [0.0, 0.5, 2.0])
+def test_adaptive_is_closed_manifold(tolerance):
+    _, faces = marching_cubes_adaptive(sphere_volume(), 0.0, tolerance=tolerance, indexed=True)
+    assert_closed_manifold(faces)
+
+
+@pytest.mark.parametrize("volume, genus", [(sphere_volume, 0), (torus_volume, 1)])
+@pytest.mark.parametrize("limit", [{"target_faces": 0.1}, {"target_faces": 0.5}, {"max_error": 0.2}])
+def test_decimation_is_closed_manifold(volume, genus, limit):
+    vertices, faces = marching_cubes_vectorized(volume(), 0.0, indexed=True)
+    assert_closed_manifold(faces, genus)
+
+    _, decimated = decimate_mesh(vertices, faces, **limit)
+    assert len(decimated) < len(faces)
+    assert_closed_manifold(decimated, genus)
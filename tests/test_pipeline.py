@@ -0,0 +1,80 @@
+import filecmp
+import json
+
+import numpy as np
+import pytest
+
+from batch_runner import parse_job, run_batch
+from conftest import read_obj, sorted_triangles
+from indexed_mesh import save_obj_chunks
+from load_voxels import iter_ct_slices, load_ct_volume
+from mc_pipeline import run_pipeline
+from mc_vectorized import marching_cubes_stream, marching_cubes_vectorized, extract_block
+from mt_vectorized import marching_tetrahedra_vectorized, extract_tetra_block
+from stl_writer import STL_RECORD_DTYPE, save_stl_chunks
+
+
+# algorithm: (block extractor, interpolated vertices)
+ALGORITHMS = {"cubes": (extract_block, False), "interp": (extract_block, True), "tetra": (extract_tetra_block, True)}
+
+
+def save_chunks(path, chunks):
+    (save_obj_chunks if path.endswith(".obj") else save_stl_chunks)(path, chunks)
+
+
+def write_stream(ct_folder, path, threshold, gaps, algorithm):
+    """writes the mesh of the stream engine, the reference of the other engines"""
+    extract, interpolate = ALGORITHMS[algorithm]
+    save_chunks(path, marching_cubes_stream(iter_ct_slices(ct_folder, gaps), threshold, indexed=path.endswith(".obj"),
+                                            interpolate=interpolate, extract=extract))
+
+
+def mesh_triangles(path):
+    """triangles of an STL or OBJ file, in a canonical order"""
+    if path.endswith(".obj"):
+        vertices, faces = read_obj(path)
+        triangles = vertices[faces]
+    else:
+        triangles = np.fromfile(path, dtype=STL_RECORD_DTYPE, offset=84)["vectors"]
+    return sorted_triangles(np.asarray(triangles, dtype=np.float64))
+
+
+@pytest.mark.parametrize("algorithm", list(ALGORITHMS))
+@pytest.mark.parametrize("ext", ["stl", "obj"])
+@pytest.mark.parametrize("gaps", [1, 2.5])
+def test_pipeline_matches_stream(ct_folder, tmp_path, algorithm, ext, gaps):
+    expected, output = str(tmp_path / f"stream.{ext}"), str(tmp_path / f"pipeline.{ext}")
+    write_stream(ct_folder, expected, 128, gaps, algorithm)
+
+    extract, interpolate = ALGORITHMS[algorithm]
+    run_pipeline(ct_folder, output, 128, gaps, indexed=ext == "obj", interpolate=interpolate, extract=extract, workers=2)
+    assert filecmp.cmp(output, expected, shallow=False)
+
+
+@pytest.mark.parametrize("algorithm", list(ALGORITHMS))
+@pytest.mark.parametrize("ext", ["stl", "obj"])
+def test_batch_matches_stream(ct_folder, tmp_path, algorithm, ext):
+    jobs = [parse_job({"input": ct_folder, "output": str(tmp_path / f"batch_{threshold}_{gaps}.{ext}"), "threshold": threshold,
+                       "gaps": gaps, "algorithm": algorithm})
+            for threshold, gaps in [(110, 1), (128, 1), (128, 2.5)]]
+    report = str(tmp_path / "report.jsonl")
+    assert run_batch(jobs, report, workers=2, cache_dir=str(tmp_path / "cache")) == (3, 0, 0)
+
+    with open(report) as f:
+        assert sorted(json.loads(line)["status"] for line in f) == ["done"]*3
+
+    for job in jobs:
+        # the batch runs the vectorized engine, whose file is the same as in the CLIs
+        expected = str(tmp_path / f"vectorized.{ext}")
+        volume = load_ct_volume(ct_folder, job["gaps"])
+        indexed = ext == "obj"
+        if algorithm == "tetra":
+            mesh = marching_tetrahedra_vectorized(volume, job["threshold"], indexed=indexed)
+        else:
+            mesh = marching_cubes_vectorized(volume, job["threshold"], indexed=indexed, interpolate=algorithm == "interp")
+        save_chunks(expected, [mesh] if indexed else [mesh.vectors])
+        assert filecmp.cmp(job["output"], expected, shallow=False)
+
+        # and the same triangles as the stream engine, which emits them slab by slab
+        write_stream(ct_folder, expected, job["threshold"], job["gaps"], algorithm)
+        np.testing.assert_array_equal(mesh_triangles(job["output"]), mesh_triangles(expected))
@@ -0,0 +1,29 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from profiling import Profiler
+
+
+def test_profiler_counts_from_threads():
+    # switch threads as often as possible, so that unguarded updates would lose increments
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    profiler = Profiler()
+
+    def record(_):
+        for _ in range(2000):
+            profiler.count("cells")
+            profiler.add_bytes("read", 2)
+            with profiler.stage("read"):
+                pass
+
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(record, range(8)))
+    finally:
+        sys.setswitchinterval(interval)
+
+    report = profiler.report()
+    assert report["counts"]["cells"] == 8*2000
+    assert report["stages"]["read"]["calls"] == 8*2000
+    assert report["stages"]["read"]["bytes"] == 8*2000*2
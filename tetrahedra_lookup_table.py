@@ -1,83 +1,114 @@
 
+import numpy as np
+
+
+# each cubic voxel consists of 6 tetrahedrons (cube vertices, same layout as 'mc_lookup_table.py')
+CUBE_TETRA_VERTICES = [
+    [0, 2, 3, 7],
+    [0, 1, 3, 7],
+    [0, 1, 5, 7],
+    [0, 2, 6, 7],
+    [0, 4, 6, 7],
+    [0, 4, 5, 7]
+]
+
+# unit tetrahedra coordinates of the cube vertices 0 to 7
+CUBE_VERTEX_POSITIONS = [
+    (0, 0, 0),
+    (1, 0, 0),
+    (0, 0, 1),
+    (1, 0, 1),
+    (0, 1, 0),
+    (1, 1, 0),
+    (0, 1, 1),
+    (1, 1, 1)
+]
+
+# works for each tetrahedra
+VERTEX_MAPPING = [
+    [0, 1],
+    [1, 2],
+    [2, 3],
+    [0, 2],
+    [1, 3],
+    [0, 3]
+]
+
+EDGES_LIST = [
+    [],                 # 0000, 0
+    [0, 5, 3],          # 0001, 1
+    [0, 1, 4],          # 0010, 2
+    # [4, 1, 3, 4, 5, 3], # 0011, 3
+    [1, 5, 4, 1, 5, 3], # 0011, 3
+    [1, 2, 3],          # 0100, 4
+    [0, 2, 1, 0, 2, 5], # 0101, 5
+    [0, 2, 4, 0, 2, 3], # 0110, 6
+    [4, 5, 2],          # 0111, 7
+    [4, 5, 2],          # 1000, 8
+    [0, 2, 4, 0, 2, 3], # 1001, 9
+    [0, 2, 1, 0, 2, 5], # 1010, 10
+    [1, 2, 3],          # 1011, 11
+    [1, 5, 4, 1, 5, 3], # 1100, 12
+    [0, 1, 4],          # 1101, 13
+    [0, 5, 3],          # 1110, 14
+    [],                 # 1111, 15
+]
+
+# edges of each lookup index, divided up by 3 (one triplet per triangle)
+EDGE_TRIPLES = [[edge_set[i:i+3] for i in range(0, len(edge_set), 3)] for edge_set in EDGES_LIST]
+
+# unit tetrahedra coordinate of the start vertex of each (tetra_idx, edge_idx), and direction towards the end vertex
+UNIT_TETRAHEDRA_EDGES = [
+    [
+        (CUBE_VERTEX_POSITIONS[t_vertices[start]],
+         tuple(e - s for s, e in zip(CUBE_VERTEX_POSITIONS[t_vertices[start]], CUBE_VERTEX_POSITIONS[t_vertices[end]])))
+        for start, end in VERTEX_MAPPING
+    ]
+    for t_vertices in CUBE_TETRA_VERTICES
+]
+
+
+def _build_tables():
+    """builds the flat tables (indexed with whole batches of tetrahedra by the vectorized extractor)"""
+
+    tri_table = -np.ones((16, 6), dtype=np.int8)      # edges of each lookup index, padded with -1
+    tri_count = np.zeros(16, dtype=np.uint8)          # number of triangles of each lookup index
+    for idx, edge_set in enumerate(EDGES_LIST):
+        tri_table[idx, :len(edge_set)] = edge_set
+        tri_count[idx] = len(edge_set) // 3
+
+    # cube vertices at both ends of each (tetra_idx, edge_idx), shape (6, 6, 2)
+    edge_cube_vertices = np.array(CUBE_TETRA_VERTICES)[:, VERTEX_MAPPING].astype(np.int8)
+    edge_origin = np.array([[origin for origin, _ in edges] for edges in UNIT_TETRAHEDRA_EDGES], dtype=np.float64)
+    edge_direction = np.array([[direction for _, direction in edges] for edges in UNIT_TETRAHEDRA_EDGES], dtype=np.float64)
+
+    # lookup index of each tetrahedra given the lookup index of the cube (bit n is cube vertex n)
+    cube_bits = (np.arange(256)[:, None] >> np.arange(8)) & 1
+    tetra_case = np.zeros((256, 6), dtype=np.uint8)
+    for tetra_idx, t_vertices in enumerate(CUBE_TETRA_VERTICES):
+        for n, vertex in enumerate(t_vertices):
+            tetra_case[:, tetra_idx] |= (cube_bits[:, vertex] << n).astype(np.uint8)
+
+    return tri_table, tri_count, edge_cube_vertices, edge_origin, edge_direction, tetra_case
+
+
+TETRA_TRI_TABLE, TETRA_TRI_COUNT, TETRA_EDGE_CUBE_VERTICES, TETRA_EDGE_ORIGIN, TETRA_EDGE_DIRECTION, \
+    CUBE_TO_TETRA_CASE = _build_tables()
+
+
 def edge_to_vertex(edge_idx):
     "works for each tetrahedra"
-    vertex_mapping = [
-        [0, 1],
-        [1, 2],
-        [2, 3],
-        [0, 2],
-        [1, 3],
-        [0, 3]
-    ]
-    return vertex_mapping[edge_idx]
+    return VERTEX_MAPPING[edge_idx]
 
 
 def edge_idx_to_unit_tetrahedra_mapping(edge_idx, tetra_idx, alpha=0.5):
     "maps the edge index to a unit tetrahedra coordinate"
 
-    assert edge_idx in list(range(6)), f"{edge_idx} out of range 0-5"
-    assert tetra_idx in list(range(6)), f"tetra_idx {tetra_idx} must be in range 0-5"
-
-    if edge_idx == 0:
-
-        if tetra_idx in [0, 3]:
-            return (0, 0, alpha)
-        elif tetra_idx in [1, 2]:
-            return (alpha, 0, 0)
-        elif tetra_idx in [4, 5]:
-            return (0, alpha, 0)
-        
-    elif edge_idx == 1:
-
-        if tetra_idx == 0:
-            return (alpha, 0, 1)
-        elif tetra_idx == 1:
-            return (1, 0, alpha)
-        elif tetra_idx == 2:
-            return (1, alpha, 0)
-        elif tetra_idx == 3:
-            return (0, alpha, 1)
-        elif tetra_idx == 4:
-            return (0, 1, alpha)
-        elif tetra_idx == 5:
-            return (alpha, 1, 0)
-    
-    elif edge_idx == 2:
-
-        if tetra_idx in [0, 1]:
-            return (1, alpha, 1)
-        if tetra_idx in [2, 5]:
-            return (1, 1, alpha)
-        elif tetra_idx in [3, 4]:
-            return (alpha, 1, 1)
-
-    elif edge_idx == 3:
-
-        if tetra_idx in [0, 1]:
-            # z = x function, y = 0
-            return (alpha, 0, alpha)
-        elif tetra_idx in [2, 5]:
-            # z = 0, y = x 
-            return (alpha, alpha, 0)
-        elif tetra_idx in [3, 4]:
-            # x = 0, z = y
-            return (0, alpha, alpha)
-
-    elif edge_idx == 4:
-
-        if tetra_idx in [0, 3]:
-            # y = x function, z = 1
-            return (alpha, alpha, 1)
-        elif tetra_idx in [1, 2]:
-            # x = 1, z = y
-            return (1, alpha, alpha)
-        elif tetra_idx in [4, 5]:
-            # y = 1, z = x
-            return (alpha, 1, alpha)
-        
-    elif edge_idx == 5:
-        # y = x, z = x function
-        return (alpha, alpha, alpha)
+    assert 0 <= edge_idx < 6, f"{edge_idx} out of range 0-5"
+    assert 0 <= tetra_idx < 6, f"tetra_idx {tetra_idx} must be in range 0-5"
+
+    (x, y, z), (dx, dy, dz) = UNIT_TETRAHEDRA_EDGES[tetra_idx][edge_idx]
+    return (x + alpha*dx, y + alpha*dy, z + alpha*dz)
 
 def binary_to_base10(binary_list):
     "converts a binary list to base10"
@@ -87,33 +118,7 @@ def get_edge(idx):
     """idx is the base10 value of the 4 edge binaries
     Checked for all tetrahedras
     """
-
-    edges_list = [
-        [],                 # 0000, 0
-        [0, 5, 3],          # 0001, 1
-        [0, 1, 4],          # 0010, 2
-        # [4, 1, 3, 4, 5, 3], # 0011, 3
-        [1, 5, 4, 1, 5, 3], # 0011, 3
-        [1, 2, 3],          # 0100, 4
-        [0, 2, 1, 0, 2, 5], # 0101, 5
-        [0, 2, 4, 0, 2, 3], # 0110, 6
-        [4, 5, 2],          # 0111, 7
-        [4, 5, 2],          # 1000, 8
-        [0, 2, 4, 0, 2, 3], # 1001, 9
-        [0, 2, 1, 0, 2, 5], # 1010, 10
-        [1, 2, 3],          # 1011, 11
-        [1, 5, 4, 1, 5, 3], # 1100, 12
-        [0, 1, 4],          # 1101, 13
-        [0, 5, 3],          # 1110, 14
-        [],                 # 1111, 15
-    ]
-
-    edge_set = edges_list[idx]
-
-    # divide it up by 3
-    edge_triples = [ edge_set[i:i+3] for i in range(0, len(edge_set), 3) ]
-
-    return edge_triples
+    return EDGE_TRIPLES[idx]
 
 
 # import numpy as np
@@ -0,0 +1,127 @@
+"""
+Memory-mapped volume cache.
+
+Decoding the images of a CT folder takes most of the time of a run on a small volume, so the
+loaded (and resampled) volume is saved once as a raw '.npy' file next to a small JSON sidecar
+describing where it comes from: the folder path, the name, size and modification time of every
+image and the gaps setting. Later runs check the sidecar and open the volume zero-copy with
+np.load(mmap_mode='r'), which only maps the file (the pages are read on demand).
+
+The cache entry of a (folder, gaps) pair is replaced when any of the images changes. A memmapped
+volume is also passed to the worker processes of 'mc_parallel.py' by file name instead of being
+copied into shared memory. The downsampled levels of the LOD previews (see 'mc_lod.py') are cached
+the same way, one entry per level.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from load_voxels import load_ct_volume
+from mc_lod import downsample
+from profiling import NULL_PROFILER
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "marching-cubes")
+
+
+def folder_metadata(folder_dir, gaps=1):
+    """describes the images of the folder and the gaps setting (the cache entry is valid while it does not change)"""
+
+    folder_dir = os.path.abspath(folder_dir)
+    files = []
+    for file in sorted(os.listdir(folder_dir)):
+        stat = os.stat(os.path.join(folder_dir, file))
+        files.append([file, stat.st_size, stat.st_mtime_ns])
+
+    return {"folder": folder_dir, "gaps": float(gaps), "files": files}
+
+
+def cache_paths(cache_dir, folder_dir, gaps=1, level=0):
+    """(volume, sidecar) paths of the cache entry of a folder and gaps setting (and pyramid level, see 'mc_lod.py')"""
+
+    key = json.dumps([os.path.abspath(folder_dir), float(gaps)] + ([level] if level else []))
+    name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, name + ".npy"), os.path.join(cache_dir, name + ".json")
+
+
+def _open_entry(volume_path, sidecar_path, metadata, profiler):
+    """memory-mapped volume of the entry if its sidecar matches the metadata, else None"""
+
+    try:
+        with open(sidecar_path) as f:
+            cached = json.load(f)
+        if all(cached.get(name) == value for name, value in metadata.items()):
+            with profiler.stage("cache"):
+                volume = np.load(volume_path, mmap_mode="r")
+            profiler.count("cache_hits")
+            return volume
+    except (OSError, ValueError):
+        pass
+
+    profiler.count("cache_misses")
+    return None
+
+
+def _save_entry(volume, volume_path, sidecar_path, metadata, profiler):
+    """writes the entry and returns it memory-mapped"""
+
+    # invalidate the old entry, and write to temporary files first so an interrupted run never
+    # leaves a partial entry
+    os.makedirs(os.path.dirname(volume_path), exist_ok=True)
+    if os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+    with profiler.stage("cache"), open(volume_path + ".tmp", "wb") as f:
+        np.save(f, volume)
+    profiler.add_bytes("cache", volume.nbytes)
+    os.replace(volume_path + ".tmp", volume_path)
+
+    metadata = dict(metadata, shape=list(volume.shape), dtype=volume.dtype.str)
+    with open(sidecar_path + ".tmp", "w") as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(sidecar_path + ".tmp", sidecar_path)
+
+    return np.load(volume_path, mmap_mode="r")
+
+
+def load_ct_folder_cached(folder_dir, gaps=1, cache_dir=DEFAULT_CACHE_DIR, stats=False, profiler=NULL_PROFILER):
+    """same volume as 'load_voxels.load_ct_volume', memory-mapped (read only) from the cache
+
+    stats prints the value statistics of the images when they are loaded (not when the cache entry is reused)
+    """
+
+    volume_path, sidecar_path = cache_paths(cache_dir, folder_dir, gaps)
+    metadata = folder_metadata(folder_dir, gaps)
+
+    # reuse the entry if the images did not change
+    volume = _open_entry(volume_path, sidecar_path, metadata, profiler)
+    if volume is not None:
+        print(f"Opened cached volume {volume_path} for {folder_dir}")
+        print(f"Dimensions: {volume.shape}")
+        return volume
+
+    volume = load_ct_volume(folder_dir, gaps, stats, profiler)
+    return _save_entry(volume, volume_path, sidecar_path, metadata, profiler)
+
+
+def load_lod_cached(folder_dir, levels=3, gaps=1, cache_dir=DEFAULT_CACHE_DIR, stats=False, profiler=NULL_PROFILER):
+    """same pyramid as 'mc_lod.volume_pyramid' of the folder volume, every level memory-mapped from the cache
+
+    Each level is a cache entry of its own, validated against the images like the volume, and
+    built from the level below it only when it is missing or out of date.
+    """
+
+    pyramid = [load_ct_folder_cached(folder_dir, gaps, cache_dir, stats, profiler)]
+    for level in range(1, levels + 1):
+        volume_path, sidecar_path = cache_paths(cache_dir, folder_dir, gaps, level)
+        metadata = dict(folder_metadata(folder_dir, gaps), level=level)
+        volume = _open_entry(volume_path, sidecar_path, metadata, profiler)
+        if volume is None:
+            with profiler.stage("downsample"):
+                volume = downsample(pyramid[-1])
+            volume = _save_entry(volume, volume_path, sidecar_path, metadata, profiler)
+        pyramid.append(volume)
+
+    return pyramid